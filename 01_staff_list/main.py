@@ -1,118 +1,108 @@
 import asyncio
-import httpx
-import config
-from connection import Connection
-import json
-import csv
+from fetch import fetch_pages
+from profiles import Connections, tag, tagged_schema, tagged_columns
+from schema import USERS
+from snapshot import StageOutput
+from sinks import streaming_enabled
+from columnar import USER_COLUMNS
+from store import Store
+from sync import delta_sync, INCREMENTAL_SYNC
 from pathlib import Path
 
-async def get_users_by_patrongroup(base_url, tenant, token, patron_group_id):
-    users = []
-    limit = 1000
-    offset = 0
-
-    headers = {
-        "x-okapi-token": token,
-        "x-okapi-tenant": tenant
-    }
-
-    async with httpx.AsyncClient() as client:
-        while True:
-            print(f"Descargando usuarios... offset: {offset}")
-            query = f'patronGroup=="{patron_group_id}"'
-            params = {
-                "query": query,
-                "limit": limit,
-                "offset": offset
-            }
-
-            try:
-                response = await client.get(
-                    f"{base_url}/users",
-                    headers=headers,
-                    params=params
-                )
-                response.raise_for_status()
-                data = response.json()
-                batch = data.get("users", [])
-                users.extend(batch)
-
-                if len(batch) < limit:
-                    break
-                offset += limit
-
-            except httpx.HTTPStatusError as exc:
-                print(f"Error HTTP {exc.response.status_code}: {exc.response.text}")
-                break
-            except httpx.RequestError as exc:
-                print(f"Error de conexión: {exc}")
-                break
+# Rutas relativas a este script, para poder correrlo desde cualquier carpeta
+STAGE_DIR = Path(__file__).resolve().parent
+OUTPUT_DIR = STAGE_DIR / "output"
 
-    return users
+# Salidas de la etapa (las columnas llevan la del perfil si hay OKAPI_PROFILES)
+OUTPUT = StageOutput(OUTPUT_DIR, "usuarios",
+                     tagged_schema(USERS), tagged_columns(USER_COLUMNS),
+                     uuids=("uuids.tsv", ["id"]), store=("users", "upsert_users", "patron_group = ?"))
 
-def flatten_user(user):
-    """Convierte la estructura anidada en una plana para TSV"""
-    flat = {
-        "id": user.get("id"),
-        "username": user.get("username"),
-        "barcode": user.get("barcode"),
-        "active": user.get("active"),
-        "patronGroup": user.get("patronGroup"),
-        "createdDate": user.get("createdDate"),
-        "updatedDate": user.get("updatedDate"),
-        "personal.lastName": user.get("personal", {}).get("lastName"),
-        "personal.firstName": user.get("personal", {}).get("firstName"),
-        "personal.middleName": user.get("personal", {}).get("middleName"),
-        "personal.email": user.get("personal", {}).get("email"),
-        "personal.mobilePhone": user.get("personal", {}).get("mobilePhone"),
-        "personal.preferredContactTypeId": user.get("personal", {}).get("preferredContactTypeId"),
-        "metadata.createdDate": user.get("metadata", {}).get("createdDate"),
-        "metadata.updatedDate": user.get("metadata", {}).get("updatedDate"),
-        "metadata.createdByUserId": user.get("metadata", {}).get("createdByUserId"),
-        "metadata.updatedByUserId": user.get("metadata", {}).get("updatedByUserId"),
-    }
-    return flat
-
-def save_json(users, path):
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(users, f, indent=2, ensure_ascii=False)
-
-def save_tsv(users, path):
-    flattened_users = [flatten_user(u) for u in users]
-    fieldnames = flattened_users[0].keys() if flattened_users else []
-
-    with open(path, "w", newline="", encoding="utf-8") as f:
-        writer = csv.DictWriter(f, fieldnames=fieldnames, delimiter="\t")
-        writer.writeheader()
-        writer.writerows(flattened_users)
-
-def save_uuids(users, path):
-    with open(path, "w", newline="", encoding="utf-8") as f:
-        writer = csv.writer(f, delimiter="\t")
-        writer.writerow(["id"])
-        for u in users:
-            writer.writerow([u.get("id")])
+def iter_users_by_patrongroup(conn, patron_group_id, concurrency=None, mode=None):
+    """Páginas de usuarios del patron group, a medida que llegan."""
+    query = f'patronGroup=="{patron_group_id}"'
+    return fetch_pages(conn, "/users", "users", query=query,
+                       concurrency=concurrency, mode=mode, label="usuarios",
+                       checkpoint=f"01_usuarios_{patron_group_id}")
 
-async def main():
-    base_url = config.OKAPI_URL
-    tenant = config.OKAPI_TENANT
-    conn = Connection()
-    token = await conn.get_token()
-    patron_group_id = "34688b28-fec2-4a8d-b108-e35532f54601"
+async def get_users_by_patrongroup(conn, patron_group_id, concurrency=None, mode=None):
+    users = []
 
-    print("Iniciando descarga de usuarios...")
-    users = await get_users_by_patrongroup(base_url, tenant, token, patron_group_id)
-    print(f"Usuarios encontrados con patronGroup {patron_group_id}: {len(users)}")
+    async for batch in iter_users_by_patrongroup(conn, patron_group_id, concurrency, mode):
+        users.extend(batch)
 
-    # Crear carpeta de salida si no existe
-    Path("output").mkdir(exist_ok=True)
+    return users
 
-    # Guardar los archivos
-    save_json(users, "output/usuarios.json")
-    save_tsv(users, "output/usuarios.tsv")
-    save_uuids(users, "output/uuids.tsv")
+def jobs(connections):
+    """Descargas de la etapa: (conexión, perfil, patron group) por cada combinación."""
+    return [(conn, profile, patron_group_id)
+            for profile, conn in connections
+            for patron_group_id in profile.patron_groups]
+
+def describe(profile, patron_group_id):
+    suffix = f" en {profile.name}" if profile.name else ""
+    return f"patronGroup {patron_group_id}{suffix}"
+
+async def stream_users(connections):
+    """Escribe cada página directo a NDJSON/TSV/uuids sin acumular en memoria.
+
+    Todos los perfiles y patron groups se descargan a la vez y sus páginas
+    se van agregando a los mismos archivos a medida que llegan.
+    """
+    async def download(out, conn, profile, patron_group_id):
+        count = 0
+        async for batch in iter_users_by_patrongroup(conn, patron_group_id):
+            out.write(tag(batch, profile))
+            count += len(batch)
+        print(f"Usuarios encontrados con {describe(profile, patron_group_id)}: {count}")
+
+    async def download_all(out):
+        await asyncio.gather(*(download(out, *job) for job in jobs(connections)))
+
+    patron_group_ids = [patron_group_id for _, _, patron_group_id in jobs(connections)]
+    return await OUTPUT.stream(download_all, patron_group_ids)
+
+async def sync_users(conn, patron_group_id):
+    """Trae solo los usuarios modificados y devuelve la copia completa actualizada."""
+    scope = ("patron_group = ?", (patron_group_id,))
+    with await asyncio.to_thread(Store) as store:
+        await delta_sync(conn, store, f"users:{patron_group_id}", "users", "/users", "users",
+                         store.upsert_users, base_query=f'patronGroup=="{patron_group_id}"',
+                         scope=scope[0], scope_params=scope[1], label="usuarios")
+        return store.records("users", *scope)
+
+async def fetch_users(conn, profile, patron_group_id):
+    if INCREMENTAL_SYNC:
+        users = await sync_users(conn, patron_group_id)
+    else:
+        users = await get_users_by_patrongroup(conn, patron_group_id)
+    print(f"Usuarios encontrados con {describe(profile, patron_group_id)}: {len(users)}")
+    return tag(users, profile)
+
+async def run(connections, write_files=True):
+    """Descarga los usuarios de todos los perfiles y patron groups a la vez y los devuelve.
+
+    `connections` son los pares (perfil, conexión) de profiles.Connections;
+    los archivos son opcionales.
+    """
+    results = await asyncio.gather(*(fetch_users(*job) for job in jobs(connections)))
+    users = [user for batch in results for user in batch]
+
+    if write_files:
+        patron_group_ids = [patron_group_id for _, _, patron_group_id in jobs(connections)]
+        # La codificación corre en otro hilo para no frenar las descargas de las demás etapas
+        await asyncio.to_thread(OUTPUT.save, users, patron_group_ids, mirror=not INCREMENTAL_SYNC)
+    return users
 
-    print("Archivos guardados en la carpeta 'output'.")
+async def main():
+    print("Iniciando descarga de usuarios...")
+    async with Connections() as connections:
+        if streaming_enabled() and not INCREMENTAL_SYNC:
+            count = await stream_users(connections)
+            print(f"Usuarios encontrados en total: {count}")
+            print("Archivos guardados en la carpeta 'output'.")
+            return
+        await run(connections)
 
 if __name__ == "__main__":
     asyncio.run(main())
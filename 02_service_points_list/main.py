@@ -1,109 +1,79 @@
 import asyncio
-import httpx
-import config
-from connection import Connection
-import json
-import csv
+from fetch import fetch_pages
+from profiles import Connections, tag, tagged_schema, tagged_columns
+from schema import SERVICE_POINTS
+from snapshot import StageOutput
+from sinks import streaming_enabled
+from columnar import SERVICE_POINT_COLUMNS
+from refdata import ReferenceData
 from pathlib import Path
 
-async def get_all_service_points(base_url, tenant, token):
+# Rutas relativas a este script, para poder correrlo desde cualquier carpeta
+STAGE_DIR = Path(__file__).resolve().parent
+OUTPUT_DIR = STAGE_DIR / "output"
+
+# Salidas de la etapa (las columnas llevan la del perfil si hay OKAPI_PROFILES)
+OUTPUT = StageOutput(OUTPUT_DIR, "service_points",
+                     tagged_schema(SERVICE_POINTS), tagged_columns(SERVICE_POINT_COLUMNS),
+                     uuids=("uuids.tsv", ["id", "discoveryDisplayName"]),
+                     store=("service_points", "upsert_service_points", None))
+
+def iter_service_points(conn, concurrency=None):
+    """Páginas de service points, a medida que llegan."""
+    return fetch_pages(conn, "/service-points", "servicepoints",
+                       concurrency=concurrency, label="service points",
+                       checkpoint="02_service_points")
+
+async def get_all_service_points(conn, concurrency=None):
     service_points = []
-    limit = 1000
-    offset = 0
-
-    headers = {
-        "x-okapi-token": token,
-        "x-okapi-tenant": tenant
-    }
-
-    async with httpx.AsyncClient() as client:
-        while True:
-            print(f"Descargando service points... offset: {offset}")
-            params = {
-                "limit": limit,
-                "offset": offset
-            }
-
-            try:
-                response = await client.get(
-                    f"{base_url}/service-points",
-                    headers=headers,
-                    params=params
-                )
-                response.raise_for_status()
-                data = response.json()
-                batch = data.get("servicepoints", [])
-                service_points.extend(batch)
-
-                if len(batch) < limit:
-                    break
-                offset += limit
-
-            except httpx.HTTPStatusError as exc:
-                print(f"Error HTTP {exc.response.status_code}: {exc.response.text}")
-                break
-            except httpx.RequestError as exc:
-                print(f"Error de conexión: {exc}")
-                break
+
+    async for batch in iter_service_points(conn, concurrency):
+        service_points.extend(batch)
 
     return service_points
 
-def flatten_service_point(sp):
-    """Convierte la estructura de un service-point en una plana para TSV"""
-    return {
-        "id": sp.get("id"),
-        "name": sp.get("name"),
-        "code": sp.get("code"),
-        "discoveryDisplayName": sp.get("discoveryDisplayName"),
-        "description": sp.get("description"),
-        "shelvingLagTime": sp.get("shelvingLagTime"),
-        "pickupLocation": sp.get("pickupLocation"),
-        "holdShelfExpiryPeriod": json.dumps(sp.get("holdShelfExpiryPeriod"), ensure_ascii=False),
-        "staffSlips": json.dumps(sp.get("staffSlips"), ensure_ascii=False),
-        "metadata.createdDate": sp.get("metadata", {}).get("createdDate"),
-        "metadata.updatedDate": sp.get("metadata", {}).get("updatedDate"),
-        "metadata.createdByUserId": sp.get("metadata", {}).get("createdByUserId"),
-        "metadata.updatedByUserId": sp.get("metadata", {}).get("updatedByUserId")
-    }
-
-def save_json(data, path):
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(data, f, indent=2, ensure_ascii=False)
-
-def save_tsv(data, path, flatten_fn):
-    flat_data = [flatten_fn(d) for d in data]
-    fieldnames = flat_data[0].keys() if flat_data else []
-
-    with open(path, "w", newline="", encoding="utf-8") as f:
-        writer = csv.DictWriter(f, fieldnames=fieldnames, delimiter="\t")
-        writer.writeheader()
-        writer.writerows(flat_data)
-
-def save_uuids(data, path):
-    with open(path, "w", newline="", encoding="utf-8") as f:
-        writer = csv.writer(f, delimiter="\t")
-        writer.writerow(["id", "discoveryDisplayName"])
-        for d in data:
-            writer.writerow([d.get("id"), d.get("discoveryDisplayName")])
+async def stream_service_points(connections):
+    """Escribe cada página directo a NDJSON/TSV/uuids sin acumular en memoria.
 
+    Los perfiles se descargan a la vez y sus páginas van a los mismos archivos.
+    """
+    async def download(out, profile, conn):
+        async for batch in iter_service_points(conn):
+            out.write(tag(batch, profile))
 
-async def main():
-    base_url = config.OKAPI_URL
-    tenant = config.OKAPI_TENANT
-    conn = Connection()
-    token = await conn.get_token()
+    async def download_all(out):
+        await asyncio.gather(*(download(out, profile, conn) for profile, conn in connections))
 
-    print("Iniciando descarga de service points...")
-    service_points = await get_all_service_points(base_url, tenant, token)
-    print(f"Service points encontrados: {len(service_points)}")
+    return await OUTPUT.stream(download_all)
 
-    Path("output").mkdir(exist_ok=True)
+async def fetch_service_points(profile, conn):
+    service_points = await get_all_service_points(conn)
+    # Deja la lista en el caché de referencia (de ese tenant) para que la etapa 05 no la pida
+    ReferenceData(conn).save("service_points", service_points)
+    return tag(service_points, profile)
 
-    save_json(service_points, "output/service_points.json")
-    save_tsv(service_points, "output/service_points.tsv", flatten_service_point)
-    save_uuids(service_points, "output/uuids.tsv")
+async def run(connections, write_files=True):
+    """Descarga los service points de todos los perfiles a la vez y los devuelve.
 
-    print("Archivos guardados en la carpeta 'output'.")
+    Los archivos son opcionales.
+    """
+    results = await asyncio.gather(*(fetch_service_points(profile, conn) for profile, conn in connections))
+    service_points = [sp for batch in results for sp in batch]
+    print(f"Service points encontrados: {len(service_points)}")
+
+    if write_files:
+        await asyncio.to_thread(OUTPUT.save, service_points)
+    return service_points
+
+async def main():
+    print("Iniciando descarga de service points...")
+    async with Connections() as connections:
+        if streaming_enabled():
+            count = await stream_service_points(connections)
+            print(f"Service points encontrados: {count}")
+            print("Archivos guardados en la carpeta 'output'.")
+            return
+        await run(connections)
 
 if __name__ == "__main__":
     asyncio.run(main())
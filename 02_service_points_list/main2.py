@@ -1,10 +1,24 @@
 import asyncio
-import httpx
-import config
 from connection import Connection
-import json
+from fetch import fetch_pages, fetch_by_ids
+from sync import remote_count
+from schema import save_tsv, SERVICE_POINT_USERS
+from sinks import StreamingOutput, NdjsonWriter, TsvWriter, ColumnsWriter, streaming_enabled
+from columnar import ParquetWriter, save_parquet, parquet_enabled, SERVICE_POINT_USER_COLUMNS
+import jsoncodec
 import csv
 from pathlib import Path
+import config
+
+# Rutas relativas a este script, para poder correrlo desde cualquier carpeta
+STAGE_DIR = Path(__file__).resolve().parent
+OUTPUT_DIR = STAGE_DIR / "output"
+
+# "server": filtra en Okapi con userId==(...); "scan": descarga todo y filtra aquí;
+# "auto": elige según cuántos ids hay frente al total de asignaciones
+FILTER_MODE = getattr(config, "SP_USERS_FILTER_MODE", "auto")
+# En modo "auto" se filtra en el servidor si ids / total no supera esta fracción
+SERVER_FILTER_MAX_FRACTION = getattr(config, "SP_USERS_SERVER_FILTER_MAX_FRACTION", 0.3)
 
 def load_user_ids_from_tsv(path):
     """Carga userIds desde un archivo TSV con o sin encabezado"""
@@ -13,76 +27,30 @@ def load_user_ids_from_tsv(path):
 
         reader = csv.reader(f, delimiter="\t")
         for row in reader:
-            # Si hay encabezado, lo ignoramos (suponiendo que la columna se llama 'userId')
-            if row and row[0].lower() == "userId".lower():
+            # Si hay encabezado, lo ignoramos (la columna se llama 'userId' o 'id')
+            if row and row[0].lower() in ("userid", "id"):
                 continue
             if row:
                 user_ids.add(row[0].strip())
     return user_ids
 
-async def get_all_service_point_users(base_url, tenant, token):
+def iter_service_point_users(conn, concurrency=None, mode=None):
+    """Páginas de service point users, a medida que llegan."""
+    return fetch_pages(conn, "/service-points-users", "servicePointsUsers",
+                       concurrency=concurrency, mode=mode, label="service point users",
+                       checkpoint="02_service_point_users")
+
+async def get_all_service_point_users(conn, concurrency=None, mode=None):
     service_point_users = []
-    limit = 1000
-    offset = 0
-
-    headers = {
-        "x-okapi-token": token,
-        "x-okapi-tenant": tenant
-    }
-
-    async with httpx.AsyncClient() as client:
-        while True:
-            print(f"Descargando service point users... offset: {offset}")
-            params = {
-                "limit": limit,
-                "offset": offset
-            }
-
-            try:
-                response = await client.get(
-                    f"{base_url}/service-points-users",
-                    headers=headers,
-                    params=params
-                )
-                response.raise_for_status()
-                data = response.json()
-                batch = data.get("servicePointsUsers", [])
-                service_point_users.extend(batch)
-
-                if len(batch) < limit:
-                    break
-                offset += limit
-
-            except httpx.HTTPStatusError as exc:
-                print(f"Error HTTP {exc.response.status_code}: {exc.response.text}")
-                break
-            except httpx.RequestError as exc:
-                print(f"Error de conexión: {exc}")
-                break
 
-    return service_point_users
+    async for batch in iter_service_point_users(conn, concurrency, mode):
+        service_point_users.extend(batch)
 
-def flatten_service_point_user(spu):
-    """Convierte la estructura de un service point user en una plana para TSV"""
-    return {
-        "id": spu.get("id"),
-        "userId": spu.get("userId"),
-        "servicePoints": json.dumps(spu.get("servicePoints"), ensure_ascii=False),
-        "defaultServicePointId": spu.get("defaultServicePointId"),
-    }
+    return service_point_users
 
 def save_json(data, path):
     with open(path, "w", encoding="utf-8") as f:
-        json.dump(data, f, indent=2, ensure_ascii=False)
-
-def save_tsv(data, path, flatten_fn):
-    flat_data = [flatten_fn(d) for d in data]
-    fieldnames = flat_data[0].keys() if flat_data else []
-
-    with open(path, "w", newline="", encoding="utf-8") as f:
-        writer = csv.DictWriter(f, fieldnames=fieldnames, delimiter="\t")
-        writer.writeheader()
-        writer.writerows(flat_data)
+        jsoncodec.dump(data, f)
 
 def save_uuids(data, path):
     with open(path, "w", newline="", encoding="utf-8") as f:
@@ -91,32 +59,87 @@ def save_uuids(data, path):
         for d in data:
             writer.writerow([d.get("id"), d.get("userId")])
 
-async def main():
-    base_url = config.OKAPI_URL
-    tenant = config.OKAPI_TENANT
-    conn = Connection()
-    token = await conn.get_token()
+def output_writers():
+    """Writers de la salida en streaming (NDJSON, TSV, uuids y Parquet opcional)."""
+    writers = [
+        NdjsonWriter(OUTPUT_DIR / "service_point_users_filtrados.ndjson"),
+        TsvWriter(OUTPUT_DIR / "service_point_users_filtrados.tsv", SERVICE_POINT_USERS),
+        ColumnsWriter(OUTPUT_DIR / "service_point_users_uuids_filtrados.tsv", ["id", "userId"]),
+    ]
+    if parquet_enabled():
+        writers.append(ParquetWriter(OUTPUT_DIR / "service_point_users_filtrados.parquet", SERVICE_POINT_USER_COLUMNS))
+    return writers
+
+def save_outputs(filtered_sp_users):
+    OUTPUT_DIR.mkdir(exist_ok=True)
+
+    if streaming_enabled():
+        with StreamingOutput(*output_writers()) as out:
+            out.write(filtered_sp_users)
+    else:
+        save_json(filtered_sp_users, OUTPUT_DIR / "service_point_users_filtrados.json")
+        save_tsv(filtered_sp_users, OUTPUT_DIR / "service_point_users_filtrados.tsv", SERVICE_POINT_USERS)
+        save_uuids(filtered_sp_users, OUTPUT_DIR / "service_point_users_uuids_filtrados.tsv")
+        if parquet_enabled():
+            save_parquet(filtered_sp_users, OUTPUT_DIR / "service_point_users_filtrados.parquet", SERVICE_POINT_USER_COLUMNS)
+
+    print("Archivos guardados en la carpeta 'output'.")
+
+async def choose_filter_mode(conn, user_ids):
+    """Filtra en el servidor solo si los ids son una fracción chica del total."""
+    total = await remote_count(conn, "/service-points-users", "cql.allRecords=1")
+    fraction = len(user_ids) / total if total else 1
+    mode = "server" if fraction <= SERVER_FILTER_MAX_FRACTION else "scan"
+    print(f"Service point users en Okapi: {total} ({fraction:.1%} de ids buscados) → modo {mode}")
+    return mode
+
+async def get_service_point_users_by_user_ids(conn, user_ids):
+    """Pide a Okapi solo las asignaciones de los userIds, en lotes CQL paralelos."""
+    return await fetch_by_ids(conn, "/service-points-users", "servicePointsUsers", user_ids,
+                              field="userId", label="service point users")
+
+async def stream_filtered_service_point_users(conn, user_ids):
+    """Filtra y escribe cada página al llegar, sin acumular en memoria."""
+    total = 0
+    with StreamingOutput(*output_writers()) as out:
+        async for batch in iter_service_point_users(conn):
+            total += len(batch)
+            out.write([spu for spu in batch if spu.get("userId") in user_ids])
+    return total, out.count
 
+async def main():
     # Cargar los userId deseados desde usuarios.tsv
-    user_ids = load_user_ids_from_tsv("../01_staff_list/output/uuids.tsv")
+    user_ids = load_user_ids_from_tsv(STAGE_DIR.parent / "01_staff_list" / "output" / "uuids.tsv")
     print(f"User IDs cargados desde archivo: {len(user_ids)}")
 
-    # Descargar todos los service point users
     print("Iniciando descarga de service point users...")
-    all_sp_users = await get_all_service_point_users(base_url, tenant, token)
+    async with Connection() as conn:
+        mode = FILTER_MODE
+        if mode == "auto":
+            mode = await choose_filter_mode(conn, user_ids)
+
+        if mode == "server":
+            filtered_sp_users = await get_service_point_users_by_user_ids(conn, user_ids)
+            print(f"Service point users después del filtro: {len(filtered_sp_users)}")
+            save_outputs(filtered_sp_users)
+            return
+
+        if streaming_enabled():
+            total, count = await stream_filtered_service_point_users(conn, user_ids)
+            print(f"Total service point users encontrados: {total}")
+            print(f"Service point users después del filtro: {count}")
+            print("Archivos guardados en la carpeta 'output'.")
+            return
+
+        # Descargar todos los service point users
+        all_sp_users = await get_all_service_point_users(conn)
     print(f"Total service point users encontrados: {len(all_sp_users)}")
 
     # Filtrar los que están en la lista de userIds
     filtered_sp_users = [spu for spu in all_sp_users if spu.get("userId") in user_ids]
     print(f"Service point users después del filtro: {len(filtered_sp_users)}")
 
-    Path("output").mkdir(exist_ok=True)
-
-    save_json(filtered_sp_users, "output/service_point_users_filtrados.json")
-    save_tsv(filtered_sp_users, "output/service_point_users_filtrados.tsv", flatten_service_point_user)
-    save_uuids(filtered_sp_users, "output/service_point_users_uuids_filtrados.tsv")
-
-    print("Archivos guardados en la carpeta 'output'.")
+    save_outputs(filtered_sp_users)
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -1,99 +1,89 @@
 import asyncio
-import httpx
-import config
-from connection import Connection
-import json
-import csv
+from fetch import fetch_pages
+from profiles import Connections, tag, tagged_schema, tagged_columns
+from schema import SERVICE_POINT_USERS
+from snapshot import StageOutput
+from sinks import streaming_enabled
+from columnar import SERVICE_POINT_USER_COLUMNS
+from store import Store
+from sync import delta_sync, INCREMENTAL_SYNC
 from pathlib import Path
 
-async def get_all_service_point_users(base_url, tenant, token):
-    service_point_users = []
-    limit = 1000
-    offset = 0
-
-    headers = {
-        "x-okapi-token": token,
-        "x-okapi-tenant": tenant
-    }
-
-    async with httpx.AsyncClient() as client:
-        while True:
-            print(f"Descargando service point users... offset: {offset}")
-            params = {
-                "limit": limit,
-                "offset": offset
-            }
-
-            try:
-                response = await client.get(
-                    f"{base_url}/service-points-users",
-                    headers=headers,
-                    params=params
-                )
-                response.raise_for_status()
-                data = response.json()
-                batch = data.get("servicePointsUsers", [])
-                service_point_users.extend(batch)
-
-                if len(batch) < limit:
-                    break
-                offset += limit
-
-            except httpx.HTTPStatusError as exc:
-                print(f"Error HTTP {exc.response.status_code}: {exc.response.text}")
-                break
-            except httpx.RequestError as exc:
-                print(f"Error de conexión: {exc}")
-                break
+# Rutas relativas a este script, para poder correrlo desde cualquier carpeta
+STAGE_DIR = Path(__file__).resolve().parent
+OUTPUT_DIR = STAGE_DIR / "output"
 
-    return service_point_users
+# Salidas de la etapa (las columnas llevan la del perfil si hay OKAPI_PROFILES)
+OUTPUT = StageOutput(OUTPUT_DIR, "service_point_users",
+                     tagged_schema(SERVICE_POINT_USERS), tagged_columns(SERVICE_POINT_USER_COLUMNS),
+                     uuids=("service_point_users_uuids.tsv", ["id", "userId"]),
+                     store=("service_point_users", "upsert_service_point_users", None))
 
-def flatten_service_point_user(spu):
-    """Convierte la estructura de un service point user en una plana para TSV"""
-    return {
-        "id": spu.get("id"),
-        "userId": spu.get("userId"),
-        "servicePoints": json.dumps(spu.get("servicePoints"), ensure_ascii=False),
-        "defaultServicePointId": spu.get("defaultServicePointId"),
-    }
-
-def save_json(data, path):
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(data, f, indent=2, ensure_ascii=False)
-
-def save_tsv(data, path, flatten_fn):
-    flat_data = [flatten_fn(d) for d in data]
-    fieldnames = flat_data[0].keys() if flat_data else []
-
-    with open(path, "w", newline="", encoding="utf-8") as f:
-        writer = csv.DictWriter(f, fieldnames=fieldnames, delimiter="\t")
-        writer.writeheader()
-        writer.writerows(flat_data)
-
-def save_uuids(data, path):
-    with open(path, "w", newline="", encoding="utf-8") as f:
-        writer = csv.writer(f, delimiter="\t")
-        writer.writerow(["id", "userId"])
-        for d in data:
-            writer.writerow([d.get("id"), d.get("userId")])
+def iter_service_point_users(conn, concurrency=None, mode=None):
+    """Páginas de service point users, a medida que llegan."""
+    return fetch_pages(conn, "/service-points-users", "servicePointsUsers",
+                       concurrency=concurrency, mode=mode, label="service point users",
+                       checkpoint="03_service_point_users")
 
-async def main():
-    base_url = config.OKAPI_URL
-    tenant = config.OKAPI_TENANT
-    conn = Connection()
-    token = await conn.get_token()
+async def get_all_service_point_users(conn, concurrency=None, mode=None):
+    service_point_users = []
 
-    print("Iniciando descarga de service point users...")
-    service_point_users = await get_all_service_point_users(base_url, tenant, token)
-    print(f"Service point users encontrados: {len(service_point_users)}")
+    async for batch in iter_service_point_users(conn, concurrency, mode):
+        service_point_users.extend(batch)
 
-    Path("output").mkdir(exist_ok=True)
+    return service_point_users
+
+async def stream_service_point_users(connections):
+    """Escribe cada página directo a NDJSON/TSV/uuids sin acumular en memoria.
+
+    Los perfiles se descargan a la vez y sus páginas van a los mismos archivos.
+    """
+    async def download(out, profile, conn):
+        async for batch in iter_service_point_users(conn):
+            out.write(tag(batch, profile))
+
+    async def download_all(out):
+        await asyncio.gather(*(download(out, profile, conn) for profile, conn in connections))
+
+    return await OUTPUT.stream(download_all)
+
+async def sync_service_point_users(conn):
+    """Trae solo las asignaciones modificadas y devuelve la copia completa actualizada."""
+    with await asyncio.to_thread(Store) as store:
+        await delta_sync(conn, store, "service_point_users", "service_point_users",
+                         "/service-points-users", "servicePointsUsers",
+                         store.upsert_service_point_users, label="service point users")
+        return store.records("service_point_users")
+
+async def fetch_service_point_users(profile, conn):
+    if INCREMENTAL_SYNC:
+        service_point_users = await sync_service_point_users(conn)
+    else:
+        service_point_users = await get_all_service_point_users(conn)
+    return tag(service_point_users, profile)
+
+async def run(connections, write_files=True):
+    """Descarga los service point users de todos los perfiles a la vez y los devuelve.
+
+    Los archivos son opcionales.
+    """
+    results = await asyncio.gather(*(fetch_service_point_users(profile, conn) for profile, conn in connections))
+    service_point_users = [spu for batch in results for spu in batch]
+    print(f"Service point users encontrados: {len(service_point_users)}")
 
-    save_json(service_point_users, "output/service_point_users.json")
-    save_tsv(service_point_users, "output/service_point_users.tsv", flatten_service_point_user)
-    save_uuids(service_point_users, "output/service_point_users_uuids.tsv")
+    if write_files:
+        await asyncio.to_thread(OUTPUT.save, service_point_users, mirror=not INCREMENTAL_SYNC)
+    return service_point_users
 
-    print("Archivos guardados en la carpeta 'output'.")
+async def main():
+    print("Iniciando descarga de service point users...")
+    async with Connections() as connections:
+        if streaming_enabled() and not INCREMENTAL_SYNC:
+            count = await stream_service_point_users(connections)
+            print(f"Service point users encontrados: {count}")
+            print("Archivos guardados en la carpeta 'output'.")
+            return
+        await run(connections)
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -1,80 +1,307 @@
 import csv
-import json
+import heapq
+import sys
+import tempfile
+import uuid
+from array import array
+from itertools import chain, groupby
 from pathlib import Path
+import config
+from sinks import StreamingOutput, TsvWriter, read_records, chunked, streaming_enabled
+from columnar import ParquetWriter, parquet_enabled, USER_COLUMNS
+from store import Store, STORE_ENABLED
+from profiles import PROFILES, TAGGED, tagged_columns, profile_of
 
-# 📁 Archivos de entrada
-USERS_TSV = "../01_staff_list/output/usuarios.tsv"
-SERVICE_POINTS_JSON = "../02_service_points_list/output/service_points.json"
-SERVICE_POINT_USERS_JSON = "../03_service_points_staff_list/output/service_point_users.json"
-OUTPUT_TSV = "usuarios_con_service_points.tsv"
+# 📁 Archivos de entrada (relativos a este script)
+STAGE_DIR = Path(__file__).resolve().parent
+USERS_TSV = STAGE_DIR.parent / "01_staff_list" / "output" / "usuarios.tsv"
+SERVICE_POINTS_JSON = STAGE_DIR.parent / "02_service_points_list" / "output" / "service_points.json"
+SERVICE_POINT_USERS_JSON = STAGE_DIR.parent / "03_service_points_staff_list" / "output" / "service_point_users.json"
+OUTPUT_TSV = STAGE_DIR / "usuarios_con_service_points.tsv"
+# Columnas del Parquet opcional: las del usuario más los nombres de service points
+PARQUET_COLUMNS = tagged_columns(USER_COLUMNS + [("servicePoints", "servicePoints", "string")])
 
-# 1. Cargar usuarios TSV
+# "memory" une con mapas en memoria; "external" ordena ambos lados en disco y
+# los une por userId; "auto" elige "external" si las relaciones superan el presupuesto
+MERGE_MODE = getattr(config, "MERGE_MODE", "auto")
+MERGE_MEMORY_BUDGET = getattr(config, "MERGE_MEMORY_BUDGET", 512 * 1024 * 1024)
+# Filas por tramo ordenado que se escribe a disco en el modo externo
+MERGE_RUN_SIZE = getattr(config, "MERGE_RUN_SIZE", 200000)
+# Carpeta de los tramos temporales (None = la del sistema)
+MERGE_TMP_DIR = getattr(config, "MERGE_TMP_DIR", None)
+
+# 1. Cargar usuarios TSV (fila por fila)
 def load_users(path):
     with open(path, newline='', encoding='utf-8') as f:
         reader = csv.DictReader(f, delimiter='\t')
-        return list(reader)
+        yield from reader
 
-# 2. Cargar service-points-users JSON
+# 2. Cargar service-points-users JSON (o NDJSON en streaming)
 def load_service_point_users(path):
-    with open(path, encoding='utf-8') as f:
-        data = json.load(f)
-        return data  # lista de objetos con userId y servicePointsIds
+    return read_records(path)  # objetos con userId y servicePointsIds
 
-# 3. Cargar service points JSON
+# 3. Cargar service points JSON (o NDJSON en streaming)
 def load_service_points(path):
-    with open(path, encoding='utf-8') as f:
-        data = json.load(f)
-        return data  # lista de service points
+    return read_records(path)  # service points
 
 # 4. Crear mapas
+def _uuid_key(value):
+    """UUID como 16 bytes (big-endian, así ordenan igual que el entero de 128 bits)."""
+    try:
+        return uuid.UUID(value).bytes
+    except (ValueError, TypeError, AttributeError):
+        return None
+
+# Con perfiles etiquetados (varios tenants) el mismo id puede estar en más de
+# uno: la unión se hace por (perfil, id), con el perfil como índice de 2 bytes
+PROFILE_INDEX = {profile.name: i for i, profile in enumerate(PROFILES)}
+KEY_SIZE = 18 if TAGGED else 16
+
+def _join_key(user_id, profile=None):
+    """Clave de unión en bytes: [índice del perfil +] UUID. None si no es válida."""
+    key = _uuid_key(user_id)
+    if key is None or not TAGGED:
+        return key
+    index = PROFILE_INDEX.get(profile)
+    return None if index is None else index.to_bytes(2, "big") + key
+
+def _join_text(user_id, profile=None):
+    """La misma clave como texto para el modo externo (ordena igual que los bytes)."""
+    key = _join_key(user_id, profile)
+    if key is None:
+        return None
+    if not TAGGED:
+        return str(uuid.UUID(bytes=key))
+    return f"{key[:2].hex()}:{uuid.UUID(bytes=key[2:])}"
+
+def _sp_key(sp_id, profile=None):
+    """Clave de un service point en el mapa de nombres (sus ids tampoco son únicos entre tenants)."""
+    return (profile, sp_id) if TAGGED else sp_id
+
+class UserServicePoints:
+    """Mapa (perfil, userId) → ids de service points guardado en arreglos compactos.
+
+    Las claves (ver `_join_key`) se guardan en un solo bloque ordenado y se
+    buscan por bisección; los service points de cada usuario son índices
+    en `offsets`/`refs` hacia la lista de ids distintos (unos cientos). No
+    hay un dict ni strings por usuario. Se usa como un dict: `get(user_id, [], profile)`.
+    """
+    __slots__ = ("keys", "offsets", "refs", "sp_ids")
+
+    def __init__(self, sp_users):
+        keys = bytearray()
+        offsets = array("I", [0])
+        refs = array("I")
+        sp_refs = {}
+        self.sp_ids = []
+        for entry in sp_users:
+            key = _join_key(entry.get("userId"), profile_of(entry))
+            if key is None:
+                continue
+            keys += key
+            for sp_id in entry.get("servicePointsIds") or []:
+                ref = sp_refs.get(sp_id)
+                if ref is None:
+                    ref = sp_refs[sp_id] = len(self.sp_ids)
+                    self.sp_ids.append(sp_id)
+                refs.append(ref)
+            offsets.append(len(refs))
+
+        # Orden estable: si un userId se repite, el último queda a la derecha y gana
+        order = sorted(range(len(offsets) - 1), key=lambda i: keys[i * KEY_SIZE:(i + 1) * KEY_SIZE])
+        sorted_keys = bytearray()
+        self.offsets = array("I", [0])
+        self.refs = array("I")
+        for i in order:
+            sorted_keys += keys[i * KEY_SIZE:(i + 1) * KEY_SIZE]
+            self.refs.extend(refs[offsets[i]:offsets[i + 1]])
+            self.offsets.append(len(self.refs))
+        self.keys = bytes(sorted_keys)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def _key(self, i):
+        return self.keys[i * KEY_SIZE:(i + 1) * KEY_SIZE]
+
+    def get(self, user_id, default=None, profile=None):
+        key = _join_key(user_id, profile)
+        if key is None:
+            return default
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if key < self._key(mid):
+                hi = mid
+            else:
+                lo = mid + 1
+        if lo == 0 or self._key(lo - 1) != key:
+            return default
+        start, end = self.offsets[lo - 1], self.offsets[lo]
+        return [self.sp_ids[ref] for ref in self.refs[start:end]]
+
 def build_user_to_sp_ids_map(sp_users):
-    user_to_sp = {}
-    for entry in sp_users:
-        user_id = entry.get("userId")
-        sp_ids = entry.get("servicePointsIds", [])
-        if user_id:
-            user_to_sp[user_id] = sp_ids
-    return user_to_sp
+    return UserServicePoints(sp_users)
 
 def build_sp_id_to_name_map(service_points):
+    # Los nombres se internan: cada nombre distinto existe una sola vez en memoria
     sp_id_to_name = {}
     for sp in service_points:
-        sp_id_to_name[sp["id"]] = sp.get("name", "")
+        sp_id_to_name[_sp_key(sp["id"], profile_of(sp))] = sys.intern(sp.get("name") or "")
     return sp_id_to_name
 
-# 5. Agregar nombres de service points a cada usuario
+# 5. Agregar nombres de service points a cada usuario (a medida que se leen)
 def add_service_points_column(users, user_to_sp_ids, sp_id_to_name):
     for user in users:
-        user_id = user["id"]
-        sp_ids = user_to_sp_ids.get(user_id, [])
-        sp_names = [sp_id_to_name.get(sp_id, "") for sp_id in sp_ids]
+        profile = profile_of(user)
+        sp_ids = user_to_sp_ids.get(user["id"], [], profile)
+        sp_names = [sp_id_to_name.get(_sp_key(sp_id, profile), "") for sp_id in sp_ids]
         user["servicePoints"] = ", ".join(sp_names)
-    return users
+        yield user
+
+# 5b. Igual que el anterior, pero consultando el espejo SQLite por índice
+def add_service_points_column_from_store(users, store):
+    for user in users:
+        user["servicePoints"] = ", ".join(store.user_service_point_names(user["id"]))
+        yield user
+
+# API en memoria: une registros ya cargados (o recién descargados)
+def merge(users, sp_users, service_points):
+    """Agrega la columna servicePoints a usuarios planos; acepta cualquier iterable."""
+    user_to_sp_ids = build_user_to_sp_ids_map(sp_users)
+    sp_id_to_name = build_sp_id_to_name_map(service_points)
+    return add_service_points_column(users, user_to_sp_ids, sp_id_to_name)
 
-# 6. Guardar nuevo TSV
-def save_users_with_service_points(users, path):
-    fieldnames = list(users[0].keys())
-    with open(path, "w", newline="", encoding="utf-8") as f:
-        writer = csv.DictWriter(f, fieldnames=fieldnames, delimiter="\t")
-        writer.writeheader()
-        writer.writerows(users)
+# 5c. Unión externa: ambos lados se ordenan por userId en tramos en disco y
+# se recorren juntos, así la memoria no depende de la cantidad de usuarios
+def _key(row):
+    return row[0], int(row[1])
+
+def _write_runs(rows, tmp_dir, prefix):
+    """Ordena `rows` ([userId, n, ...]) por tramos y los guarda como TSV."""
+    paths = []
+    for i, run in enumerate(chunked(rows, MERGE_RUN_SIZE)):
+        run.sort(key=_key)
+        path = Path(tmp_dir) / f"{prefix}_{i}.tsv"
+        with open(path, "w", newline="", encoding="utf-8") as f:
+            csv.writer(f, delimiter="\t").writerows(run)
+        paths.append(path)
+    return paths
+
+def _read_run(path):
+    with open(path, newline="", encoding="utf-8") as f:
+        yield from csv.reader(f, delimiter="\t")
+
+def _sorted(rows, tmp_dir, prefix):
+    return heapq.merge(*(_read_run(path) for path in _write_runs(rows, tmp_dir, prefix)), key=_key)
+
+def external_merge(users, sp_users, service_points):
+    """Igual que `merge`, pero sin cargar usuarios ni relaciones en memoria.
+
+    Solo los nombres de service points (unos cientos) quedan en memoria. Las
+    filas salen ordenadas por id de usuario (por perfil y id si hay varios
+    perfiles), el mismo orden en que las descarga la etapa 01.
+    """
+    sp_id_to_name = build_sp_id_to_name_map(service_points)
+    with tempfile.TemporaryDirectory(prefix="merge_", dir=MERGE_TMP_DIR) as tmp_dir:
+        relations = (
+            [key, n, ", ".join(sp_id_to_name.get(_sp_key(sp_id, profile_of(entry)), "")
+                               for sp_id in entry.get("servicePointsIds") or [])]
+            for n, entry in enumerate(sp_users) if (key := _join_text(entry.get("userId"), profile_of(entry)))
+        )
+        # Si un userId se repite gana la última relación (la de mayor n), como en `merge`
+        names_by_user = ((user_id, list(group)[-1][2])
+                         for user_id, group in groupby(_sorted(relations, tmp_dir, "sp"), key=lambda r: r[0]))
+
+        users = iter(users)
+        first = next(users, None)
+        if first is None:
+            return
+        fields = list(first.keys())
+        rows = ([_join_text(user.get("id"), profile_of(user)) or "", n, *(user.get(f) or "" for f in fields)]
+                for n, user in enumerate(chain([first], users)))
+
+        current = next(names_by_user, None)
+        for row in _sorted(rows, tmp_dir, "users"):
+            while current is not None and current[0] < row[0]:
+                current = next(names_by_user, None)
+            user = dict(zip(fields, row[2:]))
+            user["servicePoints"] = current[1] if current is not None and current[0] == row[0] else ""
+            yield user
+
+def use_external_merge(sp_users_path):
+    """Decide el modo de unión según MERGE_MODE y el tamaño de las relaciones.
+
+    En modo memoria los usuarios se leen fila por fila; lo que queda
+    residente son las relaciones, así que se compara su tamaño en disco.
+    """
+    if MERGE_MODE != "auto":
+        return MERGE_MODE == "external"
+    path = Path(sp_users_path)
+    path = path.with_suffix(".ndjson") if streaming_enabled() else path
+    return path.exists() and path.stat().st_size > MERGE_MEMORY_BUDGET
+
+# 6. Guardar nuevo TSV (y el Parquet, si está activo, en la misma pasada)
+def output_fieldnames(users_path):
+    """Columnas del TSV final: las del TSV de usuarios más servicePoints."""
+    with open(users_path, newline="", encoding="utf-8") as f:
+        header = next(csv.reader(f, delimiter="\t"), None)
+    if not header:
+        raise ValueError(f"❌ {users_path} no tiene encabezado")
+    return header + ["servicePoints"]
+
+def save_users_with_service_points(users, path, fieldnames=None):
+    """Guarda el TSV (y el Parquet opcional) final.
+
+    Sin usuarios se escriben igual, solo con el encabezado (`fieldnames`),
+    para no dejar en su lugar la salida de una corrida anterior.
+    """
+    users = iter(users)
+    first = next(users, None)
+    if first is not None:
+        fieldnames = list(first.keys())
+    elif fieldnames is None:
+        raise ValueError("❌ No hay usuarios y no se conocen las columnas de la salida")
+    writers = [TsvWriter(path, fieldnames=fieldnames)]
+    if parquet_enabled():
+        writers.append(ParquetWriter(path.with_suffix(".parquet"), PARQUET_COLUMNS))
+    with StreamingOutput(*writers) as out:
+        if first is not None:
+            for rows in chunked(chain([first], users), 1000):
+                out.write(rows)
+    if first is None:
+        print("⚠️  No hay usuarios: la salida queda solo con el encabezado")
 
 # 🧠 Ejecutar todo
 def main():
+    if STORE_ENABLED:
+        print("Enlazando usuarios con service points desde el espejo local...")
+        with Store() as store:
+            users = load_users(USERS_TSV)
+            updated_users = add_service_points_column_from_store(users, store)
+            save_users_with_service_points(updated_users, OUTPUT_TSV, output_fieldnames(USERS_TSV))
+        print(f"✅ Archivo guardado: {OUTPUT_TSV}")
+        return
+
     print("Cargando datos...")
-    users = load_users(USERS_TSV)
     sp_users = load_service_point_users(SERVICE_POINT_USERS_JSON)
     service_points = load_service_points(SERVICE_POINTS_JSON)
 
+    if use_external_merge(SERVICE_POINT_USERS_JSON):
+        print("Enlazando usuarios con service points en disco (sort-merge)...")
+        updated_users = external_merge(load_users(USERS_TSV), sp_users, service_points)
+        save_users_with_service_points(updated_users, OUTPUT_TSV, output_fieldnames(USERS_TSV))
+        print(f"✅ Archivo guardado: {OUTPUT_TSV}")
+        return
+
     print("Procesando relaciones...")
     user_to_sp_ids = build_user_to_sp_ids_map(sp_users)
     sp_id_to_name = build_sp_id_to_name_map(service_points)
 
-    print("Enlazando usuarios con service points...")
+    print("Enlazando usuarios con service points y guardando archivo final...")
+    users = load_users(USERS_TSV)
     updated_users = add_service_points_column(users, user_to_sp_ids, sp_id_to_name)
-
-    print("Guardando archivo final...")
-    save_users_with_service_points(updated_users, OUTPUT_TSV)
+    save_users_with_service_points(updated_users, OUTPUT_TSV, output_fieldnames(USERS_TSV))
 
     print(f"✅ Archivo guardado: {OUTPUT_TSV}")
 
@@ -1,77 +1,79 @@
 import asyncio
-import aiohttp
-import json
 import csv
+import jsoncodec
 from pathlib import Path
-from connection import Connection  # Ajusta esto según tu estructura
 import config
-
-# Patron group a excluir
-EXCLUDED_PATRON_GROUP_ID = "34688b28-fec2-4a8d-b108-e35532f54601"
-
-# Archivo de entrada con relaciones
-SERVICE_POINT_USERS_JSON = "../03_service_points_staff_list/output/service_point_users.json"
+from connection import Connection  # Ajusta esto según tu estructura
+from fetch import resolve_users
+from scheduler import AdaptiveScheduler
+from sinks import StreamingOutput, TsvWriter, read_ndjson, chunked, streaming_enabled
+from store import Store, STORE_ENABLED
+from refdata import ReferenceData
+from columnar import ParquetWriter, save_parquet, parquet_enabled, USER_COLUMNS
+from profiles import Connections, tag, tagged_columns, profile_of
+
+# Patron groups a excluir (se filtran en el servidor al resolver los usuarios)
+EXCLUDED_PATRON_GROUP_IDS = getattr(config, "EXCLUDED_PATRON_GROUP_IDS",
+                                    ["34688b28-fec2-4a8d-b108-e35532f54601"])
+
+# Archivo de entrada con relaciones (rutas relativas a este script)
+STAGE_DIR = Path(__file__).resolve().parent
+SERVICE_POINT_USERS_JSON = STAGE_DIR.parent / "03_service_points_staff_list" / "output" / "service_point_users.json"
+# Relaciones procesadas por tanda en modo streaming (NDJSON)
+RELATIONS_CHUNK = 1000
 # Carpeta y archivo de salida
-OUTPUT_DIR = Path("output")
+OUTPUT_DIR = STAGE_DIR / "output"
 OUTPUT_TSV = OUTPUT_DIR / "filtered_users.tsv"
-
-async def get_user_info(session, token, user_id):
-    url = f"{config.OKAPI_URL}/users/{user_id}"
-    headers = {
-        "X-Okapi-Tenant": config.OKAPI_TENANT,
-        "X-Okapi-Token": token,
-        "Content-Type": "application/json"
-    }
-    async with session.get(url, headers=headers) as resp:
-        if resp.status == 200:
-            return await resp.json()
-        else:
-            print(f"⚠️  Error al obtener usuario {user_id}: {resp.status}")
+# Columnas del Parquet opcional (se escribe junto al TSV)
+PARQUET_COLUMNS = tagged_columns(USER_COLUMNS + [("servicePointNames", "servicePointNames", "string")])
+
+async def get_service_point_name(conn, sp_id):
+    resp = await conn.request("GET", f"/service-points/{sp_id}")
+    if resp.status == 200:
+        data = resp.json()
+        return data.get("name", "")
+    else:
+        print(f"⚠️  Error al obtener service point {sp_id}: {resp.status}")
+        return None
+
+async def process_users(relations, conn, scheduler=None, refdata=None):
+    # Resolver todos los usuarios de una vez en lugar de un GET por relación
+    user_ids = [rel.get("userId") for rel in relations if rel.get("servicePointsIds")]
+    users_by_id = await resolve_users(conn, user_ids, EXCLUDED_PATRON_GROUP_IDS)
+
+    # Las consultas de service points corren en paralelo con límite adaptativo
+    scheduler = scheduler or AdaptiveScheduler(conn)
+    # Service points y grupos salen del caché de referencia; solo los ids
+    # desconocidos se consultan a Okapi
+    refdata = refdata or await ReferenceData(conn).load()
+
+    async def service_point_name(sp_id):
+        name = refdata.service_point_name(sp_id)
+        if name is not None:
+            return name
+        return await scheduler.once(("sp", sp_id), lambda: get_service_point_name(scheduler, sp_id))
+
+    async def process_relation(rel):
+        user_id = rel.get("userId")
+        service_point_ids = rel.get("servicePointsIds", [])
+
+        if not user_id or len(service_point_ids) == 0:
             return None
 
-async def get_service_point_name(session, token, sp_id):
-    url = f"{config.OKAPI_URL}/service-points/{sp_id}"
-    headers = {
-        "X-Okapi-Tenant": config.OKAPI_TENANT,
-        "X-Okapi-Token": token,
-        "Content-Type": "application/json"
-    }
-    async with session.get(url, headers=headers) as resp:
-        if resp.status == 200:
-            data = await resp.json()
-            return data.get("name", "")
-        else:
-            print(f"⚠️  Error al obtener service point {sp_id}: {resp.status}")
+        # Los usuarios excluidos no vuelven de Okapi: faltar aquí no es un error
+        user = users_by_id.get(user_id)
+        if not user:
             return None
+        user = dict(user)
 
-async def process_users(relations, conn):
-    async with aiohttp.ClientSession() as session:
-        users = []
-        service_point_cache = {}
-
-        for rel in relations:
-            user_id = rel.get("userId")
-            service_point_ids = rel.get("servicePointsIds", [])
-
-            if not user_id or len(service_point_ids) == 0:
-                continue
-
-            user = await get_user_info(session, conn, user_id)
-            if not user or user.get("patronGroup") == EXCLUDED_PATRON_GROUP_ID:
-                continue
-
-            # Obtener nombres de los puntos de servicio
-            sp_names = []
-            for sp_id in service_point_ids:
-                if sp_id not in service_point_cache:
-                    sp_name = await get_service_point_name(session, conn, sp_id)
-                    service_point_cache[sp_id] = sp_name
-                sp_names.append(service_point_cache[sp_id])
+        # Obtener nombres de los puntos de servicio (una sola consulta por id)
+        sp_names = await asyncio.gather(*(service_point_name(sp_id) for sp_id in service_point_ids))
 
-            user["servicePointNames"] = "; ".join(sp_names)
-            users.append(user)
+        user["servicePointNames"] = "; ".join(sp_names)
+        return user
 
-        return users
+    results = await asyncio.gather(*(process_relation(rel) for rel in relations))
+    return [user for user in results if user]
 
 def write_users_to_tsv(users, output_path):
     if not users:
@@ -90,24 +92,90 @@ def write_users_to_tsv(users, output_path):
 
     print(f"✅ TSV exportado: {output_path.resolve()}")
 
+    if parquet_enabled():
+        save_parquet(users, output_path.with_suffix(".parquet"), PARQUET_COLUMNS)
+
+class ProfileContext:
+    """Conexión, scheduler y caché de referencia de un perfil (tenant)."""
+
+    def __init__(self, profile, conn):
+        self.profile = profile
+        self.conn = conn
+        self.scheduler = AdaptiveScheduler(conn)
+        self.refdata = None
+
+    async def process(self, relations):
+        if self.refdata is None:
+            self.refdata = await ReferenceData(self.conn).load()
+        users = await process_users(relations, self.conn, self.scheduler, refdata=self.refdata)
+        return tag(users, self.profile)
+
+async def process_by_profile(relations, contexts):
+    """Reparte las relaciones según su perfil y las procesa en todos los tenants a la vez."""
+    groups = {}
+    for rel in relations:
+        groups.setdefault(profile_of(rel), []).append(rel)
+    unknown = [name for name in groups if name not in contexts]
+    if unknown:
+        raise ValueError(f"❌ Relaciones de perfiles que no están en OKAPI_PROFILES: {unknown}")
+    results = await asyncio.gather(*(contexts[name].process(group) for name, group in groups.items()))
+    return [user for users in results for user in users]
+
+async def stream_users(relations, connections):
+    """Procesa las relaciones (un iterable) por tandas y escribe cada tanda al TSV."""
+    contexts = {profile.name: ProfileContext(profile, conn) for profile, conn in connections}
+    writers = [TsvWriter(OUTPUT_TSV)]
+    if parquet_enabled():
+        writers.append(ParquetWriter(OUTPUT_TSV.with_suffix(".parquet"), PARQUET_COLUMNS))
+    with StreamingOutput(*writers) as out:
+        for chunk in chunked(relations, RELATIONS_CHUNK):
+            out.write(await process_by_profile(chunk, contexts))
+    if out.count:
+        print(f"✅ TSV exportado: {OUTPUT_TSV.resolve()}")
+    else:
+        print("⚠️  No hay usuarios para exportar.")
+
+async def run(connections, relations, write_files=True):
+    """Filtra las relaciones recibidas y devuelve los usuarios; el TSV es opcional.
+
+    Cada relación se resuelve en el tenant del perfil que la descargó.
+    """
+    contexts = {profile.name: ProfileContext(profile, conn) for profile, conn in connections}
+    users = await process_by_profile(relations, contexts)
+    if write_files:
+        write_users_to_tsv(users, OUTPUT_TSV)
+    return users
+
 async def main():
 
-    conn = Connection()
-    token = await conn.get_token()
+    if STORE_ENABLED:
+        # Las relaciones salen del espejo local (un solo tenant); los usuarios se piden a Okapi
+        with Store() as store:
+            relations = list(store.iter_service_point_users())
+            async with Connection() as conn:
+                users = await process_users(relations, conn)
+        write_users_to_tsv(users, OUTPUT_TSV)
+        return
+
+    if streaming_enabled():
+        path = Path(SERVICE_POINT_USERS_JSON).with_suffix(".ndjson")
+        if not path.exists():
+            print(f"❌ Archivo no encontrado: {path}")
+            return
+        async with Connections() as connections:
+            await stream_users(read_ndjson(path), connections)
+        return
 
     path = Path(SERVICE_POINT_USERS_JSON)
     if not path.exists():
         print(f"❌ Archivo no encontrado: {SERVICE_POINT_USERS_JSON}")
         return
 
-    with open(path, "r", encoding="utf-8") as f:
-        relations_data = json.load(f)
-
-    relations = relations_data if isinstance(relations_data, list) else relations_data.get("servicePointUsers", [])
-
-    users = await process_users(relations, token)
+    # El arreglo se recorre por tandas mientras se lee, sin cargarlo completo
+    relations = jsoncodec.iter_array(path, "servicePointUsers")
 
-    write_users_to_tsv(users, OUTPUT_TSV)
+    async with Connections() as connections:
+        await stream_users(relations, connections)
 
 if __name__ == "__main__":
     asyncio.run(main())
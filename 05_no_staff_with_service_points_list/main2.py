@@ -1,109 +1,101 @@
 import asyncio
-import aiohttp
-import json
 import csv
+import jsoncodec
 from pathlib import Path
-from connection import Connection  # Ajusta esto según tu estructura
 import config
-
-# Patron group a excluir
-EXCLUDED_PATRON_GROUP_ID = "34688b28-fec2-4a8d-b108-e35532f54601"
-
-# Archivo de entrada con relaciones
-SERVICE_POINT_USERS_JSON = "../03_service_points_staff_list/output/service_point_users.json"
+from connection import Connection  # Ajusta esto según tu estructura
+from fetch import resolve_users
+from scheduler import AdaptiveScheduler
+from sinks import StreamingOutput, TsvWriter, read_ndjson, chunked, streaming_enabled
+from store import Store, STORE_ENABLED
+from refdata import ReferenceData
+from columnar import ParquetWriter, save_parquet, parquet_enabled, USER_COLUMNS
+
+# Patron groups a excluir (se filtran en el servidor al resolver los usuarios)
+EXCLUDED_PATRON_GROUP_IDS = getattr(config, "EXCLUDED_PATRON_GROUP_IDS",
+                                    ["34688b28-fec2-4a8d-b108-e35532f54601"])
+
+# Archivo de entrada con relaciones (rutas relativas a este script)
+STAGE_DIR = Path(__file__).resolve().parent
+SERVICE_POINT_USERS_JSON = STAGE_DIR.parent / "03_service_points_staff_list" / "output" / "service_point_users.json"
+# Relaciones procesadas por tanda en modo streaming (NDJSON)
+RELATIONS_CHUNK = 1000
 # Carpeta y archivo de salida
-OUTPUT_DIR = Path("output")
+OUTPUT_DIR = STAGE_DIR / "output"
 OUTPUT_TSV = OUTPUT_DIR / "filtered_users_2.tsv"
-
-async def get_user_info(session, token, user_id):
-    url = f"{config.OKAPI_URL}/users/{user_id}"
-    headers = {
-        "X-Okapi-Tenant": config.OKAPI_TENANT,
-        "X-Okapi-Token": token,
-        "Content-Type": "application/json"
-    }
-    async with session.get(url, headers=headers) as resp:
-        if resp.status == 200:
-            return await resp.json()
-        else:
-            print(f"⚠️  Error al obtener usuario {user_id}: {resp.status}")
-            return None
-
-async def get_service_point_name(session, token, sp_id):
-    url = f"{config.OKAPI_URL}/service-points/{sp_id}"
-    headers = {
-        "X-Okapi-Tenant": config.OKAPI_TENANT,
-        "X-Okapi-Token": token,
-        "Content-Type": "application/json"
-    }
-    async with session.get(url, headers=headers) as resp:
-        if resp.status == 200:
-            data = await resp.json()
-            return data.get("name", "")
-        else:
-            print(f"⚠️  Error al obtener service point {sp_id}: {resp.status}")
-            return None
-
-
-async def get_patron_group_name(session, token, group_id, cache):
-  if group_id in cache:
-    return cache[group_id]
-
-  url = f"{config.OKAPI_URL}/groups/{group_id}"
-  headers = {
-    "X-Okapi-Tenant": config.OKAPI_TENANT,
-    "X-Okapi-Token": token,
-    "Content-Type": "application/json"
-  }
-
-  async with session.get(url, headers=headers) as resp:
+# Columnas del Parquet opcional (se escribe junto al TSV)
+PARQUET_COLUMNS = USER_COLUMNS + [
+    ("patronGroupName", "patronGroupName", "string"),
+    ("servicePointNames", "servicePointNames", "string"),
+]
+
+async def get_service_point_name(conn, sp_id):
+    resp = await conn.request("GET", f"/service-points/{sp_id}")
     if resp.status == 200:
-      data = await resp.json()
-      group_name = data.get("group", "")
-      cache[group_id] = group_name
-      return group_name
+        data = resp.json()
+        return data.get("name", "")
     else:
-      print(f"⚠️  Error al obtener patronGroup {group_id}: {resp.status}")
-      return ""
+        print(f"⚠️  Error al obtener service point {sp_id}: {resp.status}")
+        return None
 
 
-async def process_users(relations, conn):
-  async with aiohttp.ClientSession() as session:
-    users = []
-    service_point_cache = {}
-    patron_group_cache = {}
+async def get_patron_group_name(conn, group_id):
+  resp = await conn.request("GET", f"/groups/{group_id}")
+  if resp.status == 200:
+    data = resp.json()
+    return data.get("group", "")
+  else:
+    print(f"⚠️  Error al obtener patronGroup {group_id}: {resp.status}")
+    return ""
 
-    for rel in relations:
-      user_id = rel.get("userId")
-      service_point_ids = rel.get("servicePointsIds", [])
 
-      if not user_id or not service_point_ids:
-        continue
+async def process_users(relations, conn, scheduler=None, refdata=None):
+  # 🔹 Resolver todos los usuarios de una vez en lugar de un GET por relación
+  user_ids = [rel.get("userId") for rel in relations if rel.get("servicePointsIds")]
+  users_by_id = await resolve_users(conn, user_ids, EXCLUDED_PATRON_GROUP_IDS)
 
-      user = await get_user_info(session, conn, user_id)
-      if not user:
-        continue
+  # 🔹 Consultas de grupos y service points en paralelo con límite adaptativo
+  scheduler = scheduler or AdaptiveScheduler(conn)
+  # Service points y grupos salen del caché de referencia; solo los ids
+  # desconocidos se consultan a Okapi
+  refdata = refdata or await ReferenceData(conn).load()
 
-      patron_group_id = user.get("patronGroup")
-      if patron_group_id == EXCLUDED_PATRON_GROUP_ID:
-        continue
+  async def service_point_name(sp_id):
+    name = refdata.service_point_name(sp_id)
+    if name is not None:
+      return name
+    return await scheduler.once(("sp", sp_id), lambda: get_service_point_name(scheduler, sp_id))
 
-      # 🔹 Obtener nombre del patronGroup
-      patron_group_name = await get_patron_group_name(session, conn, patron_group_id, patron_group_cache)
-      user["patronGroupName"] = patron_group_name
+  async def process_relation(rel):
+    user_id = rel.get("userId")
+    service_point_ids = rel.get("servicePointsIds", [])
 
-      # 🔹 Obtener nombres de service points
-      sp_names = []
-      for sp_id in service_point_ids:
-        if sp_id not in service_point_cache:
-          sp_name = await get_service_point_name(session, conn, sp_id)
-          service_point_cache[sp_id] = sp_name
-        sp_names.append(service_point_cache[sp_id])
+    if not user_id or not service_point_ids:
+      return None
 
-      user["servicePointNames"] = "; ".join(sp_names)
-      users.append(user)
+    # Los usuarios excluidos no vuelven de Okapi: faltar aquí no es un error
+    user = users_by_id.get(user_id)
+    if not user:
+      return None
+    user = dict(user)
 
-    return users
+    patron_group_id = user.get("patronGroup")
+
+    # 🔹 Obtener nombre del patronGroup (del caché, o una sola consulta por grupo)
+    patron_group_name = refdata.patron_group_name(patron_group_id)
+    if patron_group_name is None:
+      patron_group_name = await scheduler.once(
+        ("group", patron_group_id), lambda: get_patron_group_name(scheduler, patron_group_id))
+    user["patronGroupName"] = patron_group_name
+
+    # 🔹 Obtener nombres de service points (una sola consulta por id)
+    sp_names = await asyncio.gather(*(service_point_name(sp_id) for sp_id in service_point_ids))
+
+    user["servicePointNames"] = "; ".join(sp_names)
+    return user
+
+  results = await asyncio.gather(*(process_relation(rel) for rel in relations))
+  return [user for user in results if user]
 
 def write_users_to_tsv(users, output_path):
     if not users:
@@ -122,24 +114,61 @@ def write_users_to_tsv(users, output_path):
 
     print(f"✅ TSV exportado: {output_path.resolve()}")
 
+    if parquet_enabled():
+        save_parquet(users, output_path.with_suffix(".parquet"), PARQUET_COLUMNS)
+
+async def stream_users(relations, conn):
+    """Procesa las relaciones (un iterable) por tandas y escribe cada tanda al TSV."""
+    scheduler = AdaptiveScheduler(conn)
+    refdata = await ReferenceData(conn).load()
+    writers = [TsvWriter(OUTPUT_TSV)]
+    if parquet_enabled():
+        writers.append(ParquetWriter(OUTPUT_TSV.with_suffix(".parquet"), PARQUET_COLUMNS))
+    with StreamingOutput(*writers) as out:
+        for chunk in chunked(relations, RELATIONS_CHUNK):
+            out.write(await process_users(chunk, conn, scheduler, refdata=refdata))
+    if out.count:
+        print(f"✅ TSV exportado: {OUTPUT_TSV.resolve()}")
+    else:
+        print("⚠️  No hay usuarios para exportar.")
+
+async def run(conn, relations, write_files=True):
+    """Filtra las relaciones recibidas y devuelve los usuarios; el TSV es opcional."""
+    users = await process_users(relations, conn)
+    if write_files:
+        write_users_to_tsv(users, OUTPUT_TSV)
+    return users
+
 async def main():
 
-    conn = Connection()
-    token = await conn.get_token()
+    if STORE_ENABLED:
+        # Las relaciones salen del espejo local; los usuarios se piden a Okapi
+        with Store() as store:
+            relations = list(store.iter_service_point_users())
+            async with Connection() as conn:
+                users = await process_users(relations, conn)
+        write_users_to_tsv(users, OUTPUT_TSV)
+        return
+
+    if streaming_enabled():
+        path = Path(SERVICE_POINT_USERS_JSON).with_suffix(".ndjson")
+        if not path.exists():
+            print(f"❌ Archivo no encontrado: {path}")
+            return
+        async with Connection() as conn:
+            await stream_users(read_ndjson(path), conn)
+        return
 
     path = Path(SERVICE_POINT_USERS_JSON)
     if not path.exists():
         print(f"❌ Archivo no encontrado: {SERVICE_POINT_USERS_JSON}")
         return
 
-    with open(path, "r", encoding="utf-8") as f:
-        relations_data = json.load(f)
-
-    relations = relations_data if isinstance(relations_data, list) else relations_data.get("servicePointUsers", [])
-
-    users = await process_users(relations, token)
+    # El arreglo se recorre por tandas mientras se lee, sin cargarlo completo
+    relations = jsoncodec.iter_array(path, "servicePointUsers")
 
-    write_users_to_tsv(users, OUTPUT_TSV)
+    async with Connection() as conn:
+        await stream_users(relations, conn)
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -4,4 +4,110 @@
 OKAPI_URL = "https:okapi_url_example.com"
 OKAPI_TENANT = "tenant_example"
 USERNAME = "username_example"
-PASSWORD = "password_example"
\ No newline at end of file
+PASSWORD = "password_example"
+# Opcional: pool de conexiones HTTP compartido por todas las etapas
+OKAPI_POOL_LIMIT = 100          # conexiones simultáneas en total
+OKAPI_POOL_LIMIT_PER_HOST = 50  # conexiones simultáneas hacia Okapi
+OKAPI_DNS_CACHE_TTL = 300       # segundos que se cachea la resolución DNS
+OKAPI_KEEPALIVE_TIMEOUT = 30    # segundos que se mantiene viva una conexión ociosa
+OKAPI_REQUEST_TIMEOUT = 120     # timeout total por petición, en segundos
+
+# Opcional: caché del token compartido entre etapas/procesos
+OKAPI_TOKEN_CACHE_DIR = ".okapi_cache"  # carpeta del caché en disco
+OKAPI_TOKEN_TTL = 600                   # vida asumida si Okapi no informa expiración
+OKAPI_TOKEN_REFRESH_MARGIN = 60         # renovar el token N segundos antes de expirar
+
+# Opcional: descarga paginada
+OKAPI_PAGE_SIZE = 1000                      # registros máximos por página
+OKAPI_MIN_PAGE_SIZE = 100                   # mínimo al ajustar el tamaño de página
+OKAPI_TARGET_PAGE_BYTES = 4 * 1024 * 1024   # tamaño objetivo de cada respuesta
+OKAPI_FETCH_CONCURRENCY = 4                 # páginas descargadas en paralelo
+OKAPI_PAGING_MODE = "offset"                # "offset" (paralelo) o "keyset" (cursor por id)
+OKAPI_MAX_QUERY_LENGTH = 4000               # largo máximo del CQL en búsquedas por lotes de ids
+
+# Opcional: scheduler adaptativo (AIMD) de la etapa 05
+OKAPI_SCHEDULER_INITIAL = 8             # consultas simultáneas al arrancar
+OKAPI_SCHEDULER_MIN = 1
+OKAPI_SCHEDULER_MAX = 64
+OKAPI_SCHEDULER_LATENCY_TOLERANCE = 3.0 # latencia / latencia base que se toma como saturación
+
+# Opcional: formato de salida de las etapas
+OUTPUT_MODE = "json"    # "json" (listas completas) o "ndjson" (cada página se escribe al llegar)
+
+# Opcional: espejo local SQLite (etapas 01-03 lo llenan; 04 lo consulta y 05 lee de él las relaciones)
+STORE_ENABLED = False
+STORE_PATH = "output/okapi_mirror.sqlite"   # relativo a la raíz del repositorio
+STORE_BUSY_TIMEOUT = 30   # segundos de espera si otra etapa está escribiendo el espejo
+
+# Opcional: sincronización incremental (requiere el espejo local)
+INCREMENTAL_SYNC = False
+SYNC_RECONCILE_LEAF_SIZE = 1000   # tamaño de rango de ids en el que se comparan ids
+
+# Opcional: caché en disco de service points y patron groups
+REFDATA_CACHE_DIR = ".okapi_cache"   # relativo a la raíz del repositorio
+REFDATA_TTL = 24 * 3600              # segundos antes de revalidar contra Okapi
+
+# Opcional: pipeline (python main.py)
+PIPELINE_STATE = ".okapi_cache/pipeline_state.json"
+PIPELINE_SOURCE_MAX_AGE = 0   # segundos de vigencia de las etapas que descargan (0 = siempre se corren)
+
+# Opcional: filtro de service point users por userId (02/main2.py)
+SP_USERS_FILTER_MODE = "auto"               # "auto", "server" (CQL userId==...) o "scan"
+SP_USERS_SERVER_FILTER_MAX_FRACTION = 0.3   # en "auto", filtrar en Okapi si ids/total <= esto
+
+# Opcional: patron groups excluidos en la etapa 05 (se filtran en el query CQL)
+EXCLUDED_PATRON_GROUP_IDS = ["34688b28-fec2-4a8d-b108-e35532f54601"]
+
+# Opcional: copia columnar en Parquet de cada salida (requiere pyarrow)
+PARQUET_ENABLED = False
+PARQUET_COMPRESSION = "zstd"      # "zstd", "snappy", "gzip" o None
+PARQUET_ROW_GROUP_SIZE = 50000    # registros por row group
+
+# Opcional: librería JSON ("auto" usa orjson si está instalado, "json" la estándar)
+JSON_CODEC = "auto"
+
+# Opcional: modo de unión de la etapa 04
+MERGE_MODE = "auto"                       # "auto", "memory" o "external" (sort-merge en disco)
+MERGE_MEMORY_BUDGET = 512 * 1024 * 1024   # en "auto", pasar a "external" si las relaciones pesan más
+MERGE_RUN_SIZE = 200000                   # filas por tramo ordenado en disco
+MERGE_TMP_DIR = None                      # carpeta de los tramos (None = temporal del sistema)
+
+# Opcional: métricas de las llamadas a Okapi
+METRICS_ENABLED = True
+METRICS_REPORT = "output/metrics.json"   # reporte JSON de la corrida (None = no se escribe)
+METRICS_PROMETHEUS_FILE = None           # p. ej. "/var/lib/node_exporter/textfile/okapi.prom"
+METRICS_MERGE_WINDOW = 60                # segundos: procesos más cercanos se suman al mismo reporte
+FETCH_PAGE_PRINTS = False                # imprimir cada página descargada
+
+# Opcional: reintentos ante fallas transitorias (conexión, 429, 500, 502, 503, 504)
+OKAPI_RETRY_ATTEMPTS = 5        # reintentos por petición (0 = ninguno)
+OKAPI_RETRY_BASE_DELAY = 0.5    # segundos; la espera máxima se duplica en cada intento (con jitter)
+OKAPI_RETRY_MAX_DELAY = 30      # tope de la espera entre intentos
+OKAPI_RETRY_MAX_AFTER = 120     # si Retry-After pide esperar más, no se reintenta
+
+# Opcional: checkpoints de las descargas paginadas (para retomar una corrida cortada)
+CHECKPOINTS_ENABLED = True
+CHECKPOINT_DIR = ".okapi_cache/checkpoints"
+CHECKPOINT_MAX_AGE = 24 * 3600   # segundos; un checkpoint más viejo se descarta
+
+# Opcional: transporte HTTP
+OKAPI_COMPRESSION = True   # pedir respuestas comprimidas (gzip; brotli y zstd si están instalados)
+OKAPI_HTTP2 = False        # HTTP/2 multiplexado si el gateway lo ofrece (requiere `pip install httpx[http2]`)
+
+# Opcional: varios tenants y patron groups en una misma corrida
+STAFF_PATRON_GROUP_IDS = ["34688b28-fec2-4a8d-b108-e35532f54601"]   # patron groups de personal (etapa 01)
+# Con perfiles, cada tenant usa su propia conexión y token y los registros llevan
+# la columna "profile". url, username, password y patron_groups son opcionales
+# (por defecto, los de arriba). El espejo SQLite y la sincronización incremental
+# solo admiten un perfil.
+OKAPI_PROFILES = []
+# OKAPI_PROFILES = [
+#     {"name": "toluca", "tenant": "uaemex_toluca", "username": "...", "password": "..."},
+#     {"name": "texcoco", "tenant": "uaemex_texcoco", "url": "https://okapi-texcoco.example.com",
+#      "patron_groups": ["<uuid del grupo de personal>"]},
+# ]
+
+# Opcional: codificación en paralelo de las salidas (JSON/NDJSON, TSV y uuids)
+OUTPUT_WORKERS = None                 # procesos (None = uno por núcleo; 1 = sin procesos)
+OUTPUT_PARALLEL_MIN_RECORDS = 50000   # por debajo de esto se codifica en el mismo proceso
+OUTPUT_SHARD_SIZE = 10000             # registros por tanda enviada a cada proceso
@@ -0,0 +1,187 @@
+import bisect
+import re
+from functools import lru_cache
+
+# Subconjunto de CQL que usan las etapas:
+#   cql.allRecords=1, campo=="v", campo==("a" or "b"), id > "v",
+#   metadata.updatedDate >= "v", and / or / not, paréntesis y sortBy
+TOKEN = re.compile(r'\s*(\(|\)|==|>=|<=|<>|=|>|<|"(?:[^"\\]|\\.)*"|[^\s()=<>"]+)')
+RELATIONS = {"==", "=", ">", ">=", "<", "<=", "<>"}
+BOOLEANS = {"and", "or", "not"}
+
+
+def tokenize(query):
+    tokens, pos = [], 0
+    query = query.strip()
+    while pos < len(query):
+        match = TOKEN.match(query, pos)
+        if not match:
+            raise ValueError(f"CQL inválido cerca de: {query[pos:pos + 20]!r}")
+        tokens.append(match.group(1))
+        pos = match.end()
+    return tokens
+
+
+def _value(token):
+    if token.startswith('"'):
+        return token[1:-1].replace('\\"', '"')
+    return token
+
+
+def parse(query):
+    """Convierte el CQL en un árbol de tuplas (hashable, para cachear resultados)."""
+    tokens = tokenize(query or "cql.allRecords=1")
+    lower = [t.lower() for t in tokens]
+    if "sortby" in lower:
+        tokens = tokens[:lower.index("sortby")]
+    pos = 0
+
+    def peek():
+        return tokens[pos] if pos < len(tokens) else None
+
+    def take():
+        nonlocal pos
+        pos += 1
+        return tokens[pos - 1]
+
+    def expression():
+        node = term()
+        while peek() is not None and peek().lower() in BOOLEANS:
+            op = take().lower()
+            node = (op, node, term())
+        return node
+
+    def term():
+        if peek() == "(":
+            take()
+            node = expression()
+            take()  # ")"
+            return node
+        field = take()
+        relation = take()
+        if relation not in RELATIONS:
+            raise ValueError(f"Relación CQL no soportada: {relation}")
+        if peek() == "(":
+            take()
+            values = [_value(take())]
+            while peek() is not None and peek().lower() == "or":
+                take()
+                values.append(_value(take()))
+            take()  # ")"
+        else:
+            values = [_value(take())]
+        if field == "cql.allRecords":
+            return ("all",)
+        return ("rel", field, relation, tuple(values))
+
+    return expression()
+
+
+def matches(node, fields):
+    kind = node[0]
+    if kind == "all":
+        return True
+    if kind == "and":
+        return matches(node[1], fields) and matches(node[2], fields)
+    if kind == "or":
+        return matches(node[1], fields) or matches(node[2], fields)
+    if kind == "not":
+        return matches(node[1], fields) and not matches(node[2], fields)
+
+    _, field, relation, values = node
+    value = fields.get(field)
+    if value is None:
+        return False
+    if relation in ("==", "="):
+        return value in values
+    if relation == "<>":
+        return value not in values
+    target = values[0]
+    return {
+        ">": value > target,
+        ">=": value >= target,
+        "<": value < target,
+        "<=": value <= target,
+    }[relation]
+
+
+def _row_id(row):
+    return row[0]["id"]
+
+
+def _is_id_range(node):
+    return node[0] == "rel" and node[1] == "id" and node[2] in (">", ">=", "<", "<=")
+
+
+class Collection:
+    """Registros de un endpoint, ordenados por id, con índices por campo.
+
+    Cada registro es una tupla (campos consultables, JSON ya codificado).
+    Las búsquedas por igualdad usan índices y los rangos de id (el cursor
+    del modo keyset) usan bisección, para que un tenant de 1M de usuarios
+    responda cada página sin recorrer toda la colección.
+    """
+
+    def __init__(self, key, rows, indexed=("id",)):
+        self.key = key
+        self.rows = sorted(rows, key=_row_id)
+        self.indexes = {}
+        for field in indexed:
+            index = {}
+            for row in self.rows:
+                value = row[0].get(field)
+                if value is not None:
+                    index.setdefault(value, []).append(row)
+            self.indexes[field] = index
+        self.by_id = {row[0]["id"]: row for row in self.rows}
+        self.select = lru_cache(maxsize=32)(self._select)
+
+    @staticmethod
+    def _id_range(rows, relation, target):
+        """Límites [inicio, fin) de `rows` (ordenadas por id) que cumplen `id <rel> target`."""
+        if relation == ">":
+            return bisect.bisect_right(rows, target, key=_row_id), len(rows)
+        if relation == ">=":
+            return bisect.bisect_left(rows, target, key=_row_id), len(rows)
+        if relation == "<":
+            return 0, bisect.bisect_left(rows, target, key=_row_id)
+        return 0, bisect.bisect_right(rows, target, key=_row_id)
+
+    def _select(self, node):
+        kind = node[0]
+        if kind == "all":
+            return self.rows
+        if kind == "rel":
+            _, field, relation, values = node
+            if relation in ("==", "=") and field in self.indexes:
+                found = [row for value in values for row in self.indexes[field].get(value, [])]
+                return sorted(found, key=_row_id) if len(values) > 1 else found
+            if _is_id_range(node):
+                start, end = self._id_range(self.rows, relation, values[0])
+                return self.rows[start:end]
+        if kind == "and":
+            left = self.select(node[1])
+            if _is_id_range(node[2]):
+                start, end = self._id_range(left, node[2][2], node[2][3][0])
+                return left[start:end]
+            return [row for row in left if matches(node[2], row[0])]
+        if kind == "not":
+            return [row for row in self.select(node[1]) if not matches(node[2], row[0])]
+        return [row for row in self.rows if matches(node, row[0])]
+
+    def page(self, cql, offset=0, limit=10):
+        """Registros de la página pedida y el total que cumple el CQL.
+
+        El cursor del modo keyset (`(...) and id > "x"`) cambia en cada
+        página: se resuelve por bisección sobre el resultado ya cacheado de
+        la parte izquierda, sin copiarlo ni cachearlo.
+        """
+        node = parse(cql)
+        if node[0] == "and" and _is_id_range(node[2]):
+            rows = self.select(node[1])
+            start, end = self._id_range(rows, node[2][2], node[2][3][0])
+        else:
+            rows = self.select(node)
+            start, end = 0, len(rows)
+        first = min(start + offset, end)
+        return rows[first:min(first + limit, end)], end - start
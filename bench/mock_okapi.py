@@ -0,0 +1,211 @@
+"""Okapi falso para benchmarks: sirve un tenant sintético por HTTP.
+
+Uso: python bench/mock_okapi.py --users 10000 --port 9130 [--latency-ms 20]
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+import uuid
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from aiohttp import web
+from cql import Collection
+from synthetic import generate_tenant
+
+TENANT = "bench"
+USERNAME = "bench_admin"
+PASSWORD = "bench"
+TOKEN_TTL = 600
+
+# endpoint → (clave de la colección, campos consultables por CQL, campos con índice)
+ENDPOINTS = {
+    "/users": ("users", ("id", "patronGroup", "metadata.updatedDate"), ("id", "patronGroup")),
+    "/groups": ("usergroups", ("id", "metadata.updatedDate"), ("id",)),
+    "/service-points": ("servicepoints", ("id", "metadata.updatedDate"), ("id",)),
+    "/service-points-users": ("servicePointsUsers", ("id", "userId", "metadata.updatedDate"), ("id", "userId")),
+}
+
+
+def _fields(record, names):
+    fields = {}
+    for name in names:
+        value = record
+        for part in name.split("."):
+            value = value.get(part) if isinstance(value, dict) else None
+        fields[name] = value
+    return fields
+
+
+def build_collections(tenant):
+    collections = {}
+    for path, (key, fields, indexed) in ENDPOINTS.items():
+        rows = [(_fields(r, fields), json.dumps(r, ensure_ascii=False).encode("utf-8")) for r in tenant[key]]
+        collections[path] = Collection(key, rows, indexed)
+    return collections
+
+
+class MockOkapi:
+    """Estado del servidor: colecciones, tokens emitidos y contadores."""
+
+    def __init__(self, collections, latency_ms=0, jitter_ms=0, error_rate=0.0,
+                 max_limit=None, estimate_totals=False, compress=False, seed=1):
+        self.collections = collections
+        self.latency = latency_ms / 1000
+        self.jitter = jitter_ms / 1000
+        self.error_rate = error_rate
+        self.max_limit = max_limit
+        self.estimate_totals = estimate_totals
+        self.compress = compress
+        self.random = random.Random(seed)
+        self.tokens = set()
+        self.stats = defaultdict(lambda: {"requests": 0, "errors": 0, "bytes": 0, "records": 0})
+
+    def _count(self, path, body=b"", records=0, error=False):
+        entry = self.stats[path]
+        entry["requests"] += 1
+        entry["bytes"] += len(body)
+        entry["records"] += records
+        entry["errors"] += int(error)
+
+    def _authorized(self, request):
+        token = request.headers.get("x-okapi-token") or request.cookies.get("folioAccessToken")
+        return token in self.tokens
+
+    async def _delay(self):
+        if self.latency or self.jitter:
+            await asyncio.sleep(self.latency + self.random.uniform(0, self.jitter))
+
+    def _new_token(self):
+        token = uuid.uuid4().hex
+        self.tokens.add(token)
+        return token
+
+    async def login_with_expiry(self, request):
+        payload = await request.json()
+        if payload.get("username") != USERNAME or payload.get("password") != PASSWORD:
+            return web.Response(status=422, text="Credenciales inválidas")
+        expires = datetime.now(timezone.utc) + timedelta(seconds=TOKEN_TTL)
+        response = web.json_response({"accessTokenExpiration": expires.isoformat()}, status=201)
+        response.set_cookie("folioAccessToken", self._new_token())
+        return response
+
+    async def login(self, request):
+        payload = await request.json()
+        if payload.get("username") != USERNAME or payload.get("password") != PASSWORD:
+            return web.Response(status=422, text="Credenciales inválidas")
+        return web.json_response(payload, status=201, headers={"x-okapi-token": self._new_token()})
+
+    def _injected_error(self, path):
+        if self.error_rate and self.random.random() < self.error_rate:
+            self._count(path, error=True)
+            if self.random.random() < 0.5:
+                return web.Response(status=429, text="Too many requests", headers={"Retry-After": "1"})
+            return web.Response(status=500, text="Error inyectado")
+        return None
+
+    def _respond(self, body):
+        response = web.Response(body=body, content_type="application/json")
+        if self.compress:
+            # aiohttp elige la codificación según el Accept-Encoding del cliente
+            response.enable_compression()
+        return response
+
+    def _total(self, total):
+        # FOLIO estima totalRecords en resultados grandes; se imita con 2 cifras significativas
+        if not self.estimate_totals or total < 1000:
+            return total
+        scale = 10 ** (len(str(total)) - 2)
+        return round(total / scale) * scale
+
+    async def collection(self, request):
+        path = "/" + request.match_info["endpoint"]
+        if path not in self.collections:
+            return web.Response(status=404, text="No encontrado")
+        if not self._authorized(request):
+            return web.Response(status=401, text="Token inválido")
+        await self._delay()
+        error = self._injected_error(path)
+        if error is not None:
+            return error
+
+        collection = self.collections[path]
+        try:
+            offset = int(request.query.get("offset", 0))
+            limit = int(request.query.get("limit", 10))
+            page, total = collection.page(request.query.get("query"), offset, limit if limit >= 0 else 0)
+        except (ValueError, IndexError) as exc:
+            return web.Response(status=400, text=str(exc))
+        if self.max_limit is not None:
+            page = page[:self.max_limit]
+
+        body = b"".join([
+            b'{"', collection.key.encode(), b'":[',
+            b",".join(raw for _, raw in page),
+            b'],"totalRecords":', str(self._total(total)).encode(), b"}",
+        ])
+        self._count(path, body, len(page))
+        return self._respond(body)
+
+    async def record(self, request):
+        path = "/" + request.match_info["endpoint"]
+        if path not in self.collections:
+            return web.Response(status=404, text="No encontrado")
+        if not self._authorized(request):
+            return web.Response(status=401, text="Token inválido")
+        await self._delay()
+        error = self._injected_error(path + "/{id}")
+        if error is not None:
+            return error
+        row = self.collections[path].by_id.get(request.match_info["id"])
+        if row is None:
+            self._count(path + "/{id}")
+            return web.Response(status=404, text="No encontrado")
+        self._count(path + "/{id}", row[1], 1)
+        return self._respond(row[1])
+
+    async def get_stats(self, request):
+        return web.json_response(self.stats)
+
+
+def create_app(server):
+    app = web.Application()
+    app.router.add_post("/authn/login-with-expiry", server.login_with_expiry)
+    app.router.add_post("/authn/login", server.login)
+    app.router.add_get("/_bench/stats", server.get_stats)
+    app.router.add_get("/{endpoint:users|groups|service-points|service-points-users}", server.collection)
+    app.router.add_get("/{endpoint:users|groups|service-points}/{id}", server.record)
+    return app
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Okapi falso con un tenant sintético.")
+    parser.add_argument("--users", type=int, default=1000, help="usuarios del tenant")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9130)
+    parser.add_argument("--latency-ms", type=float, default=0, help="demora fija por petición")
+    parser.add_argument("--jitter-ms", type=float, default=0, help="demora aleatoria adicional (0..n)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fracción de respuestas 429/500")
+    parser.add_argument("--max-limit", type=int, default=None,
+                        help="tope de registros por página, aunque se pidan más")
+    parser.add_argument("--estimate-totals", action="store_true",
+                        help="totalRecords aproximado, como FOLIO en resultados grandes")
+    parser.add_argument("--compress", action="store_true",
+                        help="comprime las respuestas si el cliente lo acepta")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    started = time.perf_counter()
+    collections = build_collections(generate_tenant(args.users, seed=args.seed))
+    server = MockOkapi(collections, args.latency_ms, args.jitter_ms, args.error_rate,
+                       args.max_limit, args.estimate_totals, args.compress, args.seed)
+    print(f"Tenant de {args.users} usuarios generado en {time.perf_counter() - started:.1f}s", flush=True)
+    web.run_app(create_app(server), host=args.host, port=args.port, print=lambda _: print("listo", flush=True))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+"""Benchmark de las etapas 01-05 contra un Okapi falso con tenants sintéticos.
+
+Uso:
+    python bench/run.py --users 1000 10000 100000 [--latency-ms 20] [--json reporte.json]
+
+Por cada tamaño de tenant levanta `mock_okapi.py`, copia el repositorio a una
+carpeta temporal con un config.py que apunta al servidor falso (así no se
+tocan las salidas ni el config reales) y corre cada etapa en un proceso
+aparte con `main.py <etapa> --force`. Reporta tiempo, registros por segundo,
+peticiones, bytes y RSS máximo de cada etapa.
+"""
+import argparse
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from pathlib import Path
+
+BENCH_DIR = Path(__file__).resolve().parent
+ROOT_DIR = BENCH_DIR.parent
+STAGES = ["01_staff_list", "02_service_points_list", "03_service_points_staff_list",
+          "04_merged_list", "05_no_staff_with_service_points_list"]
+# Archivos que no se copian a la carpeta del benchmark
+IGNORE = shutil.ignore_patterns(".git", "bench", "output", ".okapi_cache", "__pycache__",
+                                "config.py", "*.tsv", "*.parquet", "*.sqlite")
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def get_stats(port):
+    with urllib.request.urlopen(f"http://127.0.0.1:{port}/_bench/stats", timeout=10) as response:
+        return json.load(response)
+
+
+def totals(stats):
+    return {name: sum(entry[name] for entry in stats.values())
+            for name in ("requests", "errors", "bytes", "records")}
+
+
+def start_server(args, users, port):
+    command = [sys.executable, str(BENCH_DIR / "mock_okapi.py"), "--users", str(users),
+               "--port", str(port), "--latency-ms", str(args.latency_ms),
+               "--jitter-ms", str(args.jitter_ms), "--error-rate", str(args.error_rate)]
+    if args.max_limit:
+        command += ["--max-limit", str(args.max_limit)]
+    if args.estimate_totals:
+        command.append("--estimate-totals")
+    if args.compress:
+        command.append("--compress")
+    server = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    for line in server.stdout:
+        print(f"   [okapi falso] {line.rstrip()}")
+        if line.strip() == "listo":
+            return server
+    raise RuntimeError("❌ El Okapi falso terminó antes de quedar listo")
+
+
+def prepare_workdir(port, args):
+    workdir = Path(tempfile.mkdtemp(prefix="okapi_bench_"))
+    shutil.copytree(ROOT_DIR, workdir, ignore=IGNORE, dirs_exist_ok=True)
+    config = (ROOT_DIR / "_config.py").read_text(encoding="utf-8")
+    config += (
+        "\n# --- Benchmark ---\n"
+        f'OKAPI_URL = "http://127.0.0.1:{port}"\n'
+        'OKAPI_TENANT = "bench"\n'
+        'USERNAME = "bench_admin"\n'
+        'PASSWORD = "bench"\n'
+        f'OUTPUT_MODE = "{args.output_mode}"\n'
+    )
+    (workdir / "config.py").write_text(config, encoding="utf-8")
+    return workdir
+
+
+def count_rows(path):
+    if not path.exists():
+        return 0
+    with open(path, encoding="utf-8") as f:
+        return max(sum(1 for _ in f) - 1, 0)
+
+
+def run_stage(workdir, stage, port):
+    """Corre una etapa en un proceso aparte y mide tiempo, red y memoria."""
+    before = totals(get_stats(port))
+    log_path = workdir / f"{stage}.log"
+    started = time.perf_counter()
+    with open(log_path, "w", encoding="utf-8") as log:
+        process = subprocess.Popen([sys.executable, "main.py", stage, "--force"],
+                                   cwd=workdir, stdout=log, stderr=subprocess.STDOUT)
+        # wait4 devuelve el uso de recursos de ese proceso en particular
+        _, status, usage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+    elapsed = time.perf_counter() - started
+    after = totals(get_stats(port))
+
+    network = {name: after[name] - before[name] for name in after}
+    log = log_path.read_text(encoding="utf-8")
+    failed = process.returncode != 0 or f"{stage}: failed" in log
+    if stage == "04_merged_list":
+        # 04 no usa la red: se cuentan las filas que escribió
+        records = count_rows(workdir / "04_merged_list" / "usuarios_con_service_points.tsv")
+    else:
+        records = network["records"]
+
+    return {
+        "stage": stage,
+        "ok": not failed,
+        "seconds": round(elapsed, 3),
+        "records": records,
+        "records_per_sec": round(records / elapsed, 1) if elapsed else None,
+        "requests": network["requests"],
+        "errors": network["errors"],
+        "bytes": network["bytes"],
+        "peak_rss_mb": round(usage.ru_maxrss / 1024, 1),  # ru_maxrss viene en KiB en Linux
+        "log": str(log_path),
+    }
+
+
+def print_table(results):
+    header = f"{'usuarios':>9} {'etapa':<38} {'seg':>8} {'reg/s':>10} {'peticiones':>10} {'MB':>8} {'RSS MB':>8}"
+    print(header)
+    print("-" * len(header))
+    for row in results:
+        mark = "" if row["ok"] else "  ❌"
+        print(f"{row['users']:>9} {row['stage']:<38} {row['seconds']:>8.2f} {row['records_per_sec'] or 0:>10.0f} "
+              f"{row['requests']:>10} {row['bytes'] / 1e6:>8.1f} {row['peak_rss_mb']:>8.1f}{mark}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark de las etapas contra un Okapi falso.")
+    parser.add_argument("--users", type=int, nargs="+", default=[1000, 10000],
+                        help="tamaños de tenant (p. ej. 1000 100000 1000000)")
+    parser.add_argument("--stages", nargs="+", default=STAGES, help="etapas a medir, en orden")
+    parser.add_argument("--latency-ms", type=float, default=0)
+    parser.add_argument("--jitter-ms", type=float, default=0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--max-limit", type=int, default=None)
+    parser.add_argument("--estimate-totals", action="store_true")
+    parser.add_argument("--compress", action="store_true", help="el Okapi falso comprime las respuestas")
+    parser.add_argument("--output-mode", choices=["json", "ndjson"], default="json")
+    parser.add_argument("--json", help="guarda el reporte completo en este archivo")
+    parser.add_argument("--keep", action="store_true", help="no borra las carpetas temporales")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    results = []
+    for users in args.users:
+        port = free_port()
+        print(f"▶️  Tenant de {users} usuarios (puerto {port})")
+        server = start_server(args, users, port)
+        workdir = prepare_workdir(port, args)
+        try:
+            for stage in args.stages:
+                result = run_stage(workdir, stage, port)
+                result["users"] = users
+                results.append(result)
+                status = "✅" if result["ok"] else "❌"
+                print(f"   {status} {stage}: {result['seconds']:.2f}s, {result['records']} registros")
+        finally:
+            server.terminate()
+            server.wait()
+            if not args.keep:
+                shutil.rmtree(workdir, ignore_errors=True)
+
+    print()
+    print_table(results)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), "results": results}, f, indent=2)
+        print(f"✅ Reporte guardado: {args.json}")
+
+
+if __name__ == "__main__":
+    main()
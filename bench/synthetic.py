@@ -0,0 +1,94 @@
+import random
+import uuid
+from datetime import datetime, timedelta, timezone
+
+# Mismo patron group que buscan las etapas 01 y 05 por defecto
+STAFF_GROUP_ID = "34688b28-fec2-4a8d-b108-e35532f54601"
+OTHER_GROUPS = ["estudiante", "docente", "externo", "egresado", "invitado"]
+BASE_DATE = datetime(2025, 1, 1, tzinfo=timezone.utc)
+
+
+def _uuid(rng):
+    return str(uuid.UUID(int=rng.getrandbits(128), version=4))
+
+
+def _date(value):
+    return value.strftime("%Y-%m-%dT%H:%M:%S.000+00:00")
+
+
+def _metadata(rng, admin_id):
+    created = BASE_DATE - timedelta(days=rng.randint(30, 3000), seconds=rng.randint(0, 86400))
+    updated = created + timedelta(days=rng.randint(0, 30))
+    return {
+        "createdDate": _date(created),
+        "updatedDate": _date(updated),
+        "createdByUserId": admin_id,
+        "updatedByUserId": admin_id,
+    }
+
+
+def generate_tenant(users=1000, staff_fraction=0.05, other_holder_fraction=0.01, seed=1):
+    """Genera un tenant sintético con la forma de los registros de FOLIO.
+
+    Todos los usuarios de staff tienen service points asignados, y además
+    una fracción chica del resto (como en el tenant real, donde casi todos
+    los que tienen service points son staff). Con la misma semilla se
+    obtiene siempre el mismo tenant.
+    """
+    rng = random.Random(seed)
+    admin_id = _uuid(rng)
+
+    groups = [{"id": STAFF_GROUP_ID, "group": "staff", "desc": "Personal", "metadata": _metadata(rng, admin_id)}]
+    groups += [{"id": _uuid(rng), "group": name, "desc": name.title(), "metadata": _metadata(rng, admin_id)}
+               for name in OTHER_GROUPS]
+
+    service_points = []
+    for i in range(min(300, max(10, users // 5000))):
+        service_points.append({
+            "id": _uuid(rng),
+            "name": f"Biblioteca {i + 1}",
+            "code": f"BIB{i + 1:03d}",
+            "discoveryDisplayName": f"Biblioteca {i + 1}",
+            "shelvingLagTime": rng.choice([None, 0, 30, 60]),
+            "pickupLocation": rng.random() < 0.5,
+            "holdShelfExpiryPeriod": {"duration": 3, "intervalId": "Days"},
+            "staffSlips": [],
+            "metadata": _metadata(rng, admin_id),
+        })
+
+    user_records, sp_users = [], []
+    for i in range(users):
+        staff = rng.random() < staff_fraction
+        user = {
+            "id": _uuid(rng),
+            "username": f"usuario{i}",
+            "barcode": f"{100000000 + i}",
+            "active": rng.random() < 0.9,
+            "type": "staff" if staff else "patron",
+            "patronGroup": STAFF_GROUP_ID if staff else rng.choice(groups[1:])["id"],
+            "personal": {
+                "lastName": f"Apellido{i}",
+                "firstName": f"Nombre{i}",
+                "email": f"usuario{i}@example.org",
+                "preferredContactTypeId": "002",
+            },
+            "metadata": _metadata(rng, admin_id),
+        }
+        user_records.append(user)
+
+        if staff or rng.random() < other_holder_fraction:
+            assigned = rng.sample(service_points, rng.randint(1, min(3, len(service_points))))
+            sp_users.append({
+                "id": _uuid(rng),
+                "userId": user["id"],
+                "servicePointsIds": [sp["id"] for sp in assigned],
+                "defaultServicePointId": assigned[0]["id"],
+                "metadata": _metadata(rng, admin_id),
+            })
+
+    return {
+        "users": user_records,
+        "usergroups": groups,
+        "servicepoints": service_points,
+        "servicePointsUsers": sp_users,
+    }
@@ -0,0 +1,96 @@
+import hashlib
+import os
+import time
+from pathlib import Path
+import config
+import jsoncodec
+
+# Checkpoints de las descargas paginadas, para retomar una corrida interrumpida.
+# Las rutas relativas se toman desde la raíz del repositorio.
+CHECKPOINT_DIR = Path(__file__).resolve().parent / getattr(config, "CHECKPOINT_DIR", ".okapi_cache/checkpoints")
+CHECKPOINTS_ENABLED = getattr(config, "CHECKPOINTS_ENABLED", True)
+# Un checkpoint más viejo que esto (segundos) se descarta y se empieza de cero
+CHECKPOINT_MAX_AGE = getattr(config, "CHECKPOINT_MAX_AGE", 24 * 3600)
+
+
+class PageCheckpoint:
+    """Páginas ya descargadas de un recorrido y la posición para continuarlo.
+
+    Cada página se agrega a `<nombre>.pages.ndjson` (un arreglo JSON por
+    línea) y la posición (offset o último id) va en `<nombre>.state.json`,
+    que se reemplaza de una vez e indica cuántos bytes de páginas son
+    válidos. Al retomar se vuelven a entregar las páginas guardadas y la
+    descarga sigue desde la posición; al terminar se borran ambos archivos.
+    """
+
+    def __init__(self, name, identity, directory=None):
+        directory = Path(directory or CHECKPOINT_DIR)
+        digest = hashlib.sha256(jsoncodec.dumps(identity).encode()).hexdigest()[:12]
+        self.identity = digest
+        self.pages_path = directory / f"{name}.pages.ndjson"
+        self.state_path = directory / f"{name}.state.json"
+        self.state = {"identity": digest, "offset": 0, "last_id": None, "pages": 0, "records": 0, "bytes": 0}
+        self._file = None
+
+    def load(self):
+        """Lee el estado previo; True si hay páginas de este mismo recorrido."""
+        try:
+            with open(self.state_path, encoding="utf-8") as f:
+                state = jsoncodec.load(f)
+        except (OSError, ValueError):
+            return False
+        expired = time.time() - state.get("saved_at", 0) > CHECKPOINT_MAX_AGE
+        if state.get("identity") != self.identity or expired or not self.pages_path.exists():
+            self.discard()
+            return False
+        self.state = state
+        return state["pages"] > 0
+
+    def replay(self):
+        """Vuelve a entregar, una por una, las páginas guardadas."""
+        remaining = self.state["bytes"]
+        with open(self.pages_path, "rb") as f:
+            for line in f:
+                if len(line) > remaining:
+                    break
+                remaining -= len(line)
+                if line.strip():
+                    yield jsoncodec.loads(line)
+
+    def add(self, batch, offset=None, last_id=None):
+        """Guarda una página completa y la posición desde la que sigue el recorrido."""
+        if self._file is None:
+            self.pages_path.parent.mkdir(parents=True, exist_ok=True)
+            self._file = open(self.pages_path, "r+b" if self.pages_path.exists() else "wb")
+            # Lo que quedó después del último estado guardado es una página a medias
+            self._file.truncate(self.state["bytes"])
+            self._file.seek(self.state["bytes"])
+        self._file.write(jsoncodec.dumps(batch).encode("utf-8") + b"\n")
+        self._file.flush()
+
+        self.state.update(
+            offset=offset if offset is not None else self.state["offset"],
+            last_id=last_id if last_id is not None else self.state["last_id"],
+            pages=self.state["pages"] + 1,
+            records=self.state["records"] + len(batch),
+            bytes=self._file.tell(),
+            saved_at=time.time(),
+        )
+        tmp = self.state_path.with_suffix(".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            jsoncodec.dump(self.state, f, indent=False)
+        os.replace(tmp, self.state_path)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def discard(self):
+        """Borra el checkpoint (al terminar bien o si ya no sirve)."""
+        self.close()
+        for path in (self.pages_path, self.state_path):
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
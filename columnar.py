@@ -0,0 +1,199 @@
+import os
+import uuid
+from datetime import datetime, timezone
+from pathlib import Path
+import config
+from sinks import temp_path
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # pyarrow es opcional: sin él no se escribe Parquet
+    pa = pq = None
+
+# Si está activo, las etapas escriben además un .parquet con columnas tipadas
+PARQUET_ENABLED = getattr(config, "PARQUET_ENABLED", False)
+# Compresión de las columnas ("zstd", "snappy", "gzip" o None)
+PARQUET_COMPRESSION = getattr(config, "PARQUET_COMPRESSION", "zstd")
+# Registros por row group: se escribe uno cada vez que se juntan tantos
+PARQUET_ROW_GROUP_SIZE = getattr(config, "PARQUET_ROW_GROUP_SIZE", 50000)
+
+# Columnas por tipo de registro: (nombre, ruta en el registro, tipo).
+# La ruta puede ser una clave plana ("personal.lastName" en un TSV) o
+# anidada ({"personal": {"lastName": ...}} en el JSON de Okapi).
+USER_COLUMNS = [
+    ("id", "id", "uuid"),
+    ("username", "username", "string"),
+    ("barcode", "barcode", "string"),
+    ("active", "active", "bool"),
+    ("patronGroup", "patronGroup", "uuid"),
+    ("personal.lastName", "personal.lastName", "string"),
+    ("personal.firstName", "personal.firstName", "string"),
+    ("personal.middleName", "personal.middleName", "string"),
+    ("personal.email", "personal.email", "string"),
+    ("personal.mobilePhone", "personal.mobilePhone", "string"),
+    ("personal.preferredContactTypeId", "personal.preferredContactTypeId", "string"),
+    ("metadata.createdDate", "metadata.createdDate", "timestamp"),
+    ("metadata.updatedDate", "metadata.updatedDate", "timestamp"),
+    ("metadata.createdByUserId", "metadata.createdByUserId", "uuid"),
+    ("metadata.updatedByUserId", "metadata.updatedByUserId", "uuid"),
+]
+
+SERVICE_POINT_COLUMNS = [
+    ("id", "id", "uuid"),
+    ("name", "name", "string"),
+    ("code", "code", "string"),
+    ("discoveryDisplayName", "discoveryDisplayName", "string"),
+    ("description", "description", "string"),
+    ("shelvingLagTime", "shelvingLagTime", "int"),
+    ("pickupLocation", "pickupLocation", "bool"),
+    ("metadata.createdDate", "metadata.createdDate", "timestamp"),
+    ("metadata.updatedDate", "metadata.updatedDate", "timestamp"),
+]
+
+SERVICE_POINT_USER_COLUMNS = [
+    ("id", "id", "uuid"),
+    ("userId", "userId", "uuid"),
+    ("servicePointsIds", "servicePointsIds", "uuid_list"),
+    ("defaultServicePointId", "defaultServicePointId", "uuid"),
+    ("metadata.updatedDate", "metadata.updatedDate", "timestamp"),
+]
+
+_warned = False
+
+
+def parquet_enabled():
+    """True si se pidió Parquet y pyarrow está instalado."""
+    global _warned
+    if PARQUET_ENABLED and pa is None and not _warned:
+        print("⚠️  PARQUET_ENABLED está activo pero pyarrow no está instalado; se omite el Parquet")
+        _warned = True
+    return PARQUET_ENABLED and pa is not None
+
+
+def _get(record, path):
+    if path in record:
+        return record[path]
+    value = record
+    for part in path.split("."):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(part)
+    return value
+
+
+def _to_uuid(value):
+    if not value:
+        return None
+    try:
+        return uuid.UUID(value).bytes
+    except (ValueError, TypeError, AttributeError):
+        return None
+
+
+def _to_bool(value):
+    if value is None or value == "":
+        return None
+    if isinstance(value, str):
+        return value.lower() == "true"
+    return bool(value)
+
+
+def _to_int(value):
+    if value is None or value == "":
+        return None
+    try:
+        return int(value)
+    except (ValueError, TypeError):
+        return None
+
+
+def _to_timestamp(value):
+    if not value:
+        return None
+    try:
+        parsed = datetime.fromisoformat(value)
+    except (ValueError, TypeError):
+        return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed
+
+
+def _to_string(value):
+    if value is None:
+        return None
+    return value if isinstance(value, str) else str(value)
+
+
+# tipo → (tipo de Arrow, conversión de cada valor)
+TYPES = {
+    "string": (lambda: pa.string(), _to_string),
+    "uuid": (lambda: pa.binary(16), _to_uuid),
+    "bool": (lambda: pa.bool_(), _to_bool),
+    "int": (lambda: pa.int64(), _to_int),
+    "timestamp": (lambda: pa.timestamp("ms", tz="UTC"), _to_timestamp),
+    "uuid_list": (lambda: pa.list_(pa.binary(16)),
+                  lambda values: None if values is None else [_to_uuid(v) for v in values]),
+}
+
+
+class ParquetWriter:
+    """Escribe registros a Parquet con columnas tipadas, por row groups.
+
+    Los UUID se guardan como 16 bytes, las fechas como timestamp UTC y
+    `servicePointsIds` como lista. Mantiene en memoria a lo sumo un row group.
+    """
+
+    def __init__(self, path, columns, row_group_size=None, compression=None):
+        self.path = Path(path)
+        self.columns = columns
+        self.row_group_size = row_group_size or PARQUET_ROW_GROUP_SIZE
+        self.compression = compression or PARQUET_COMPRESSION
+        self.schema = pa.schema([(name, TYPES[kind][0]()) for name, _, kind in columns])
+        self._buffer = [[] for _ in columns]
+        self._pending = 0
+        self._writer = None
+
+    def open(self):
+        self._writer = pq.ParquetWriter(temp_path(self.path), self.schema, compression=self.compression)
+
+    def write(self, records):
+        converters = [TYPES[kind][1] for _, _, kind in self.columns]
+        for record in records:
+            for values, (_, path, _), convert in zip(self._buffer, self.columns, converters):
+                values.append(convert(_get(record, path)))
+            self._pending += 1
+            if self._pending >= self.row_group_size:
+                self._flush()
+
+    def _flush(self):
+        if not self._pending:
+            return
+        self._writer.write_table(pa.Table.from_arrays(self._buffer, schema=self.schema))
+        self._buffer = [[] for _ in self.columns]
+        self._pending = 0
+
+    def close(self):
+        self._flush()
+        self._writer.close()
+        os.replace(temp_path(self.path), self.path)
+
+    def abort(self):
+        """Descarta el temporal sin tocar el Parquet anterior."""
+        if self._writer:
+            self._writer.close()
+        temp_path(self.path).unlink(missing_ok=True)
+
+
+def save_parquet(records, path, columns):
+    """Guarda una lista (o iterable) de registros en un Parquet."""
+    writer = ParquetWriter(path, columns)
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    writer.open()
+    try:
+        writer.write(records)
+    except BaseException:
+        writer.abort()
+        raise
+    writer.close()
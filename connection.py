@@ -1,55 +1,363 @@
 import aiohttp
+import asyncio
+import random
 import ssl
+import time
+import zlib
+from email.utils import parsedate_to_datetime
 import certifi
 import config
+from token_cache import TokenManager
+import jsoncodec
+from metrics import METRICS
+
+# Descompresores opcionales: sin ellos solo se piden gzip y deflate
+try:
+    import brotli
+except ImportError:
+    try:
+        import brotlicffi as brotli
+    except ImportError:
+        brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import httpx
+except ImportError:  # httpx es opcional: solo hace falta para HTTP/2
+    httpx = None
+
+# Parámetros del pool de conexiones (se pueden sobrescribir en config.py)
+POOL_LIMIT = getattr(config, "OKAPI_POOL_LIMIT", 100)
+POOL_LIMIT_PER_HOST = getattr(config, "OKAPI_POOL_LIMIT_PER_HOST", 50)
+DNS_CACHE_TTL = getattr(config, "OKAPI_DNS_CACHE_TTL", 300)
+KEEPALIVE_TIMEOUT = getattr(config, "OKAPI_KEEPALIVE_TIMEOUT", 30)
+REQUEST_TIMEOUT = getattr(config, "OKAPI_REQUEST_TIMEOUT", 120)
+
+# Pedir las respuestas comprimidas (gzip y, si hay con qué descomprimir, brotli y zstd)
+COMPRESSION = getattr(config, "OKAPI_COMPRESSION", True)
+# HTTP/2 (varias peticiones multiplexadas en una conexión); requiere `pip install httpx[http2]`
+HTTP2 = getattr(config, "OKAPI_HTTP2", False)
+
+# Reintentos ante fallas transitorias (backoff exponencial con jitter)
+RETRY_ATTEMPTS = getattr(config, "OKAPI_RETRY_ATTEMPTS", 5)
+RETRY_BASE_DELAY = getattr(config, "OKAPI_RETRY_BASE_DELAY", 0.5)
+RETRY_MAX_DELAY = getattr(config, "OKAPI_RETRY_MAX_DELAY", 30)
+# Si Retry-After pide esperar más que esto (segundos), no se reintenta
+RETRY_MAX_AFTER = getattr(config, "OKAPI_RETRY_MAX_AFTER", 120)
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# Métodos que se pueden repetir sin efectos duplicados
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}
+
+
+def _importable(*names):
+    for name in names:
+        try:
+            __import__(name)
+            return True
+        except ImportError:
+            pass
+    return False
+
+
+_http2_warned = False
+
+
+def http2_enabled():
+    """True si se pidió HTTP/2 y están httpx y h2; si no, se avisa una vez y se usa aiohttp."""
+    global _http2_warned
+    available = httpx is not None and _importable("h2")
+    if HTTP2 and not available and not _http2_warned:
+        print("⚠️  OKAPI_HTTP2 está activo pero falta httpx[http2]; se usa HTTP/1.1")
+        _http2_warned = True
+    return HTTP2 and available
+
+
+def accept_encoding():
+    """Valor de Accept-Encoding: solo las codificaciones que el cliente sabe descomprimir.
+
+    httpx y `decode_body` usan los mismos módulos opcionales (brotli y zstandard).
+    """
+    if not COMPRESSION:
+        return "identity"
+    encodings = (["zstd"] if zstandard else []) + (["br"] if brotli else []) + ["gzip", "deflate"]
+    return ", ".join(encodings)
+
+
+def decode_body(body, content_encoding):
+    """Descomprime un cuerpo según su Content-Encoding.
+
+    La sesión de aiohttp no descomprime sola para poder medir los bytes que
+    realmente viajan; lo hace esta función una vez leído el cuerpo completo.
+    """
+    codings = [c.strip().lower() for c in (content_encoding or "").split(",") if c.strip()]
+    for coding in reversed(codings):
+        if coding in ("gzip", "x-gzip"):
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        elif coding == "deflate":
+            try:
+                body = zlib.decompress(body)
+            except zlib.error:  # deflate sin encabezado zlib
+                body = zlib.decompress(body, -zlib.MAX_WBITS)
+        elif coding == "br" and brotli:
+            body = brotli.decompress(body)
+        elif coding == "zstd" and zstandard:
+            body = zstandard.ZstdDecompressor().decompressobj().decompress(body)
+        elif coding != "identity":
+            raise ValueError(f"Content-Encoding no soportado: {coding}")
+    return body
+
+
+def retry_after(response):
+    """Segundos pedidos por el encabezado Retry-After (número o fecha HTTP), o None."""
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt, wait_hint=None):
+    """Espera antes del reintento `attempt` (0, 1, ...): jitter completo sobre 2^n."""
+    delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+    if wait_hint is not None:
+        delay = max(delay, wait_hint)
+    return delay
+
+
+def is_retryable(method, status, idempotent=None):
+    """Fallas transitorias: conexión (status None), 429 y 5xx de gateway.
+
+    Los métodos no idempotentes solo se repiten si Okapi no llegó a
+    procesar la petición (429 y 503). `idempotent` permite marcar como
+    repetible un POST sin efectos (p. ej. el login).
+    """
+    if idempotent is None:
+        idempotent = method.upper() in IDEMPOTENT_METHODS
+    if idempotent:
+        return status is None or status in RETRY_STATUSES
+    return status in (429, 503)
+
+
+def retry_delay(method, attempt, response=None, idempotent=None):
+    """Espera antes del reintento `attempt`, o None si no corresponde reintentar.
+
+    `response` es None cuando falló la conexión. No se reintenta si se
+    agotaron los intentos, si la falla no es transitoria o si Retry-After
+    pide esperar más que RETRY_MAX_AFTER.
+    """
+    status = response.status if response is not None else None
+    if attempt >= RETRY_ATTEMPTS or not is_retryable(method, status, idempotent):
+        return None
+    wait_hint = retry_after(response) if response is not None else None
+    if wait_hint is not None and wait_hint > RETRY_MAX_AFTER:
+        return None
+    return backoff_delay(attempt, wait_hint)
+
+
+class OkapiError(Exception):
+    """Error de una llamada a Okapi. `status` es None si falló la conexión."""
+
+    def __init__(self, status, text, url=None):
+        self.status = status
+        self.text = text
+        self.url = url
+        if status is None:
+            super().__init__(f"Error de conexión: {text}")
+        else:
+            super().__init__(f"Error HTTP {status}: {text}")
+
+
+class OkapiResponse:
+    """Respuesta ya leída de Okapi (independiente de la librería HTTP)."""
+
+    def __init__(self, status, headers, body, url=None, cookies=None):
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.url = url
+        self.cookies = cookies or {}
+
+    @property
+    def ok(self):
+        return 200 <= self.status < 300
+
+    def text(self):
+        return self.body.decode("utf-8", errors="replace")
+
+    def json(self):
+        return jsoncodec.loads(self.body)
+
+    def raise_for_status(self):
+        if not self.ok:
+            raise OkapiError(self.status, self.text(), self.url)
+
 
 class Connection:
-    def __init__(self):
-        self.okapi_url = config.OKAPI_URL
-        self.tenant = config.OKAPI_TENANT
-        self.username = config.USERNAME
-        self.password = config.PASSWORD
-        self.token = None
+    def __init__(self, pool_limit=None, pool_limit_per_host=None, dns_cache_ttl=None, profile=None):
+        # Sin perfil se usan los datos de conexión de config.py (ver profiles.py)
+        self.profile = profile
+        self.okapi_url = profile.url if profile else config.OKAPI_URL
+        self.tenant = profile.tenant if profile else config.OKAPI_TENANT
+        self.username = profile.username if profile else config.USERNAME
+        self.password = profile.password if profile else config.PASSWORD
         self.ssl_context = ssl.create_default_context(cafile=certifi.where())
+        self.pool_limit = pool_limit or POOL_LIMIT
+        self.pool_limit_per_host = pool_limit_per_host or POOL_LIMIT_PER_HOST
+        self.dns_cache_ttl = dns_cache_ttl or DNS_CACHE_TTL
+        self.http2 = http2_enabled()
+        self.accept_encoding = accept_encoding()
+        self._session = None
+        self._client = None
+        self.tokens = TokenManager(self)
 
-    async def get_token(self):
-        # Si ya hay token, verificar que siga funcionando
-        if self.token and await self._is_token_valid(self.token):
-            return self.token
+    @property
+    def token(self):
+        return self.tokens.token
 
-        # Obtener nuevo token
-        url = f"{self.okapi_url}/authn/login"
-        headers = {
-            "Content-Type": "application/json",
-            "x-okapi-tenant": self.tenant
-        }
-        payload = {
-            "username": self.username,
-            "password": self.password
-        }
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    @property
+    def session(self):
+        """Sesión HTTP única y reutilizable (keep-alive, pool y caché DNS)."""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                ssl=self.ssl_context,
+                limit=self.pool_limit,
+                limit_per_host=self.pool_limit_per_host,
+                ttl_dns_cache=self.dns_cache_ttl,
+                keepalive_timeout=KEEPALIVE_TIMEOUT,
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT),
+                auto_decompress=False,  # ver decode_body
+            )
+        return self._session
+
+    @property
+    def client(self):
+        """Cliente httpx con HTTP/2 (solo con OKAPI_HTTP2); multiplexa sobre pocas conexiones."""
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                http2=True,
+                verify=self.ssl_context,
+                limits=httpx.Limits(
+                    max_connections=self.pool_limit_per_host,
+                    max_keepalive_connections=self.pool_limit_per_host,
+                    keepalive_expiry=KEEPALIVE_TIMEOUT,
+                ),
+                timeout=REQUEST_TIMEOUT,
+            )
+        return self._client
 
-        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(ssl=self.ssl_context)) as session:
-            async with session.post(url, json=payload, headers=headers) as response:
-                if response.status == 201:
-                    self.token = response.headers.get("x-okapi-token")
-                    return self.token
-                else:
-                    text = await response.text()
-                    raise Exception(f"❌ Error al obtener token: {response.status} {text}")
-
-    async def _is_token_valid(self, token):
-        """Hace una llamada simple protegida para ver si el token sigue siendo válido."""
-        test_url = f"{self.okapi_url}/users?limit=1"  # Endpoint liviano y común
+    async def close(self):
+        METRICS.export()
+        self.tokens.close()
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        if self._client is not None and not self._client.is_closed:
+            await self._client.aclose()
+        self._session = None
+        self._client = None
+
+    def headers(self, token=None):
         headers = {
-            "x-okapi-token": token,
             "x-okapi-tenant": self.tenant,
-            "Content-Type": "application/json"
+            "Content-Type": "application/json",
+            "Accept-Encoding": self.accept_encoding,
         }
+        if token:
+            headers["x-okapi-token"] = token
+        return headers
+
+    async def _send(self, method, url, params=None, json=None, headers=None):
+        path = url[len(self.okapi_url):] if url.startswith(self.okapi_url) else url
+        started = time.monotonic()
+        if self.http2:
+            return await self._send_http2(method, url, path, started, params, json, headers)
+        try:
+            async with self.session.request(method, url, params=params, json=json, headers=headers) as response:
+                raw = await response.read()
+                body = decode_body(raw, response.headers.get("Content-Encoding"))
+                cookies = {name: morsel.value for name, morsel in response.cookies.items()}
+                METRICS.observe_request(method, path, response.status, time.monotonic() - started,
+                                        len(body), len(raw))
+                return OkapiResponse(response.status, response.headers, body, str(response.url), cookies)
+        except (aiohttp.ClientError, TimeoutError, ValueError, zlib.error) as exc:
+            METRICS.observe_request(method, path, None, time.monotonic() - started)
+            raise OkapiError(None, str(exc) or exc.__class__.__name__, url) from exc
 
+    async def _send_http2(self, method, url, path, started, params, json, headers):
         try:
-            async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(ssl=self.ssl_context)) as session:
-                async with session.get(test_url, headers=headers) as response:
-                    return response.status != 401
-        except Exception as e:
-            print(f"⚠️ Error al validar token: {e}")
-            return False
+            response = await self.client.request(method, url, params=params, json=json, headers=headers)
+        except httpx.HTTPError as exc:
+            METRICS.observe_request(method, path, None, time.monotonic() - started)
+            raise OkapiError(None, str(exc) or exc.__class__.__name__, url) from exc
+        body = response.content
+        METRICS.observe_request(method, path, response.status_code, time.monotonic() - started,
+                                len(body), response.num_bytes_downloaded)
+        return OkapiResponse(response.status_code, response.headers, body, str(response.url),
+                             dict(response.cookies))
+
+    async def request(self, method, path, params=None, json=None, headers=None, retry=True):
+        """Hace una llamada autenticada a Okapi usando la sesión compartida.
+
+        Si Okapi responde 401 se renueva el token y se reintenta una sola vez.
+        Las fallas transitorias (conexión, 429, 5xx de gateway) se reintentan
+        hasta RETRY_ATTEMPTS veces con backoff exponencial y jitter,
+        respetando Retry-After. Con `retry=False` se devuelven (o lanzan) en
+        el primer intento, para quien reintente por su cuenta (el scheduler).
+        """
+        url = f"{self.okapi_url}{path}"
+        token = await self.tokens.get()
+        relogged = False
+        attempt = 0
+        while True:
+            request_headers = self.headers(token)
+            if headers:
+                request_headers.update(headers)
+            try:
+                response = await self._send(method, url, params=params, json=json, headers=request_headers)
+            except OkapiError:
+                delay = retry_delay(method, attempt) if retry else None
+                if delay is None:
+                    raise
+                reason = "error"
+            else:
+                if response.status == 401 and not relogged:
+                    METRICS.observe_retry(method, path, 401)
+                    token = await self.tokens.invalidate(token)
+                    relogged = True
+                    continue
+                delay = retry_delay(method, attempt, response) if retry else None
+                if delay is None:
+                    return response
+                reason = response.status
+
+            attempt += 1
+            METRICS.observe_retry(method, path, reason)
+            await asyncio.sleep(delay)
+
+    async def get_json(self, path, params=None):
+        """GET autenticado que devuelve el JSON o lanza OkapiError."""
+        response = await self.request("GET", path, params=params)
+        response.raise_for_status()
+        return response.json()
+
+    async def get_token(self):
+        """Devuelve un token vigente sin hacer llamadas de validación."""
+        return await self.tokens.get()
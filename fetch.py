@@ -0,0 +1,290 @@
+import asyncio
+import hashlib
+import math
+from collections import deque
+from urllib.parse import quote
+import config
+from checkpoint import PageCheckpoint, CHECKPOINTS_ENABLED
+from metrics import METRICS
+
+# Tamaño máximo de página que se le pide a Okapi
+PAGE_SIZE = getattr(config, "OKAPI_PAGE_SIZE", 1000)
+# Tamaño mínimo de página al ajustar de forma adaptativa
+MIN_PAGE_SIZE = getattr(config, "OKAPI_MIN_PAGE_SIZE", 100)
+# Tamaño objetivo (en bytes) de cada respuesta paginada
+TARGET_PAGE_BYTES = getattr(config, "OKAPI_TARGET_PAGE_BYTES", 4 * 1024 * 1024)
+# Páginas que se descargan en paralelo
+FETCH_CONCURRENCY = getattr(config, "OKAPI_FETCH_CONCURRENCY", 4)
+# Largo máximo del query CQL (ya codificado) en las búsquedas por lotes de ids
+MAX_QUERY_LENGTH = getattr(config, "OKAPI_MAX_QUERY_LENGTH", 4000)
+# Modo de paginación por defecto: "offset" (ventanas en paralelo) o "keyset" (cursor por id)
+PAGING_MODE = getattr(config, "OKAPI_PAGING_MODE", "offset")
+# Imprimir cada página descargada; el resumen por endpoint sale de metrics.py
+PAGE_PRINTS = getattr(config, "FETCH_PAGE_PRINTS", False)
+
+
+def with_sort(query, sort_by="id"):
+    """Agrega `sortBy` a un CQL para que el orden de las páginas sea estable."""
+    if not sort_by:
+        return query
+    if not query:
+        query = "cql.allRecords=1"
+    if "sortby" in query.lower():
+        return query
+    return f"{query} sortBy {sort_by}"
+
+
+def keyset_query(query, last_id):
+    """CQL de la página siguiente a `last_id` (orden por id)."""
+    cursor = f'id > "{last_id}"' if last_id else None
+    if query and cursor:
+        query = f"({query}) and {cursor}"
+    else:
+        query = query or cursor
+    return with_sort(query, "id")
+
+
+def exclude_query(field, values):
+    """Sufijo CQL `not field==("a" or "b" ...)` para usar como `extra_query`."""
+    values = [v for v in values if v]
+    if not values:
+        return None
+    terms = " or ".join(f'"{v}"' for v in values)
+    return f"not {field}==({terms})"
+
+
+def adaptive_page_size(page_bytes, page_count, remaining, concurrency, max_size=PAGE_SIZE):
+    """Elige el tamaño de página según el peso de los registros y el paralelismo.
+
+    Se apunta a respuestas de ~TARGET_PAGE_BYTES y a que haya al menos una
+    página por worker, sin salir del rango [MIN_PAGE_SIZE, max_size].
+    """
+    by_bytes = max_size
+    if page_count:
+        by_bytes = int(TARGET_PAGE_BYTES / (page_bytes / page_count))
+    by_workers = math.ceil(remaining / max(concurrency, 1))
+    return max(min(MIN_PAGE_SIZE, max_size), min(max_size, by_bytes, by_workers))
+
+
+async def _get_page(conn, path, key, params, offset, limit, label=None):
+    if label and PAGE_PRINTS:
+        print(f"Descargando {label}... offset: {offset}")
+    response = await conn.request("GET", path, params={**params, "limit": limit, "offset": offset})
+    response.raise_for_status()
+    data = response.json()
+    batch = data.get(key, [])
+    METRICS.observe_page(path, len(batch))
+    return batch, data.get("totalRecords"), len(response.body)
+
+
+def _is_capped(batch, total):
+    """True si una página corta no es la última: Okapi recortó `limit` a su máximo."""
+    return bool(batch) and isinstance(total, int) and total > len(batch)
+
+
+async def _keyset_pages(conn, path, key, query, params, page_size, label, last_id=None, checkpoint=None):
+    """Pagina por cursor: cada página continúa desde el último id visto.
+
+    El costo por página no crece con la profundidad y no se saltan ni repiten
+    registros si la colección cambia durante el recorrido.
+    """
+    while True:
+        if label and PAGE_PRINTS:
+            print(f"Descargando {label}... desde id: {last_id or '(inicio)'}")
+        page_params = {**params, "query": keyset_query(query, last_id)}
+        batch, total, _ = await _get_page(conn, path, key, page_params, 0, page_size)
+        if batch and checkpoint:
+            checkpoint.add(batch, last_id=batch[-1]["id"])
+        yield batch
+        if len(batch) < page_size:
+            if not _is_capped(batch, total):
+                return
+            page_size = len(batch)
+        last_id = batch[-1]["id"]
+
+
+async def _offset_pages(conn, path, key, params, page_size, concurrency, label, start=0, checkpoint=None):
+    """Ventanas offset/limit en paralelo, entregadas en orden desde `start`."""
+    batch, total, size_bytes = await _get_page(conn, path, key, params, start, page_size, label)
+    position = start + len(batch)
+    if batch and checkpoint:
+        checkpoint.add(batch, offset=position)
+    yield batch
+    if len(batch) < page_size:
+        if not _is_capped(batch, total - start if isinstance(total, int) else None):
+            return
+        page_size = len(batch)
+
+    offset = position
+    # totalRecords puede ser una estimación: si falta, se sigue hasta una página corta
+    stop_at = total if isinstance(total, int) and total > offset else offset + page_size
+    size = adaptive_page_size(size_bytes, len(batch), stop_at - offset, concurrency, page_size)
+
+    pending = deque()
+    next_offset = offset
+    extra_pages = 1
+    try:
+        while True:
+            while len(pending) < concurrency and next_offset < stop_at:
+                task = asyncio.create_task(_get_page(conn, path, key, params, next_offset, size, label))
+                pending.append(task)
+                next_offset += size
+
+            batch, _, _ = await pending.popleft()
+            position += len(batch)
+            if batch and checkpoint:
+                checkpoint.add(batch, offset=position)
+            yield batch
+            if len(batch) < size:
+                return
+            if not pending and next_offset >= stop_at:
+                # Se pasó del total informado: se sigue con ventanas cada vez más grandes
+                stop_at = next_offset + size * extra_pages
+                extra_pages = min(extra_pages * 2, concurrency)
+    finally:
+        for task in pending:
+            if task.done() and not task.cancelled():
+                task.exception()
+            task.cancel()
+
+
+def checkpoint_scope(conn):
+    """Prefijo de los checkpoints de una conexión.
+
+    Dos perfiles pueden compartir tenant (otra URL, otras credenciales u
+    otros patron groups) y descargan a la vez: el prefijo lleva además un
+    digest del nombre del perfil (único), la URL y el usuario.
+    """
+    profile = getattr(conn, "profile", None)
+    key = f"{profile.name if profile else ''}|{conn.okapi_url}|{conn.tenant}|{conn.username}"
+    return f"{conn.tenant}_{hashlib.sha256(key.encode()).hexdigest()[:8]}"
+
+
+async def fetch_pages(conn, path, key, query=None, params=None, page_size=None,
+                      concurrency=None, sort_by="id", label=None, mode=None, checkpoint=None):
+    """Recorre una colección paginada de Okapi y entrega sus páginas en orden.
+
+    En modo "offset" la primera página informa `totalRecords` y el resto de
+    las ventanas se descargan en paralelo (hasta `concurrency` a la vez),
+    entregándose en el mismo orden en el que aparecen en la colección.
+    En modo "keyset" las páginas se piden en secuencia con `id > "<último>"`.
+
+    Con `checkpoint` (un nombre) cada página queda guardada en disco junto
+    con la posición alcanzada; si la corrida se corta, la siguiente vuelve a
+    entregar esas páginas y sigue desde ahí en lugar de empezar de cero.
+    """
+    page_size = page_size or PAGE_SIZE
+    concurrency = concurrency or FETCH_CONCURRENCY
+    label = key if label is None else label
+    params = dict(params or {})
+    mode = mode or PAGING_MODE
+    if mode != "keyset":
+        query = with_sort(query, sort_by)
+        if query:
+            params["query"] = query
+
+    saved = None
+    if checkpoint and CHECKPOINTS_ENABLED:
+        checkpoint = f"{checkpoint_scope(conn)}_{checkpoint}"
+        identity = {"okapi": conn.okapi_url, "path": path, "query": query, "params": params, "mode": mode}
+        saved = PageCheckpoint(checkpoint, identity)
+        if saved.load():
+            print(f"↩️  {label or key}: se retoma desde el checkpoint ({saved.state['records']} registros)")
+            for batch in saved.replay():
+                yield batch
+
+    if mode == "keyset":
+        last_id = saved.state["last_id"] if saved else None
+        pages = _keyset_pages(conn, path, key, query, params, page_size, label, last_id, saved)
+    else:
+        start = saved.state["offset"] if saved else 0
+        pages = _offset_pages(conn, path, key, params, page_size, concurrency, label, start, saved)
+
+    try:
+        async for batch in pages:
+            yield batch
+    finally:
+        await pages.aclose()
+        if saved:
+            saved.close()
+    # Recorrido completo: el checkpoint ya no hace falta
+    if saved:
+        saved.discard()
+
+
+async def fetch_all(conn, path, key, **kwargs):
+    """Igual que `fetch_pages` pero devuelve todos los registros en una lista."""
+    records = []
+    async for batch in fetch_pages(conn, path, key, **kwargs):
+        records.extend(batch)
+    return records
+
+
+def chunk_ids(ids, field="id", max_length=None, extra_query=None):
+    """Agrupa ids en CQL `field==("a" or "b" ...)` que no superen `max_length`.
+
+    El largo se mide con el query ya codificado para la URL. Devuelve una
+    lista de tuplas (query, cantidad de ids).
+    """
+    max_length = max_length or MAX_QUERY_LENGTH
+    suffix = f" {extra_query}" if extra_query else ""
+    # Se reserva espacio para el cursor que agrega la paginación por keyset
+    base = len(quote(f'({field}==(){suffix}) and id > "{"0" * 36}" sortBy id'))
+    separator = len(quote(" or "))
+
+    chunks = []
+    current, length = [], base
+    for value in ids:
+        term = f'"{value}"'
+        cost = len(quote(term)) + (separator if current else 0)
+        if current and length + cost > max_length:
+            chunks.append(current)
+            current, length = [], base
+            cost = len(quote(term))
+        current.append(term)
+        length += cost
+    if current:
+        chunks.append(current)
+
+    return [(f"{field}==({' or '.join(c)}){suffix}", len(c)) for c in chunks]
+
+
+async def fetch_by_ids(conn, path, key, ids, field="id", extra_query=None, concurrency=None, label=None):
+    """Busca registros por lotes de ids con CQL en lugar de un GET por id.
+
+    Los lotes se piden en paralelo (hasta `concurrency` a la vez) y los
+    registros se devuelven en el orden de los lotes.
+    """
+    ids = list(dict.fromkeys(i for i in ids if i))
+    if not ids:
+        return []
+    concurrency = concurrency or FETCH_CONCURRENCY
+    label = label or key
+    semaphore = asyncio.Semaphore(concurrency)
+    chunks = chunk_ids(ids, field, extra_query=extra_query)
+
+    async def get_chunk(index, query, count):
+        async with semaphore:
+            if PAGE_PRINTS:
+                print(f"Descargando {label}... lote {index + 1}/{len(chunks)} ({count} ids)")
+            # Un mismo id puede tener varios registros (p. ej. userId), por eso se pagina
+            return await fetch_all(conn, path, key, query=query, mode="keyset", label="")
+
+    results = await asyncio.gather(*(get_chunk(i, q, n) for i, (q, n) in enumerate(chunks)))
+    return [record for batch in results for record in batch]
+
+
+async def resolve_ids(conn, path, key, ids, **kwargs):
+    """Devuelve un mapa id → registro resuelto con `fetch_by_ids`."""
+    records = await fetch_by_ids(conn, path, key, ids, **kwargs)
+    return {record["id"]: record for record in records}
+
+
+async def resolve_users(conn, user_ids, excluded_patron_groups=()):
+    """Resuelve muchos usuarios con búsquedas CQL por lotes (id → usuario).
+
+    Los usuarios de los patron groups excluidos se descartan en el mismo
+    query (`id==(...) not patronGroup==(...)`), así que no se descargan.
+    """
+    excluded = exclude_query("patronGroup", excluded_patron_groups)
+    return await resolve_ids(conn, "/users", "users", user_ids, extra_query=excluded, label="usuarios")
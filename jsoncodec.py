@@ -0,0 +1,103 @@
+import json
+import config
+
+try:
+    import orjson
+except ImportError:  # orjson es opcional: sin él se usa el módulo json estándar
+    orjson = None
+
+# "auto" usa orjson si está instalado; "json" fuerza la librería estándar
+JSON_CODEC = getattr(config, "JSON_CODEC", "auto")
+# Tamaño de cada lectura al recorrer un arreglo JSON de forma incremental
+READ_CHUNK = 1024 * 1024
+
+USE_ORJSON = orjson is not None and JSON_CODEC in ("auto", "orjson")
+
+_decoder = json.JSONDecoder()
+_WHITESPACE = " \t\n\r"
+
+
+def loads(data):
+    """Decodifica JSON desde str o bytes."""
+    if USE_ORJSON:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dumps(obj, indent=False):
+    """Codifica a str, sin escapar caracteres no ASCII."""
+    if USE_ORJSON:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else 0).decode("utf-8")
+    return json.dumps(obj, ensure_ascii=False, indent=2 if indent else None)
+
+
+def dump(obj, f, indent=True):
+    """Escribe `obj` en un archivo de texto abierto (con sangría por defecto)."""
+    f.write(dumps(obj, indent=indent))
+
+
+def load(f):
+    return loads(f.read())
+
+
+def _skip(buf, pos):
+    while pos < len(buf) and buf[pos] in _WHITESPACE:
+        pos += 1
+    return pos
+
+
+def iter_array(path, key=None):
+    """Recorre un arreglo JSON de primer nivel elemento por elemento.
+
+    El archivo se lee por bloques y cada registro se entrega apenas se
+    termina de leer, así que la memoria queda acotada a un bloque más un
+    registro. Si el archivo es un objeto (p. ej. la respuesta de Okapi tal
+    cual), se carga completo y se recorre su lista `key`.
+
+    Los registros se decodifican con el escáner en C de la librería
+    estándar, que permite decodificar desde una posición del bloque.
+    """
+    with open(path, encoding="utf-8") as f:
+        buf = f.read(READ_CHUNK)
+        pos = _skip(buf, 0)
+
+        # Archivos chicos (un solo bloque) u objetos: se decodifican de una vez
+        if len(buf) < READ_CHUNK or buf[pos:pos + 1] != "[":
+            data = loads(buf + f.read())
+            yield from (data.get(key, []) if isinstance(data, dict) else data)
+            return
+        pos += 1
+
+        while True:
+            pos = _skip(buf, pos)
+            if pos >= len(buf):
+                chunk = f.read(READ_CHUNK)
+                if not chunk:
+                    raise ValueError(f"JSON incompleto en {path}")
+                buf, pos = chunk, 0
+                continue
+            if buf[pos] == "]":
+                return
+            if buf[pos] == ",":
+                pos += 1
+                continue
+
+            try:
+                record, end = _decoder.raw_decode(buf, pos)
+                after = _skip(buf, end)
+            except json.JSONDecodeError as exc:
+                error, end = exc, None
+            # Un registro que llega al final del bloque puede estar cortado,
+            # incluso si decodificó (un número como `15000000000.` + `0`): solo
+            # se acepta si lo sigue una `,` o un `]`. Si no, se descarta lo ya
+            # procesado y se lee el bloque siguiente
+            if end is None or after >= len(buf) or buf[after] not in ",]":
+                chunk = f.read(READ_CHUNK)
+                if chunk:
+                    buf, pos = buf[pos:] + chunk, 0
+                    continue
+                if end is None:
+                    raise ValueError(f"JSON inválido en {path}: {error}")
+
+            yield record
+            pos = end
@@ -1,11 +1,36 @@
+import argparse
 import asyncio
-from connection import Connection
+from profiles import Connections
+from pipeline import run_pipeline, run_in_memory
+
+
+async def show_token():
+    async with Connections() as connections:
+        for profile, conn in connections:
+            token = await conn.get_token()
+            prefix = f"{profile.name}: " if profile.name else ""
+            print(f"✅ {prefix}Token: {token}")
 
-# Ejemplo de uso
-if __name__ == "__main__":
-    async def main():
-        conn = Connection()
-        token = await conn.get_token()
-        print(f"✅ Token: {token}")
 
-    asyncio.run(main())
\ No newline at end of file
+def parse_args():
+    parser = argparse.ArgumentParser(description="Corre las etapas 01-05 como un solo pipeline.")
+    parser.add_argument("stages", nargs="*", help="etapas a correr (por defecto, todas)")
+    parser.add_argument("--force", action="store_true", help="corre las etapas aunque no haya cambios")
+    parser.add_argument("--in-memory", action="store_true",
+                        help="corre todo en un proceso pasando los datos en memoria")
+    parser.add_argument("--write-files", action="store_true",
+                        help="con --in-memory, escribe también los archivos de cada etapa")
+    parser.add_argument("--token", action="store_true", help="solo obtiene un token y lo muestra")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.token:
+        asyncio.run(show_token())
+    elif args.in_memory:
+        data = asyncio.run(run_in_memory(write_files=args.write_files))
+        print(", ".join(f"{name}: {len(records)}" for name, records in data.items()))
+    else:
+        results = asyncio.run(run_pipeline(force=args.force, only=args.stages or None))
+        print(", ".join(f"{name}: {status}" for name, status in results.items()))
@@ -0,0 +1,335 @@
+import os
+import re
+import tempfile
+import time
+from collections import Counter
+from pathlib import Path
+import config
+import jsoncodec
+
+# Métricas de las llamadas a Okapi (latencia, estados, bytes y registros por endpoint).
+# Las rutas relativas se toman desde la raíz del repositorio.
+ROOT_DIR = Path(__file__).resolve().parent
+METRICS_ENABLED = getattr(config, "METRICS_ENABLED", True)
+# Reporte JSON de la corrida (None = no se escribe)
+METRICS_REPORT = getattr(config, "METRICS_REPORT", "output/metrics.json")
+# Archivo .prom para el textfile collector de node_exporter (None = no se escribe)
+METRICS_PROMETHEUS_FILE = getattr(config, "METRICS_PROMETHEUS_FILE", None)
+# Procesos que terminaron hasta estos segundos antes de que empiece otro se suman
+# al mismo reporte (etapas en paralelo o una tras otra); los anteriores se descartan
+METRICS_MERGE_WINDOW = getattr(config, "METRICS_MERGE_WINDOW", 60)
+# Sin reporte JSON, las métricas por proceso se combinan en este archivo
+METRICS_STATE_FILE = ".okapi_cache/metrics_runs.json"
+# Un lock del reporte más viejo que esto se considera abandonado
+LOCK_STALE_AFTER = 10
+
+# Límites (en segundos) de los buckets del histograma de latencia
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# Límites de los buckets de registros por página
+PAGE_BUCKETS = (0, 1, 10, 50, 100, 250, 500, 1000, 2500, 5000)
+
+UUID_RE = re.compile(r"[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}")
+
+
+def endpoint_of(path):
+    """Ruta sin ids ni query, para agrupar (p. ej. /service-points/{id})."""
+    return UUID_RE.sub("{id}", path.split("?", 1)[0])
+
+
+class Histogram:
+    """Histograma acumulado al estilo Prometheus (conteo por límite superior)."""
+
+    __slots__ = ("bounds", "counts", "count", "sum", "max")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * len(bounds)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.bounds):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        """Aproximación: límite superior del bucket donde cae el cuantil."""
+        if not self.count:
+            return None
+        target = q * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= target:
+                return min(bound, self.max)
+        return self.max
+
+    def cumulative(self):
+        total, result = 0, []
+        for bound, count in zip(self.bounds, self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+    def add_dict(self, data):
+        """Suma un histograma exportado con `to_dict` (de otro proceso)."""
+        previous = 0
+        for i, bound in enumerate(self.bounds):
+            cumulative = data["buckets"].get(str(bound), previous)
+            self.counts[i] += cumulative - previous
+            previous = cumulative
+        self.count += data["count"]
+        self.sum += data["sum"]
+        self.max = max(self.max, data["max"])
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 6),
+            "max": round(self.max, 6),
+            "p50": self.quantile(0.5),
+            "p90": self.quantile(0.9),
+            "p99": self.quantile(0.99),
+            "buckets": {str(bound): count for bound, count in self.cumulative()},
+        }
+
+
+class EndpointStats:
+    __slots__ = ("requests", "retries", "errors", "bytes", "wire_bytes", "records", "statuses", "latency",
+                 "page_records")
+
+    def __init__(self):
+        self.requests = 0
+        self.retries = Counter()
+        self.errors = 0
+        self.bytes = 0
+        self.wire_bytes = 0
+        self.records = 0
+        self.statuses = Counter()
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.page_records = Histogram(PAGE_BUCKETS)
+
+
+class Metrics:
+    """Registro de métricas del proceso; lo alimentan Connection y fetch."""
+
+    def __init__(self):
+        self.started_at = time.time()
+        self.endpoints = {}
+
+    def _stats(self, method, path):
+        key = (method, endpoint_of(path))
+        stats = self.endpoints.get(key)
+        if stats is None:
+            stats = self.endpoints[key] = EndpointStats()
+        return stats
+
+    def observe_request(self, method, path, status, seconds, size=0, wire_size=None):
+        """Una respuesta (o un fallo de conexión si `status` es None).
+
+        `size` son los bytes del cuerpo ya descomprimido y `wire_size` los que
+        viajaron por la red (iguales si la respuesta no venía comprimida).
+        """
+        if not METRICS_ENABLED:
+            return
+        stats = self._stats(method, path)
+        stats.requests += 1
+        stats.statuses["error" if status is None else str(status)] += 1
+        if status is None or status >= 400:
+            stats.errors += 1
+        stats.bytes += size
+        stats.wire_bytes += size if wire_size is None else wire_size
+        stats.latency.observe(seconds)
+
+    def observe_retry(self, method, path, reason):
+        if METRICS_ENABLED:
+            self._stats(method, path).retries[str(reason)] += 1
+
+    def observe_page(self, path, records):
+        if not METRICS_ENABLED:
+            return
+        stats = self._stats("GET", path)
+        stats.records += records
+        stats.page_records.observe(records)
+
+    def add_report(self, report):
+        """Suma los endpoints de un reporte (de otro proceso) a este registro."""
+        for entry in report.get("endpoints", []):
+            stats = self._stats(entry["method"], entry["endpoint"])
+            stats.requests += entry["requests"]
+            stats.retries.update(entry.get("retry_reasons", {}))
+            stats.errors += entry["errors"]
+            stats.statuses.update(entry.get("statuses", {}))
+            stats.bytes += entry["bytes"]
+            stats.wire_bytes += entry.get("wire_bytes", entry["bytes"])
+            stats.records += entry["records"]
+            stats.latency.add_dict(entry["latency_seconds"])
+            stats.page_records.add_dict(entry["records_per_page"])
+
+    def report(self):
+        endpoints = []
+        for (method, endpoint), stats in sorted(self.endpoints.items(), key=lambda item: item[0][1]):
+            endpoints.append({
+                "method": method,
+                "endpoint": endpoint,
+                "requests": stats.requests,
+                "retries": sum(stats.retries.values()),
+                "retry_reasons": dict(stats.retries),
+                "errors": stats.errors,
+                "statuses": dict(stats.statuses),
+                "bytes": stats.bytes,
+                "wire_bytes": stats.wire_bytes,
+                "records": stats.records,
+                "latency_seconds": stats.latency.to_dict(),
+                "records_per_page": stats.page_records.to_dict(),
+            })
+        return {"started_at": self.started_at, "finished_at": time.time(), "endpoints": endpoints}
+
+    def prometheus(self):
+        """Texto en el formato de exposición de Prometheus."""
+        lines = []
+
+        def metric(name, kind, help_text):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        def labels(method, endpoint, **extra):
+            pairs = {"method": method, "endpoint": endpoint, **extra}
+            return "{" + ",".join(f'{k}="{v}"' for k, v in pairs.items()) + "}"
+
+        items = sorted(self.endpoints.items(), key=lambda item: item[0][1])
+
+        metric("okapi_requests_total", "counter", "Respuestas de Okapi por endpoint y estado HTTP")
+        for (method, endpoint), stats in items:
+            for status, count in sorted(stats.statuses.items()):
+                lines.append(f"okapi_requests_total{labels(method, endpoint, status=status)} {count}")
+
+        metric("okapi_retries_total", "counter", "Reintentos por endpoint y motivo")
+        for (method, endpoint), stats in items:
+            for reason, count in sorted(stats.retries.items()):
+                lines.append(f"okapi_retries_total{labels(method, endpoint, reason=reason)} {count}")
+
+        metric("okapi_response_bytes_total", "counter", "Bytes recibidos por endpoint (descomprimidos)")
+        for (method, endpoint), stats in items:
+            lines.append(f"okapi_response_bytes_total{labels(method, endpoint)} {stats.bytes}")
+
+        metric("okapi_response_wire_bytes_total", "counter", "Bytes recibidos por la red por endpoint")
+        for (method, endpoint), stats in items:
+            lines.append(f"okapi_response_wire_bytes_total{labels(method, endpoint)} {stats.wire_bytes}")
+
+        metric("okapi_records_total", "counter", "Registros recibidos en páginas por endpoint")
+        for (method, endpoint), stats in items:
+            lines.append(f"okapi_records_total{labels(method, endpoint)} {stats.records}")
+
+        for name, attr, help_text in (
+            ("okapi_request_duration_seconds", "latency", "Latencia de las llamadas a Okapi"),
+            ("okapi_page_records", "page_records", "Registros por página"),
+        ):
+            metric(name, "histogram", help_text)
+            for (method, endpoint), stats in items:
+                histogram = getattr(stats, attr)
+                if not histogram.count:
+                    continue
+                for bound, count in histogram.cumulative():
+                    lines.append(f"{name}_bucket{labels(method, endpoint, le=bound)} {count}")
+                lines.append(f'{name}_bucket{labels(method, endpoint, le="+Inf")} {histogram.count}')
+                lines.append(f"{name}_sum{labels(method, endpoint)} {histogram.sum}")
+                lines.append(f"{name}_count{labels(method, endpoint)} {histogram.count}")
+
+        metric("okapi_last_run_timestamp_seconds", "gauge", "Fin de la última corrida")
+        lines.append(f"okapi_last_run_timestamp_seconds {time.time()}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """Tabla corta por endpoint para imprimir al terminar."""
+        rows = [f"{'endpoint':<40} {'pet.':>6} {'reint.':>6} {'err.':>5} {'MB':>8} {'MB red':>8} "
+                f"{'p50 ms':>8} {'p99 ms':>8}"]
+        for (method, endpoint), stats in sorted(self.endpoints.items(), key=lambda item: item[0][1]):
+            p50 = (stats.latency.quantile(0.5) or 0) * 1000
+            p99 = (stats.latency.quantile(0.99) or 0) * 1000
+            rows.append(f"{method + ' ' + endpoint:<40} {stats.requests:>6} {sum(stats.retries.values()):>6} "
+                        f"{stats.errors:>5} {stats.bytes / 1e6:>8.2f} {stats.wire_bytes / 1e6:>8.2f} "
+                        f"{p50:>8.0f} {p99:>8.0f}")
+        return "\n".join(rows)
+
+    def export(self):
+        """Escribe el reporte JSON y el archivo de Prometheus configurados.
+
+        Si varias etapas corren en procesos distintos, cada una guarda su
+        parte en `processes` del reporte y los totales son la suma de todas.
+        Las partes de procesos que terminaron más de METRICS_MERGE_WINDOW
+        segundos antes de que empezara este se descartan, así una corrida
+        nueva empieza un reporte nuevo. Se puede llamar varias veces: cada
+        llamada reemplaza la parte de este proceso.
+        """
+        if not METRICS_ENABLED or not self.endpoints:
+            return
+        path = ROOT_DIR / (METRICS_REPORT or METRICS_STATE_FILE)
+        key = f"{os.getpid()}-{self.started_at}"
+        with _ReportLock(path.with_name(path.name + ".lock")):
+            try:
+                with open(path, encoding="utf-8") as f:
+                    processes = jsoncodec.loads(f.read()).get("processes") or {}
+            except (OSError, ValueError):
+                processes = {}
+            processes = {name: part for name, part in processes.items()
+                         if name != key and part.get("finished_at", 0) >= self.started_at - METRICS_MERGE_WINDOW}
+            processes[key] = self.report()
+
+            combined = Metrics()
+            for part in processes.values():
+                combined.add_report(part)
+            report = combined.report()
+            report["started_at"] = min(part["started_at"] for part in processes.values())
+            report["processes"] = processes
+            _write_atomic(path, jsoncodec.dumps(report, indent=True))
+            if METRICS_PROMETHEUS_FILE:
+                _write_atomic(ROOT_DIR / METRICS_PROMETHEUS_FILE, combined.prometheus())
+
+
+class _ReportLock:
+    """Lock entre procesos (archivo creado de forma exclusiva) para combinar el reporte."""
+
+    def __init__(self, path):
+        self.path = Path(path)
+
+    def __enter__(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        while True:
+            try:
+                os.close(os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                return self
+            except FileExistsError:
+                try:
+                    if time.time() - self.path.stat().st_mtime > LOCK_STALE_AFTER:
+                        self.path.unlink(missing_ok=True)
+                        continue
+                except FileNotFoundError:
+                    continue
+                time.sleep(0.05)
+
+    def __exit__(self, exc_type, exc, tb):
+        self.path.unlink(missing_ok=True)
+
+
+def _write_atomic(path, text):
+    # node_exporter puede leer el archivo en cualquier momento: se reemplaza de una
+    # vez, desde un temporal propio de este proceso
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with tempfile.NamedTemporaryFile("w", encoding="utf-8", dir=path.parent, prefix=path.name + ".",
+                                     suffix=".tmp", delete=False) as f:
+        f.write(text)
+    try:
+        os.replace(f.name, path)
+    except OSError:
+        os.unlink(f.name)
+        raise
+
+
+METRICS = Metrics()
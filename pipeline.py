@@ -0,0 +1,228 @@
+import asyncio
+import hashlib
+import importlib.util
+import inspect
+import json
+import os
+import time
+from pathlib import Path
+import config
+from profiles import Connections, tagged_schema
+from metrics import METRICS
+from schema import USERS
+from sinks import streaming_enabled
+
+ROOT_DIR = Path(__file__).resolve().parent
+# Estado de la última corrida exitosa de cada etapa
+PIPELINE_STATE = ROOT_DIR / getattr(config, "PIPELINE_STATE", ".okapi_cache/pipeline_state.json")
+# Las etapas que descargan de Okapi no tienen archivos de entrada: se vuelven
+# a correr si su última corrida tiene más de estos segundos (0 = siempre)
+SOURCE_MAX_AGE = getattr(config, "PIPELINE_SOURCE_MAX_AGE", 0)
+# Configuración que no afecta los resultados (no entra en el hash)
+CONFIG_HASH_EXCLUDE = {"PASSWORD"}
+
+
+def _data_file(path):
+    """Archivo de registros de una etapa según OUTPUT_MODE (.json o .ndjson)."""
+    return path.with_suffix(".ndjson") if streaming_enabled() else path
+
+
+def _hash_file(path, digest):
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+
+
+def config_hash():
+    values = {
+        name: repr(getattr(config, name))
+        for name in dir(config)
+        if name.isupper() and name not in CONFIG_HASH_EXCLUDE
+    }
+    return hashlib.sha256(json.dumps(values, sort_keys=True).encode()).hexdigest()
+
+
+class Stage:
+    """Una etapa del pipeline: su script, dependencias, entradas y salidas."""
+
+    def __init__(self, name, script, deps=(), inputs=(), outputs=()):
+        self.name = name
+        self.script = ROOT_DIR / script
+        self.deps = list(deps)
+        self.inputs = [ROOT_DIR / p for p in inputs]
+        self.outputs = [ROOT_DIR / p for p in outputs]
+
+    def fingerprint(self):
+        """Hash de la configuración, el código de la etapa y sus entradas."""
+        digest = hashlib.sha256(config_hash().encode())
+        for path in [self.script, *self.inputs]:
+            digest.update(str(path.relative_to(ROOT_DIR)).encode())
+            if path.exists():
+                _hash_file(path, digest)
+        return digest.hexdigest()
+
+    def is_up_to_date(self, state, fingerprint):
+        previous = state.get(self.name)
+        if not previous or previous.get("fingerprint") != fingerprint:
+            return False
+        if not all(path.exists() for path in self.outputs):
+            return False
+        if not self.inputs and time.time() - previous.get("finished_at", 0) >= SOURCE_MAX_AGE:
+            return False
+        return True
+
+    def load(self):
+        spec = importlib.util.spec_from_file_location(f"stage_{self.name}", self.script)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return module
+
+    async def run(self):
+        main = self.load().main
+        if inspect.iscoroutinefunction(main):
+            await main()
+        else:
+            # Las etapas sin red (p. ej. 04) corren en un hilo para no frenar al resto
+            await asyncio.to_thread(main)
+
+
+def default_stages():
+    """Etapas 01-05 con las rutas que las conectan entre sí."""
+    staff_users = Path("01_staff_list/output/usuarios.tsv")
+    service_points = _data_file(Path("02_service_points_list/output/service_points.json"))
+    sp_users = _data_file(Path("03_service_points_staff_list/output/service_point_users.json"))
+    return [
+        Stage("01_staff_list", "01_staff_list/main.py",
+              outputs=[staff_users, "01_staff_list/output/uuids.tsv"]),
+        Stage("02_service_points_list", "02_service_points_list/main.py",
+              outputs=[service_points, "02_service_points_list/output/service_points.tsv"]),
+        Stage("03_service_points_staff_list", "03_service_points_staff_list/main.py",
+              outputs=[sp_users, "03_service_points_staff_list/output/service_point_users.tsv"]),
+        Stage("04_merged_list", "04_merged_list/main.py",
+              deps=["01_staff_list", "02_service_points_list", "03_service_points_staff_list"],
+              inputs=[staff_users, service_points, sp_users],
+              outputs=["04_merged_list/usuarios_con_service_points.tsv"]),
+        Stage("05_no_staff_with_service_points_list", "05_no_staff_with_service_points_list/main.py",
+              deps=["03_service_points_staff_list"],
+              inputs=[sp_users],
+              outputs=["05_no_staff_with_service_points_list/output/filtered_users.tsv"]),
+    ]
+
+
+def load_state():
+    try:
+        with open(PIPELINE_STATE, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_state(state):
+    PIPELINE_STATE.parent.mkdir(parents=True, exist_ok=True)
+    tmp = PIPELINE_STATE.with_suffix(".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp, PIPELINE_STATE)
+
+
+async def run_pipeline(stages=None, force=False, only=None):
+    """Corre las etapas respetando dependencias; las independientes, en paralelo.
+
+    Una etapa se salta si su huella (configuración, código y entradas) es la
+    misma que en su última corrida exitosa y sus salidas siguen existiendo.
+    Si una etapa falla, las que dependen de ella no se ejecutan.
+    """
+    stages = stages or default_stages()
+    by_name = {stage.name: stage for stage in stages}
+    state = load_state()
+    tasks = {}
+    results = {}
+
+    def task_for(name):
+        if name not in tasks:
+            tasks[name] = asyncio.ensure_future(run(by_name[name]))
+        return tasks[name]
+
+    async def run(stage):
+        for dep in stage.deps:
+            if await task_for(dep) == "failed":
+                print(f"⏭️  {stage.name}: se omite porque falló {dep}")
+                results[stage.name] = "failed"
+                return "failed"
+
+        fingerprint = stage.fingerprint()
+        selected = only is None or any(stage.name.startswith(name) for name in only)
+        if not selected or (not force and stage.is_up_to_date(state, fingerprint)):
+            print(f"⏭️  {stage.name}: sin cambios, se omite")
+            results[stage.name] = "skipped"
+            return "skipped"
+
+        print(f"▶️  {stage.name}: iniciando")
+        started = time.time()
+        try:
+            await stage.run()
+        except Exception as exc:
+            print(f"❌ {stage.name}: {exc}")
+            results[stage.name] = "failed"
+            return "failed"
+
+        state[stage.name] = {"fingerprint": fingerprint, "finished_at": time.time()}
+        save_state(state)
+        print(f"✅ {stage.name}: terminada en {time.time() - started:.1f}s")
+        results[stage.name] = "done"
+        return "done"
+
+    for stage in stages:
+        missing = [dep for dep in stage.deps if dep not in by_name]
+        if missing:
+            raise ValueError(f"{stage.name} depende de etapas desconocidas: {missing}")
+
+    await asyncio.gather(*(task_for(stage.name) for stage in stages))
+    if METRICS.endpoints:
+        print(METRICS.summary())
+    return results
+
+
+async def run_in_memory(write_files=False):
+    """Corre 01-05 en un solo proceso pasando los registros en memoria.
+
+    Las etapas comparten una conexión por perfil; 04 y 05 consumen directamente lo que
+    devuelven 01-03, sin serializar ni volver a leer archivos. Con
+    `write_files` cada etapa además escribe sus salidas habituales.
+    """
+    modules = {stage.name: stage.load() for stage in default_stages()}
+    staff = modules["01_staff_list"]
+    service_points_stage = modules["02_service_points_list"]
+    sp_users_stage = modules["03_service_points_staff_list"]
+    merged_stage = modules["04_merged_list"]
+    no_staff = modules["05_no_staff_with_service_points_list"]
+
+    async with Connections() as connections:
+        users, service_points, sp_users = await asyncio.gather(
+            staff.run(connections, write_files=write_files),
+            service_points_stage.run(connections, write_files=write_files),
+            sp_users_stage.run(connections, write_files=write_files),
+        )
+
+        def merge():
+            rows = map(tagged_schema(USERS).flatten, users)
+            merged = list(merged_stage.merge(rows, sp_users, service_points))
+            if write_files:
+                fieldnames = tagged_schema(USERS).names + ["servicePoints"]
+                merged_stage.save_users_with_service_points(merged, merged_stage.OUTPUT_TSV, fieldnames)
+            return merged
+
+        # 04 es CPU y 05 es red: corren a la vez
+        merged, filtered = await asyncio.gather(
+            asyncio.to_thread(merge),
+            no_staff.run(connections, sp_users, write_files=write_files),
+        )
+    print(METRICS.summary())
+
+    return {
+        "users": users,
+        "service_points": service_points,
+        "service_point_users": sp_users,
+        "merged": merged,
+        "filtered": filtered,
+    }
@@ -0,0 +1,96 @@
+import asyncio
+import config
+from connection import Connection
+
+# Perfiles de Okapi (tenant y credenciales) que se descargan en una misma corrida.
+# Si no hay OKAPI_PROFILES se usa un solo perfil con OKAPI_URL, OKAPI_TENANT,
+# USERNAME y PASSWORD, y las salidas quedan igual que siempre (sin etiqueta).
+OKAPI_PROFILES = getattr(config, "OKAPI_PROFILES", None) or []
+# Patron groups de personal que descarga la etapa 01 (un perfil puede tener los suyos)
+STAFF_PATRON_GROUP_IDS = getattr(config, "STAFF_PATRON_GROUP_IDS", ["34688b28-fec2-4a8d-b108-e35532f54601"])
+
+# Campo con el nombre del perfil que se agrega a cada registro y columna en TSV/Parquet
+TAG_FIELD = "profile"
+
+
+class Profile:
+    """Un tenant de Okapi con sus credenciales y sus patron groups de personal."""
+
+    def __init__(self, name, url, tenant, username, password, patron_groups=None):
+        self.name = name
+        self.url = url
+        self.tenant = tenant
+        self.username = username
+        self.password = password
+        self.patron_groups = list(patron_groups or STAFF_PATRON_GROUP_IDS)
+
+    def __repr__(self):
+        return f"Profile({self.name or self.tenant!r})"
+
+
+def load_profiles():
+    if not OKAPI_PROFILES:
+        return [Profile(None, config.OKAPI_URL, config.OKAPI_TENANT, config.USERNAME, config.PASSWORD)]
+    profiles = []
+    for entry in OKAPI_PROFILES:
+        profiles.append(Profile(
+            entry.get("name") or entry["tenant"],
+            entry.get("url", getattr(config, "OKAPI_URL", None)),
+            entry["tenant"],
+            entry.get("username", getattr(config, "USERNAME", None)),
+            entry.get("password", getattr(config, "PASSWORD", None)),
+            entry.get("patron_groups"),
+        ))
+    names = [profile.name for profile in profiles]
+    if len(set(names)) != len(names):
+        raise ValueError(f"❌ Nombres de perfil repetidos en OKAPI_PROFILES: {names}")
+    return profiles
+
+
+PROFILES = load_profiles()
+# Con OKAPI_PROFILES los registros llevan el nombre de su perfil
+TAGGED = bool(OKAPI_PROFILES)
+
+
+def tag(records, profile):
+    """Agrega el nombre del perfil a cada registro (solo si hay OKAPI_PROFILES)."""
+    if TAGGED:
+        for record in records:
+            record[TAG_FIELD] = profile.name
+    return records
+
+
+def tagged_schema(schema):
+    """Esquema de TSV con la columna del perfil al final, si corresponde."""
+    return schema.extended([(TAG_FIELD, TAG_FIELD, None)]) if TAGGED else schema
+
+
+def tagged_columns(columns):
+    """Columnas de Parquet con la del perfil al final, si corresponde."""
+    return columns + [(TAG_FIELD, TAG_FIELD, "string")] if TAGGED else columns
+
+
+def profile_of(record):
+    """Perfil de un registro etiquetado (el único perfil si no hay etiquetas)."""
+    if not TAGGED:
+        return PROFILES[0].name
+    return record.get(TAG_FIELD)
+
+
+class Connections:
+    """Una Connection por perfil, cada una con su token y su pool de conexiones.
+
+    `async with Connections() as connections:` entrega una lista de pares
+    (perfil, conexión) y al salir las cierra todas.
+    """
+
+    def __init__(self, profiles=None):
+        self.profiles = profiles or PROFILES
+        self.items = []
+
+    async def __aenter__(self):
+        self.items = [(profile, Connection(profile=profile)) for profile in self.profiles]
+        return self.items
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await asyncio.gather(*(conn.close() for _, conn in self.items))
@@ -0,0 +1,117 @@
+import hashlib
+import os
+import time
+from pathlib import Path
+import config
+import jsoncodec
+from fetch import fetch_all
+from sync import remote_count
+
+# Carpeta y vigencia del caché en disco de datos de referencia.
+# Las rutas relativas se toman desde la raíz del repositorio.
+REFDATA_CACHE_DIR = Path(__file__).resolve().parent / getattr(config, "REFDATA_CACHE_DIR", ".okapi_cache")
+REFDATA_TTL = getattr(config, "REFDATA_TTL", 24 * 3600)
+
+# nombre → (endpoint, clave de la colección, campo con el nombre visible)
+COLLECTIONS = {
+    "service_points": ("/service-points", "servicepoints", "name"),
+    "groups": ("/groups", "usergroups", "group"),
+}
+
+
+class ReferenceData:
+    """Caché de service points y patron groups, en memoria y en disco.
+
+    Cada colección se descarga completa (paginada) y se guarda con fecha,
+    ETag y `metadata.updatedDate` máximo. Mientras no venza REFDATA_TTL se usa
+    tal cual; al vencer se valida con una consulta liviana (304 o conteos)
+    antes de volver a descargarla.
+    """
+
+    def __init__(self, conn, cache_dir=None):
+        self.conn = conn
+        key = hashlib.sha256(f"{conn.okapi_url}|{conn.tenant}".encode()).hexdigest()[:16]
+        self.cache_dir = Path(cache_dir or REFDATA_CACHE_DIR)
+        self.prefix = f"refdata_{key}"
+        self.records = {name: {} for name in COLLECTIONS}
+
+    def _path(self, name):
+        return self.cache_dir / f"{self.prefix}_{name}.json"
+
+    async def load(self, names=None):
+        for name in names or COLLECTIONS:
+            await self._load_collection(name)
+        return self
+
+    async def _load_collection(self, name):
+        cached = self._read(name)
+        if cached and time.time() - cached["fetched_at"] < REFDATA_TTL:
+            pass
+        elif cached and await self._is_unchanged(name, cached):
+            cached["fetched_at"] = time.time()
+            self._write(name, cached)
+        else:
+            cached = await self.refresh(name)
+        self.records[name] = {r["id"]: r for r in cached["records"]}
+
+    async def refresh(self, name):
+        """Descarga la colección completa y actualiza el caché en disco."""
+        path, key, _ = COLLECTIONS[name]
+        probe = await self.conn.request("GET", path, params={"limit": 0})
+        records = await fetch_all(self.conn, path, key, label=name)
+        return self.save(name, records, probe.headers.get("ETag"))
+
+    def save(self, name, records, etag=None):
+        """Guarda una colección ya descargada (p. ej. por la etapa 02)."""
+        records = list(records)
+        updated = [(r.get("metadata") or {}).get("updatedDate") for r in records]
+        cached = {
+            "fetched_at": time.time(),
+            "etag": etag,
+            "count": len(records),
+            "max_updated": max((u for u in updated if u), default=None),
+            "records": records,
+        }
+        self._write(name, cached)
+        self.records[name] = {r["id"]: r for r in records}
+        return cached
+
+    async def _is_unchanged(self, name, cached):
+        path, _, _ = COLLECTIONS[name]
+        headers = {"If-None-Match": cached["etag"]} if cached.get("etag") else None
+        response = await self.conn.request("GET", path, params={"limit": 0}, headers=headers)
+        if response.status == 304:
+            return True
+        if not response.ok or response.json().get("totalRecords") != cached["count"]:
+            return False
+        if not cached.get("max_updated"):
+            return False
+        newer = await remote_count(self.conn, path, f'metadata.updatedDate > "{cached["max_updated"]}"')
+        return newer == 0
+
+    def _read(self, name):
+        try:
+            with open(self._path(name), encoding="utf-8") as f:
+                return jsoncodec.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write(self, name, cached):
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        tmp = self._path(name).with_suffix(".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            jsoncodec.dump(cached, f, indent=False)
+        os.replace(tmp, self._path(name))
+
+    def name(self, collection, record_id):
+        """Nombre visible de un registro, o None si no está en el caché."""
+        record = self.records[collection].get(record_id)
+        if record is None:
+            return None
+        return record.get(COLLECTIONS[collection][2], "")
+
+    def service_point_name(self, sp_id):
+        return self.name("service_points", sp_id)
+
+    def patron_group_name(self, group_id):
+        return self.name("groups", group_id)
@@ -0,0 +1,123 @@
+import asyncio
+import time
+from connection import OkapiError, retry_delay
+from metrics import METRICS
+import config
+
+# Límites de concurrencia del scheduler adaptativo (AIMD)
+SCHEDULER_INITIAL = getattr(config, "OKAPI_SCHEDULER_INITIAL", 8)
+SCHEDULER_MIN = getattr(config, "OKAPI_SCHEDULER_MIN", 1)
+SCHEDULER_MAX = getattr(config, "OKAPI_SCHEDULER_MAX", 64)
+# Una latencia mayor que base * este factor se toma como señal de saturación
+LATENCY_TOLERANCE = getattr(config, "OKAPI_SCHEDULER_LATENCY_TOLERANCE", 3.0)
+
+
+def is_overload(status):
+    """429 y 5xx indican que Okapi (o el gateway) está saturado."""
+    return status is None or status == 429 or status >= 500
+
+
+class AdaptiveScheduler:
+    """Ejecuta llamadas a Okapi en paralelo con un límite que se ajusta solo.
+
+    El límite crece de a uno por ventana mientras las respuestas son buenas y
+    se reduce a la mitad ante 429/5xx (AIMD); una latencia muy por encima de
+    la mínima observada lo reduce suavemente. Expone `request`/`get_json`
+    igual que `Connection`, así que puede usarse en su lugar.
+
+    Los reintentos ante fallas transitorias se hacen aquí y no dentro de la
+    Connection: cada 429/5xx baja el límite en cuanto llega, y el reintento
+    vuelve a esperar un lugar bajo el límite ya reducido.
+    """
+
+    def __init__(self, conn, initial=None, minimum=None, maximum=None):
+        self.conn = conn
+        self.minimum = minimum or SCHEDULER_MIN
+        self.maximum = maximum or SCHEDULER_MAX
+        self.limit = float(min(initial or SCHEDULER_INITIAL, self.maximum))
+        self.in_flight = 0
+        self.base_latency = None
+        self._last_decrease = 0.0
+        self._condition = asyncio.Condition()
+        self._flights = {}
+        self._results = {}
+
+    async def _acquire(self):
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+
+    async def _release(self):
+        async with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    def _decrease(self, factor):
+        # Una sola reducción por ventana, aunque fallen varias llamadas juntas
+        now = time.monotonic()
+        if now - self._last_decrease < (self.base_latency or 0):
+            return
+        self._last_decrease = now
+        self.limit = max(self.minimum, self.limit * factor)
+
+    def _observe(self, status, latency):
+        if is_overload(status):
+            self._decrease(0.5)
+            return
+        if self.base_latency is None or latency < self.base_latency:
+            self.base_latency = latency
+        else:
+            # La base se adapta despacio para seguir cambios reales del servidor
+            self.base_latency = self.base_latency * 0.99 + latency * 0.01
+        if latency > self.base_latency * LATENCY_TOLERANCE:
+            self._decrease(0.9)
+        else:
+            self.limit = min(self.maximum, self.limit + 1 / self.limit)
+
+    async def request(self, method, path, **kwargs):
+        attempt = 0
+        while True:
+            await self._acquire()
+            started = time.monotonic()
+            response, error, status = None, None, None
+            try:
+                response = await self.conn.request(method, path, retry=False, **kwargs)
+                status = response.status
+            except OkapiError as exc:
+                error, status = exc, exc.status
+            finally:
+                self._observe(status, time.monotonic() - started)
+                await self._release()
+
+            delay = retry_delay(method, attempt, response)
+            if delay is None:
+                if error is not None:
+                    raise error
+                return response
+            attempt += 1
+            METRICS.observe_retry(method, path, status or "error")
+            await asyncio.sleep(delay)
+
+    async def get_json(self, path, params=None):
+        response = await self.request("GET", path, params=params)
+        response.raise_for_status()
+        return response.json()
+
+    async def once(self, key, fn):
+        """Single-flight: una sola ejecución de `fn()` por clave.
+
+        Las llamadas concurrentes con la misma clave esperan el mismo
+        resultado, y el resultado queda guardado para las siguientes.
+        """
+        if key in self._results:
+            return self._results[key]
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = asyncio.ensure_future(fn())
+            self._flights[key] = flight
+            try:
+                self._results[key] = await asyncio.shield(flight)
+            finally:
+                del self._flights[key]
+            return self._results[key]
+        return await asyncio.shield(flight)
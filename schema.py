@@ -0,0 +1,120 @@
+import json
+from sinks import TsvWriter
+
+# Columnas de los TSV por tipo de registro: (nombre, ruta con puntos, codificador).
+# El codificador (opcional) convierte el valor antes de escribirlo; "json" guarda
+# objetos y listas como texto JSON.
+
+
+def _json(value):
+    return json.dumps(value, ensure_ascii=False)
+
+
+ENCODERS = {"json": _json}
+
+USER_FIELDS = [
+    ("id", "id", None),
+    ("username", "username", None),
+    ("barcode", "barcode", None),
+    ("active", "active", None),
+    ("patronGroup", "patronGroup", None),
+    ("createdDate", "createdDate", None),
+    ("updatedDate", "updatedDate", None),
+    ("personal.lastName", "personal.lastName", None),
+    ("personal.firstName", "personal.firstName", None),
+    ("personal.middleName", "personal.middleName", None),
+    ("personal.email", "personal.email", None),
+    ("personal.mobilePhone", "personal.mobilePhone", None),
+    ("personal.preferredContactTypeId", "personal.preferredContactTypeId", None),
+    ("metadata.createdDate", "metadata.createdDate", None),
+    ("metadata.updatedDate", "metadata.updatedDate", None),
+    ("metadata.createdByUserId", "metadata.createdByUserId", None),
+    ("metadata.updatedByUserId", "metadata.updatedByUserId", None),
+]
+
+SERVICE_POINT_FIELDS = [
+    ("id", "id", None),
+    ("name", "name", None),
+    ("code", "code", None),
+    ("discoveryDisplayName", "discoveryDisplayName", None),
+    ("description", "description", None),
+    ("shelvingLagTime", "shelvingLagTime", None),
+    ("pickupLocation", "pickupLocation", None),
+    ("holdShelfExpiryPeriod", "holdShelfExpiryPeriod", "json"),
+    ("staffSlips", "staffSlips", "json"),
+    ("metadata.createdDate", "metadata.createdDate", None),
+    ("metadata.updatedDate", "metadata.updatedDate", None),
+    ("metadata.createdByUserId", "metadata.createdByUserId", None),
+    ("metadata.updatedByUserId", "metadata.updatedByUserId", None),
+]
+
+SERVICE_POINT_USER_FIELDS = [
+    ("id", "id", None),
+    ("userId", "userId", None),
+    ("servicePoints", "servicePoints", "json"),
+    ("defaultServicePointId", "defaultServicePointId", None),
+]
+
+
+def compile_row(fields):
+    """Genera una función registro → tupla de valores para las columnas dadas.
+
+    Cada objeto intermedio (p. ej. `personal` o `metadata`) se busca una sola
+    vez por registro y se reutiliza para todas sus columnas, sin armar dicts
+    temporales. Un objeto ausente o null se trata como vacío.
+    """
+    namespace = {"_EMPTY": {}}
+    lines = ["def row(r):"]
+    variables = {"": "r"}
+    values = []
+    for i, (_, path, encoder) in enumerate(fields):
+        *parents, key = path.split(".")
+        parent = ""
+        for part in parents:
+            prefix = f"{parent}.{part}" if parent else part
+            if prefix not in variables:
+                variables[prefix] = f"v{len(variables)}"
+                lines.append(f"    {variables[prefix]} = {variables[parent]}.get({part!r}) or _EMPTY")
+            parent = prefix
+        value = f"{variables[parent]}.get({key!r})"
+        if encoder is not None:
+            namespace[f"e{i}"] = ENCODERS.get(encoder, encoder)
+            value = f"e{i}({value})"
+        values.append(value)
+    lines.append(f"    return ({', '.join(values)},)" if values else "    return ()")
+    exec("\n".join(lines), namespace)
+    return namespace["row"]
+
+
+class Schema:
+    """Columnas de un tipo de registro y su función de extracción ya compilada."""
+
+    def __init__(self, fields):
+        self.fields = fields
+        self.names = [name for name, _, _ in fields]
+        self.row = compile_row(fields)
+
+    def extended(self, fields):
+        """Otro esquema con columnas agregadas al final."""
+        return Schema(self.fields + list(fields))
+
+    def flatten(self, record):
+        """Registro plano como dict (nombre de columna → valor)."""
+        return dict(zip(self.names, self.row(record)))
+
+
+USERS = Schema(USER_FIELDS)
+SERVICE_POINTS = Schema(SERVICE_POINT_FIELDS)
+SERVICE_POINT_USERS = Schema(SERVICE_POINT_USER_FIELDS)
+
+
+def save_tsv(records, path, schema):
+    """Guarda una lista (o iterable) de registros en un TSV con las columnas del esquema."""
+    writer = TsvWriter(path, schema)
+    writer.open()
+    try:
+        writer.write(records)
+    except BaseException:
+        writer.abort()
+        raise
+    writer.close()
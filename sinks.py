@@ -0,0 +1,164 @@
+import csv
+import os
+from itertools import islice
+from pathlib import Path
+import config
+import jsoncodec
+
+# "json" guarda listas completas (por defecto); "ndjson" escribe cada página al llegar
+OUTPUT_MODE = getattr(config, "OUTPUT_MODE", "json")
+
+
+def streaming_enabled():
+    return OUTPUT_MODE == "ndjson"
+
+
+def temp_path(path):
+    """Ruta temporal en la que se escribe una salida antes de reemplazar la final."""
+    return path.with_name(path.name + ".tmp")
+
+
+class _AtomicFile:
+    """Base de los writers de archivos: escriben en `<ruta>.tmp` y solo al
+    cerrar sin errores reemplazan la salida anterior. Si la corrida falla,
+    `abort()` borra el temporal y el archivo previo queda intacto.
+    """
+
+    def _open(self, **kwargs):
+        self._file = open(temp_path(self.path), "w", encoding="utf-8", **kwargs)
+
+    def close(self):
+        self._file.close()
+        os.replace(temp_path(self.path), self.path)
+
+    def abort(self):
+        if self._file:
+            self._file.close()
+        temp_path(self.path).unlink(missing_ok=True)
+
+
+class NdjsonWriter(_AtomicFile):
+    """Escribe un registro JSON por línea."""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._file = None
+
+    def open(self):
+        self._open()
+
+    def write(self, records):
+        self._file.writelines(jsoncodec.dumps(r) + "\n" for r in records)
+
+
+class TsvWriter(_AtomicFile):
+    """Escribe registros a TSV.
+
+    Con un `schema` (ver schema.py) las columnas son las del esquema; sin él
+    los registros ya son dicts planos y el encabezado sale de `fieldnames`
+    o, si no se indica, del primer registro.
+    """
+
+    def __init__(self, path, schema=None, fieldnames=None):
+        self.path = Path(path)
+        self.schema = schema
+        self.fieldnames = fieldnames
+        self._file = None
+        self._writer = None
+
+    def open(self):
+        self._open(newline="")
+        if self.schema is not None:
+            self._writer = csv.writer(self._file, delimiter="\t")
+            self._writer.writerow(self.schema.names)
+        elif self.fieldnames is not None:
+            self._writer = csv.DictWriter(self._file, fieldnames=self.fieldnames,
+                                          delimiter="\t", extrasaction="ignore")
+            self._writer.writeheader()
+
+    def write(self, records):
+        if self.schema is not None:
+            self._writer.writerows(map(self.schema.row, records))
+            return
+        for row in records:
+            if self._writer is None:
+                self._writer = csv.DictWriter(self._file, fieldnames=list(row.keys()),
+                                              delimiter="\t", extrasaction="ignore")
+                self._writer.writeheader()
+            self._writer.writerow(row)
+
+
+class ColumnsWriter(_AtomicFile):
+    """Escribe un TSV con columnas fijas (p. ej. los archivos de uuids)."""
+
+    def __init__(self, path, columns):
+        self.path = Path(path)
+        self.columns = columns
+        self._file = None
+        self._writer = None
+
+    def open(self):
+        self._open(newline="")
+        self._writer = csv.writer(self._file, delimiter="\t")
+        self._writer.writerow(self.columns)
+
+    def write(self, records):
+        self._writer.writerows([r.get(c) for c in self.columns] for r in records)
+
+
+class StreamingOutput:
+    """Reparte cada página recibida entre varios writers a medida que llega.
+
+    Así la memoria queda acotada a una página, sin importar el tamaño total.
+    Si la descarga falla se llama `abort()` en vez de `close()`, para no
+    dejar salidas truncadas en lugar de las anteriores.
+    """
+
+    def __init__(self, *writers):
+        self.writers = writers
+        self.count = 0
+
+    def __enter__(self):
+        for writer in self.writers:
+            writer.path.parent.mkdir(parents=True, exist_ok=True)
+            writer.open()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        for writer in self.writers:
+            if exc_type is None:
+                writer.close()
+            else:
+                writer.abort()
+
+    def write(self, records):
+        for writer in self.writers:
+            writer.write(records)
+        self.count += len(records)
+
+
+def read_ndjson(path):
+    """Lee un archivo NDJSON registro por registro."""
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield jsoncodec.loads(line)
+
+
+def read_records(path):
+    """Lee los registros guardados en `path` según OUTPUT_MODE.
+
+    En modo "ndjson" se lee en streaming el archivo .ndjson equivalente; un
+    .json se recorre elemento por elemento sin cargar todo el arreglo.
+    """
+    path = Path(path)
+    if streaming_enabled():
+        return read_ndjson(path.with_suffix(".ndjson"))
+    return jsoncodec.iter_array(path)
+
+
+def chunked(iterable, size):
+    """Divide un iterable en listas de hasta `size` elementos."""
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
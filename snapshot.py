@@ -0,0 +1,236 @@
+import asyncio
+import csv
+import io
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import config
+import jsoncodec
+from schema import Schema
+from sinks import StreamingOutput, NdjsonWriter, TsvWriter, ColumnsWriter, read_ndjson, chunked, streaming_enabled
+from columnar import ParquetWriter, save_parquet, parquet_enabled
+from store import Store, STORE_ENABLED
+
+# Codificación en paralelo de las salidas completas (JSON o NDJSON, TSV y uuids).
+# Procesos que codifican (None = uno por núcleo; 1 = todo en el proceso actual)
+OUTPUT_WORKERS = getattr(config, "OUTPUT_WORKERS", None)
+# Con menos registros que esto no vale la pena levantar procesos
+OUTPUT_PARALLEL_MIN_RECORDS = getattr(config, "OUTPUT_PARALLEL_MIN_RECORDS", 50000)
+# Registros por tanda enviada a cada proceso
+OUTPUT_SHARD_SIZE = getattr(config, "OUTPUT_SHARD_SIZE", 10000)
+
+_schemas = {}
+
+
+def _schema(fields):
+    # Las funciones compiladas no se pueden enviar a otro proceso: se compilan allí una vez
+    key = repr(fields)
+    if key not in _schemas:
+        _schemas[key] = Schema(fields)
+    return _schemas[key]
+
+
+def _encode_shard(records, json_mode, tsv_fields, uuid_columns):
+    """Codifica una tanda a los tres formatos (cada registro se codifica una sola vez).
+
+    Devuelve los bytes de cada salida, sin encabezados ni corchetes, para
+    concatenarlos en orden con los de las demás tandas.
+    """
+    data = ""
+    if json_mode == "json" and records:
+        # La tanda como arreglo sin "[\n  " ni "\n]": los mismos bytes que tendría
+        # dentro del arreglo completo
+        data = jsoncodec.dumps(records, indent=True)[4:-2]
+    elif json_mode == "ndjson":
+        data = "".join(jsoncodec.dumps(record) + "\n" for record in records)
+
+    row = _schema(tsv_fields).row if tsv_fields else None
+    tsv = io.StringIO()
+    uuids = io.StringIO()
+    tsv_writer = csv.writer(tsv, delimiter="\t")
+    uuid_writer = csv.writer(uuids, delimiter="\t")
+    for record in records:
+        if row:
+            tsv_writer.writerow(row(record))
+        if uuid_columns:
+            uuid_writer.writerow([record.get(c) for c in uuid_columns])
+    return data.encode("utf-8"), tsv.getvalue().encode("utf-8"), uuids.getvalue().encode("utf-8")
+
+
+def _workers(count):
+    workers = OUTPUT_WORKERS or os.cpu_count() or 1
+    if workers <= 1 or count < OUTPUT_PARALLEL_MIN_RECORDS:
+        return 1
+    return min(workers, -(-count // OUTPUT_SHARD_SIZE))
+
+
+def _encoded_shards(records, workers, *args):
+    """Tandas codificadas, en el orden original (en paralelo si `workers` > 1)."""
+    shards = [records[i:i + OUTPUT_SHARD_SIZE] for i in range(0, len(records), OUTPUT_SHARD_SIZE)]
+    if workers == 1:
+        for shard in shards:
+            yield _encode_shard(shard, *args)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        # A lo sumo dos tandas por proceso en vuelo, para acotar la memoria
+        pending = []
+        for shard in shards:
+            pending.append(pool.submit(_encode_shard, shard, *args))
+            if len(pending) >= workers * 2:
+                yield pending.pop(0).result()
+        for future in pending:
+            yield future.result()
+
+
+def _tsv_line(values):
+    buffer = io.StringIO()
+    csv.writer(buffer, delimiter="\t").writerow(values)
+    return buffer.getvalue().encode("utf-8")
+
+
+class _Target:
+    """Archivo de salida que se escribe en un temporal y se reemplaza al terminar."""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.tmp = self.path.with_name(self.path.name + ".tmp")
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.file = open(self.tmp, "wb")
+
+    def write(self, data):
+        self.file.write(data)
+
+    def commit(self):
+        self.file.close()
+        os.replace(self.tmp, self.path)
+
+    def abort(self):
+        self.file.close()
+        self.tmp.unlink(missing_ok=True)
+
+
+def save_snapshot(records, data_path=None, tsv=None, uuids=None):
+    """Guarda una lista de registros en JSON o NDJSON, TSV y uuids en una sola pasada.
+
+    `data_path` es el .json (arreglo con sangría) o el .ndjson, `tsv` es
+    (ruta, Schema) y `uuids` es (ruta, columnas). Con muchos
+    registros las tandas se codifican en varios procesos y se concatenan en
+    orden; el resultado es idéntico al de codificarlas en secuencia.
+    """
+    records = records if isinstance(records, list) else list(records)
+    json_mode = None
+    if data_path:
+        json_mode = "ndjson" if Path(data_path).suffix == ".ndjson" else "json"
+    tsv_fields = tsv[1].fields if tsv else None
+    uuid_columns = list(uuids[1]) if uuids else None
+
+    targets = [_Target(path) if path else None
+               for path in (data_path, tsv and tsv[0], uuids and uuids[0])]
+    data_file, tsv_file, uuid_file = targets
+    try:
+        if tsv_file:
+            tsv_file.write(_tsv_line(tsv[1].names))
+        if uuid_file:
+            uuid_file.write(_tsv_line(uuid_columns))
+
+        first = True
+        if json_mode == "json":
+            data_file.write(b"[\n  " if records else b"[]")
+        shards = _encoded_shards(records, _workers(len(records)), json_mode, tsv_fields, uuid_columns)
+        for data, tsv_data, uuid_data in shards:
+            if data_file:
+                if json_mode == "json" and not first:
+                    data_file.write(b",\n  ")
+                data_file.write(data)
+            if tsv_file:
+                tsv_file.write(tsv_data)
+            if uuid_file:
+                uuid_file.write(uuid_data)
+            first = False
+        if json_mode == "json" and records:
+            data_file.write(b"\n]")
+    except BaseException:
+        for target in targets:
+            if target:
+                target.abort()
+        raise
+    for target in targets:
+        if target:
+            target.commit()
+
+
+class StageOutput:
+    """Salidas de una etapa de descarga (01-03) y su tabla en el espejo local.
+
+    `name` es el nombre base de los archivos (<name>.json o .ndjson, .tsv y
+    .parquet), `uuids` es (archivo, columnas) y `store` es (tabla, método de
+    Store que la llena, filtro por alcance como "patron_group = ?" o None).
+    """
+
+    def __init__(self, directory, name, schema, parquet_columns, uuids, store=None):
+        self.directory = Path(directory)
+        self.name = name
+        self.schema = schema
+        self.parquet_columns = parquet_columns
+        self.uuids = (self.directory / uuids[0], list(uuids[1]))
+        self.store = store
+
+    def path(self, suffix):
+        return self.directory / f"{self.name}{suffix}"
+
+    def writers(self):
+        """Writers de la salida en streaming (NDJSON, TSV, uuids y Parquet opcional)."""
+        writers = [
+            NdjsonWriter(self.path(".ndjson")),
+            TsvWriter(self.path(".tsv"), self.schema),
+            ColumnsWriter(*self.uuids),
+        ]
+        if parquet_enabled():
+            writers.append(ParquetWriter(self.path(".parquet"), self.parquet_columns))
+        return writers
+
+    def reload_store(self, records, scope_values=()):
+        """Recarga la tabla del espejo SQLite local, en una sola transacción corta.
+
+        Con filtro de alcance solo se reemplazan las filas de `scope_values`.
+        """
+        table, upsert, scope = self.store
+        with Store() as store:
+            if scope:
+                for value in scope_values:
+                    store.clear(table, scope, (value,))
+            else:
+                store.clear(table)
+            for chunk in chunked(records, 1000):
+                getattr(store, upsert)(chunk)
+
+    async def stream(self, download, scope_values=()):
+        """Escribe cada página directo a NDJSON/TSV/uuids sin acumular en memoria.
+
+        `download(out)` descarga y va llamando `out.write(batch)`. El espejo se
+        recarga al final desde el NDJSON ya escrito, en otro hilo: no se tiene
+        el lock de escritura de SQLite durante la descarga.
+        """
+        with StreamingOutput(*self.writers()) as out:
+            await download(out)
+        if STORE_ENABLED and self.store:
+            await asyncio.to_thread(self.reload_store, read_ndjson(self.path(".ndjson")), scope_values)
+        return out.count
+
+    def save(self, records, scope_values=(), mirror=True):
+        """Escribe las salidas de una lista completa (JSON o NDJSON, TSV, uuids, Parquet y espejo).
+
+        `mirror=False` deja el espejo como está (p. ej. si ya lo actualizó la
+        sincronización incremental).
+        """
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+        # JSON (o NDJSON), TSV y uuids en una sola pasada; con muchos registros, en varios procesos
+        data_path = self.path(".ndjson" if streaming_enabled() else ".json")
+        save_snapshot(records, data_path, tsv=(self.path(".tsv"), self.schema), uuids=self.uuids)
+        if parquet_enabled():
+            save_parquet(records, self.path(".parquet"), self.parquet_columns)
+        if STORE_ENABLED and self.store and mirror:
+            self.reload_store(records, scope_values)
+
+        print("Archivos guardados en la carpeta 'output'.")
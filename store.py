@@ -0,0 +1,181 @@
+import sqlite3
+from pathlib import Path
+import config
+import jsoncodec
+
+# Espejo local en SQLite de los datos descargados de Okapi.
+# Las rutas relativas se toman desde la raíz del repositorio.
+STORE_PATH = Path(__file__).resolve().parent / getattr(config, "STORE_PATH", "output/okapi_mirror.sqlite")
+# Si está activo, las etapas 01-03 llenan el espejo y 04/05 lo consultan
+STORE_ENABLED = getattr(config, "STORE_ENABLED", False)
+# Segundos que una conexión espera a que otra suelte el lock de escritura (las
+# etapas 01-03 corren a la vez y escriben el espejo, cada una en transacciones cortas)
+STORE_BUSY_TIMEOUT = getattr(config, "STORE_BUSY_TIMEOUT", 30)
+# El espejo es de un solo tenant: con varios perfiles (OKAPI_PROFILES) no se usa
+if STORE_ENABLED and len(getattr(config, "OKAPI_PROFILES", None) or []) > 1:
+    print("⚠️  STORE_ENABLED no admite varios perfiles en OKAPI_PROFILES; se desactiva el espejo")
+    STORE_ENABLED = False
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    id TEXT PRIMARY KEY,
+    patron_group TEXT,
+    updated_date TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_users_patron_group ON users (patron_group);
+
+CREATE TABLE IF NOT EXISTS service_points (
+    id TEXT PRIMARY KEY,
+    name TEXT,
+    updated_date TEXT,
+    data TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS service_point_users (
+    id TEXT PRIMARY KEY,
+    user_id TEXT,
+    updated_date TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_spu_user_id ON service_point_users (user_id);
+
+CREATE TABLE IF NOT EXISTS service_point_user_assignments (
+    spu_id TEXT NOT NULL,
+    user_id TEXT,
+    service_point_id TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    PRIMARY KEY (spu_id, position)
+);
+CREATE INDEX IF NOT EXISTS idx_spua_user_id ON service_point_user_assignments (user_id);
+CREATE INDEX IF NOT EXISTS idx_spua_service_point_id ON service_point_user_assignments (service_point_id);
+
+CREATE TABLE IF NOT EXISTS sync_state (
+    collection TEXT PRIMARY KEY,
+    high_water_mark TEXT,
+    synced_at TEXT
+);
+"""
+
+
+def _updated_date(record):
+    return (record.get("metadata") or {}).get("updatedDate")
+
+
+class Store:
+    """Espejo local de users, service points y service-points-users."""
+
+    def __init__(self, path=None):
+        self.path = Path(path or STORE_PATH)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # La espera por el lock bloquea el hilo: desde código async, la conexión se
+        # abre y se escribe en un hilo de trabajo (asyncio.to_thread), uno a la vez
+        self.db = sqlite3.connect(self.path, timeout=STORE_BUSY_TIMEOUT, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.db.commit()
+        self.close()
+
+    def close(self):
+        self.db.close()
+
+    def commit(self):
+        self.db.commit()
+
+    # --- Escritura ---
+
+    def upsert_users(self, users):
+        self.db.executemany(
+            "INSERT OR REPLACE INTO users (id, patron_group, updated_date, data) VALUES (?, ?, ?, ?)",
+            [(u["id"], u.get("patronGroup"), _updated_date(u), jsoncodec.dumps(u)) for u in users],
+        )
+
+    def upsert_service_points(self, service_points):
+        self.db.executemany(
+            "INSERT OR REPLACE INTO service_points (id, name, updated_date, data) VALUES (?, ?, ?, ?)",
+            [(sp["id"], sp.get("name"), _updated_date(sp), jsoncodec.dumps(sp))
+             for sp in service_points],
+        )
+
+    def upsert_service_point_users(self, sp_users):
+        sp_users = list(sp_users)
+        self.db.executemany(
+            "INSERT OR REPLACE INTO service_point_users (id, user_id, updated_date, data) VALUES (?, ?, ?, ?)",
+            [(spu["id"], spu.get("userId"), _updated_date(spu), jsoncodec.dumps(spu))
+             for spu in sp_users],
+        )
+        self.db.executemany(
+            "DELETE FROM service_point_user_assignments WHERE spu_id = ?",
+            [(spu["id"],) for spu in sp_users],
+        )
+        self.db.executemany(
+            "INSERT INTO service_point_user_assignments (spu_id, user_id, service_point_id, position) "
+            "VALUES (?, ?, ?, ?)",
+            [(spu["id"], spu.get("userId"), sp_id, position)
+             for spu in sp_users
+             for position, sp_id in enumerate(spu.get("servicePointsIds") or [])],
+        )
+
+    def clear(self, table, where=None, params=()):
+        """Borra una tabla (o parte de ella) antes de recargarla completa."""
+        if table == "service_point_users" and where is None:
+            self.db.execute("DELETE FROM service_point_user_assignments")
+        self.db.execute(f"DELETE FROM {table}" + (f" WHERE {where}" if where else ""), params)
+
+    def delete(self, table, ids):
+        ids = [(i,) for i in ids]
+        if table == "service_point_users":
+            self.db.executemany("DELETE FROM service_point_user_assignments WHERE spu_id = ?", ids)
+        self.db.executemany(f"DELETE FROM {table} WHERE id = ?", ids)
+
+    def get_mark(self, collection):
+        row = self.db.execute(
+            "SELECT high_water_mark FROM sync_state WHERE collection = ?", (collection,)).fetchone()
+        return row[0] if row else None
+
+    def set_mark(self, collection, mark):
+        self.db.execute(
+            "INSERT OR REPLACE INTO sync_state (collection, high_water_mark, synced_at) "
+            "VALUES (?, ?, datetime('now'))",
+            (collection, mark),
+        )
+
+    # --- Lectura ---
+
+    def user_service_point_names(self, user_id):
+        """Nombres de los service points asignados a un usuario, en orden."""
+        rows = self.db.execute(
+            "SELECT sp.name FROM service_point_user_assignments a "
+            "LEFT JOIN service_points sp ON sp.id = a.service_point_id "
+            "WHERE a.user_id = ? ORDER BY a.spu_id, a.position",
+            (user_id,),
+        )
+        return [name or "" for (name,) in rows]
+
+    def iter_service_point_users(self):
+        for (data,) in self.db.execute("SELECT data FROM service_point_users ORDER BY id"):
+            yield jsoncodec.loads(data)
+
+    def records(self, table, where=None, params=()):
+        """Registros completos de una tabla (opcionalmente filtrados), por id."""
+        sql = f"SELECT data FROM {table}" + (f" WHERE {where}" if where else "") + " ORDER BY id"
+        return [jsoncodec.loads(data) for (data,) in self.db.execute(sql, params)]
+
+    def ids(self, table, where=None, params=()):
+        sql = f"SELECT id FROM {table}" + (f" WHERE {where}" if where else "")
+        return {i for (i,) in self.db.execute(sql, params)}
+
+    def count(self, table, where=None, params=()):
+        sql = f"SELECT COUNT(*) FROM {table}" + (f" WHERE {where}" if where else "")
+        return self.db.execute(sql, params).fetchone()[0]
+
+    def max_updated_date(self, table, where=None, params=()):
+        sql = f"SELECT MAX(updated_date) FROM {table}" + (f" WHERE {where}" if where else "")
+        return self.db.execute(sql, params).fetchone()[0]
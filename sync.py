@@ -0,0 +1,131 @@
+import asyncio
+from bisect import bisect_left, bisect_right
+import config
+from fetch import fetch_all, fetch_pages
+from sinks import chunked
+
+# Si está activo, las etapas 01 y 03 solo traen lo modificado desde la última corrida
+INCREMENTAL_SYNC = getattr(config, "INCREMENTAL_SYNC", False)
+# La sincronización usa el espejo local, que es de un solo tenant
+if INCREMENTAL_SYNC and len(getattr(config, "OKAPI_PROFILES", None) or []) > 1:
+    print("⚠️  INCREMENTAL_SYNC no admite varios perfiles en OKAPI_PROFILES; se descarga todo")
+    INCREMENTAL_SYNC = False
+# Rango de ids a partir del cual se comparan ids en vez de seguir dividiendo
+RECONCILE_LEAF_SIZE = getattr(config, "SYNC_RECONCILE_LEAF_SIZE", 1000)
+
+HEX_DIGITS = "0123456789abcdef"
+
+
+def _uuid_bound(prefix, fill):
+    digits = (prefix + fill * 32)[:32]
+    return f"{digits[:8]}-{digits[8:12]}-{digits[12:16]}-{digits[16:20]}-{digits[20:]}"
+
+
+def _and(*clauses):
+    return " and ".join(f"({c})" for c in clauses if c)
+
+
+def _id_range(prefix):
+    """Límites (inclusive) de los UUID que empiezan con `prefix`."""
+    return _uuid_bound(prefix, "0"), _uuid_bound(prefix, "f")
+
+
+async def remote_count(conn, path, query):
+    """Cantidad de registros que cumplen un CQL, sin descargarlos (limit=0)."""
+    data = await conn.get_json(path, params={"query": query, "limit": 0})
+    return data.get("totalRecords", 0)
+
+
+def _known_ids(store, table, ids, scope=None, scope_params=()):
+    """Los ids que ya están en el espejo (dentro del alcance), consultados por lotes."""
+    known = set()
+    for chunk in chunked(ids, 500):
+        where = _and(scope, f"id IN ({','.join('?' * len(chunk))})")
+        known |= store.ids(table, where, (*scope_params, *chunk))
+    return known
+
+
+async def reconcile_deletions(conn, store, table, path, key, base_query=None, scope=None, scope_params=(),
+                              added=()):
+    """Detecta los registros borrados en Okapi que siguen en el espejo local.
+
+    Con los cambios ya descargados (`added` son los ids nuevos que aún no se
+    guardaron), el espejo contiene todo lo que hay en Okapi, así que un rango
+    de ids con el mismo conteo local y remoto no tiene bajas. Se comparan
+    conteos (limit=0) y solo se bajan a nivel de ids los rangos que difieren,
+    dividiéndolos por el siguiente dígito hexadecimal. Solo lee del espejo:
+    los borrados se devuelven y se aplican después, junto con los cambios.
+    """
+    deleted = []
+    added = sorted(added)
+
+    async def check(prefix):
+        lo, hi = _id_range(prefix)
+        where = _and(scope, "id >= ? and id <= ?")
+        params = (*scope_params, lo, hi)
+        query = _and(base_query, f'id >= "{lo}" and id <= "{hi}"')
+        new = added[bisect_left(added, lo):bisect_right(added, hi)]
+
+        local = store.count(table, where, params) + len(new)
+        if local == 0:
+            return
+        remote = await remote_count(conn, path, query)
+        if local == remote:
+            return
+        if min(local, remote) <= RECONCILE_LEAF_SIZE or len(prefix) >= 8:
+            records = await fetch_all(conn, path, key, query=query, mode="keyset", label="")
+            deleted.extend((store.ids(table, where, params) | set(new)) - {r["id"] for r in records})
+            return
+        await asyncio.gather(*(check(prefix + digit) for digit in HEX_DIGITS))
+
+    await check("")
+    return deleted
+
+
+async def delta_sync(conn, store, collection, table, path, key, upsert,
+                     base_query=None, scope=None, scope_params=(), label=None):
+    """Actualiza una colección del espejo local trayendo solo lo modificado.
+
+    Se guarda como marca el `metadata.updatedDate` más alto visto; la próxima
+    vez se piden solo registros con fecha mayor o igual y se aplican sobre la
+    copia anterior. La primera vez se hace una descarga completa.
+
+    Primero se descargan los cambios y se buscan los borrados (solo lecturas);
+    después se aplica todo en una sola transacción corta, sin esperar a la red.
+    """
+    label = label or collection
+    mark = store.get_mark(collection)
+
+    if mark is None:
+        print(f"Sin marca previa para {label}: descarga completa")
+        query = base_query
+    else:
+        print(f"Descargando {label} modificados desde {mark}")
+        query = _and(base_query, f'metadata.updatedDate >= "{mark}"')
+
+    changed = []
+    async for batch in fetch_pages(conn, path, key, query=query, label=label):
+        changed.extend(batch)
+
+    deleted = []
+    if mark is not None:
+        ids = [record["id"] for record in changed]
+        added = set(ids) - _known_ids(store, table, ids, scope, scope_params)
+        deleted = await reconcile_deletions(conn, store, table, path, key, base_query, scope, scope_params,
+                                            added)
+
+    def apply():
+        if mark is None:
+            store.clear(table, scope, scope_params)
+        for chunk in chunked(changed, 1000):
+            upsert(chunk)
+        # Solo se borra lo que sigue en este alcance: otra sincronización pudo
+        # mover el registro a otro patron group mientras se buscaban los borrados
+        store.delete(table, _known_ids(store, table, deleted, scope, scope_params))
+        store.set_mark(collection, store.max_updated_date(table, scope, scope_params) or mark)
+        store.commit()
+
+    # Si otra etapa está escribiendo, la espera por el lock ocurre en otro hilo
+    await asyncio.to_thread(apply)
+    print(f"{label}: {len(changed)} nuevos o modificados, {len(deleted)} borrados")
+    return len(changed), deleted
@@ -0,0 +1,204 @@
+import asyncio
+import hashlib
+import json
+import os
+import time
+from datetime import datetime
+from pathlib import Path
+import config
+
+# Carpeta donde se comparte el token entre procesos (etapas 01-05).
+# Las rutas relativas se toman desde la raíz del repositorio.
+TOKEN_CACHE_DIR = Path(__file__).resolve().parent / getattr(config, "OKAPI_TOKEN_CACHE_DIR", ".okapi_cache")
+# Vida asumida para tokens sin expiración explícita (/authn/login clásico)
+DEFAULT_TOKEN_TTL = getattr(config, "OKAPI_TOKEN_TTL", 600)
+# Segundos antes de expirar en los que se renueva el token
+REFRESH_MARGIN = getattr(config, "OKAPI_TOKEN_REFRESH_MARGIN", 60)
+# Un lock que no se renueva hace más que esto se considera abandonado por un
+# proceso caído; debe superar el timeout de una petición (el login)
+LOCK_STALE_AFTER = getattr(config, "OKAPI_REQUEST_TIMEOUT", 120) + 30
+
+
+class FileLock:
+    """Lock entre procesos basado en un archivo creado de forma exclusiva.
+
+    Mientras se tiene, se renueva la fecha del archivo, así un login con
+    reintentos que dure más que LOCK_STALE_AFTER no pierde el lock.
+    """
+
+    def __init__(self, path, poll=0.1):
+        self.path = Path(path)
+        self.poll = poll
+        self._keepalive = None
+
+    async def __aenter__(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        while True:
+            try:
+                fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                os.write(fd, str(os.getpid()).encode())
+                os.close(fd)
+                self._keepalive = asyncio.get_running_loop().create_task(self._touch())
+                return self
+            except FileExistsError:
+                try:
+                    if time.time() - self.path.stat().st_mtime > LOCK_STALE_AFTER:
+                        self.path.unlink(missing_ok=True)
+                        continue
+                except FileNotFoundError:
+                    continue
+                await asyncio.sleep(self.poll)
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self._keepalive.cancel()
+        self.path.unlink(missing_ok=True)
+
+    async def _touch(self):
+        while True:
+            await asyncio.sleep(LOCK_STALE_AFTER / 3)
+            try:
+                os.utime(self.path)
+            except FileNotFoundError:
+                return
+
+
+def _parse_expiration(value):
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+    except ValueError:
+        return None
+
+
+class TokenManager:
+    """Mantiene el token de Okapi vigente, en memoria y en un caché en disco.
+
+    El token se renueva en segundo plano antes de expirar y se comparte entre
+    procesos mediante un archivo protegido con lock, de modo que varias etapas
+    corriendo a la vez hacen un solo login.
+    """
+
+    def __init__(self, conn, cache_dir=None):
+        self.conn = conn
+        self.token = None
+        self.expires_at = 0
+        key = f"{conn.okapi_url}|{conn.tenant}|{conn.username}"
+        name = hashlib.sha256(key.encode()).hexdigest()[:16]
+        cache_dir = Path(cache_dir or TOKEN_CACHE_DIR)
+        self.cache_path = cache_dir / f"token_{name}.json"
+        self.lock = FileLock(cache_dir / f"token_{name}.lock")
+        self._login_lock = asyncio.Lock()
+        self._refresh_task = None
+
+    def _is_fresh(self, expires_at):
+        return expires_at - REFRESH_MARGIN > time.time()
+
+    async def get(self):
+        if self.token and self._is_fresh(self.expires_at):
+            return self.token
+        return await self.refresh()
+
+    async def refresh(self, stale_token=None):
+        """Obtiene un token nuevo (desde el caché compartido o con login)."""
+        async with self._login_lock:
+            # Otro coroutine ya lo renovó mientras esperábamos
+            if self.token and self.token != stale_token and self._is_fresh(self.expires_at):
+                return self.token
+
+            async with self.lock:
+                cached = self._read_cache()
+                if cached and cached["token"] != stale_token and self._is_fresh(cached["expires_at"]):
+                    self.token, self.expires_at = cached["token"], cached["expires_at"]
+                else:
+                    self.token, self.expires_at = await self._login()
+                    self._write_cache()
+
+            self._schedule_refresh()
+            return self.token
+
+    async def invalidate(self, token):
+        """Descarta un token rechazado por Okapi (401) y obtiene otro."""
+        return await self.refresh(stale_token=token)
+
+    async def _post_login(self, path, payload):
+        """POST de login con reintentos ante fallas transitorias (conexión, 429, 5xx).
+
+        El login no tiene efectos que se dupliquen, así que se reintenta
+        como una petición idempotente, con el mismo backoff que el resto.
+        """
+        from connection import OkapiError, retry_delay  # connection importa este módulo
+        conn = self.conn
+        attempt = 0
+        while True:
+            try:
+                response = await conn._send("POST", f"{conn.okapi_url}{path}",
+                                            json=payload, headers=conn.headers())
+            except OkapiError:
+                delay = retry_delay("POST", attempt, idempotent=True)
+                if delay is None:
+                    raise
+            else:
+                delay = retry_delay("POST", attempt, response, idempotent=True)
+                if delay is None:
+                    return response
+            attempt += 1
+            print(f"⚠️  Login falló de forma transitoria; reintento {attempt} en {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+    async def _login(self):
+        conn = self.conn
+        payload = {
+            "username": conn.username,
+            "password": conn.password
+        }
+
+        # Login con expiración (FOLIO Poppy+); si no existe usamos el clásico
+        response = await self._post_login("/authn/login-with-expiry", payload)
+        if response.status == 201:
+            token = response.cookies.get("folioAccessToken")
+            expires_at = _parse_expiration(response.json().get("accessTokenExpiration"))
+            if token:
+                return token, expires_at or time.time() + DEFAULT_TOKEN_TTL
+
+        response = await self._post_login("/authn/login", payload)
+        if response.status == 201:
+            return response.headers.get("x-okapi-token"), time.time() + DEFAULT_TOKEN_TTL
+        raise Exception(f"❌ Error al obtener token: {response.status} {response.text()}")
+
+    def _read_cache(self):
+        try:
+            with open(self.cache_path, encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("token") and data.get("expires_at"):
+                return data
+        except (OSError, ValueError):
+            pass
+        return None
+
+    def _write_cache(self):
+        tmp = self.cache_path.with_suffix(".tmp")
+        fd = os.open(tmp, os.O_CREAT | os.O_TRUNC | os.O_WRONLY, 0o600)
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump({"token": self.token, "expires_at": self.expires_at}, f)
+        os.replace(tmp, self.cache_path)
+
+    def _schedule_refresh(self):
+        """Programa la renovación en segundo plano antes de que expire."""
+        current = asyncio.current_task()
+        if self._refresh_task not in (None, current) and not self._refresh_task.done():
+            self._refresh_task.cancel()
+        self._refresh_task = asyncio.get_running_loop().create_task(self._refresh_later())
+
+    async def _refresh_later(self):
+        delay = self.expires_at - REFRESH_MARGIN - time.time()
+        await asyncio.sleep(max(delay, 1))
+        try:
+            await self.refresh(stale_token=self.token)
+        except Exception as e:
+            print(f"⚠️ Error al renovar token en segundo plano: {e}")
+
+    def close(self):
+        if self._refresh_task is not None:
+            self._refresh_task.cancel()
+            self._refresh_task = None